@@ -1,17 +1,54 @@
-from .fields import cached, denormalized, CountField, CacheKeyField
-from .denorms import flush, rebuildall
-from .dependencies import depend_on_related
+import importlib
+import sys
+import types
 
-from django.conf import settings
-if hasattr(settings, 'DENORM_FLUSH_AFTER_REQUEST'):
-    import warnings
-    warnings.warn("The DENORM_FLUSH_AFTER_REQUEST will be deprecated in favor of the new DenormMiddleware", DeprecationWarning)
+import django
 
-if hasattr(settings, 'DENORM_FLUSH_AFTER_REQUEST') and settings.DENORM_FLUSH_AFTER_REQUEST:
-    from django.core.signals import request_finished
+if django.VERSION < (3, 2):
+    # found automatically since Django 3.2
+    default_app_config = 'denorm.apps.DenormConfig'
 
-    def do_flush(sender, **kwargs):
-        flush()
-    request_finished.connect(do_flush)
+# The public names and the modules defining them. They are only imported
+# on first access, so importing denorm doesn't load Django's ORM internals.
+LAZY_NAMES = {
+    'cached': 'fields',
+    'denormalized': 'fields',
+    'CountField': 'fields',
+    'CacheKeyField': 'fields',
+    'flush': 'denorms',
+    'rebuildall': 'denorms',
+    'depend_on_related': 'dependencies',
+}
 
 __all__ = ['cached', 'denormalized', 'depend_on_related', 'flush', 'rebuildall', 'CountField', 'CacheKeyField']
+
+
+def __getattr__(name):
+    try:
+        module = LAZY_NAMES[name]
+    except KeyError:
+        raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(LAZY_NAMES))
+
+
+if sys.version_info < (3, 7):
+    # Modules only support __getattr__ since Python 3.7
+    class LazyModule(types.ModuleType):
+        def __getattr__(self, name):
+            return __getattr__(name)
+
+        def __dir__(self):
+            return __dir__()
+
+    try:
+        sys.modules[__name__].__class__ = LazyModule
+    except TypeError:  # Python<3.5
+        from .fields import cached, denormalized, CountField, CacheKeyField
+        from .denorms import flush, rebuildall
+        from .dependencies import depend_on_related
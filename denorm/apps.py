@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from django.apps import AppConfig
+from django.conf import settings
+
+
+def do_flush(sender, **kwargs):
+    from .denorms import flush
+    flush(concurrent=True)
+
+
+class DenormConfig(AppConfig):
+    name = 'denorm'
+
+    def ready(self):
+        from .registry import registry
+        registry.build()
+
+        if hasattr(settings, 'DENORM_FLUSH_AFTER_REQUEST'):
+            import warnings
+            warnings.warn("The DENORM_FLUSH_AFTER_REQUEST will be deprecated in favor of the new DenormMiddleware", DeprecationWarning)
+
+        if getattr(settings, 'DENORM_FLUSH_AFTER_REQUEST', False):
+            from django.core.signals import request_finished
+            request_finished.connect(do_flush)
@@ -1,5 +1,3 @@
-from django.conf import settings
-
 """
 This file attempts to automatically load the denorm backend for your chosen
 database adaptor.
@@ -12,7 +10,14 @@ DATABASES = {
         'DENORM_BACKEND': 'denorm.db.postgresql',
     }
 }
+
+The backend of a database is only imported when it is first needed and then
+cached per database alias, so importing denorm doesn't touch the database
+settings.
 """
+import importlib
+
+from django.db import connections, DEFAULT_DB_ALIAS
 
 # Default mappings from common postgresql equivalents
 DB_GUESS_MAPPING = {
@@ -20,18 +25,47 @@ DB_GUESS_MAPPING = {
     'postgresql_psycopg2': 'postgresql',
 }
 
+# The trigger modules by database alias
+backends = {}
+
 
 def backend_for_dbname(db_name):
     return 'denorm.db.%s' % DB_GUESS_MAPPING.get(db_name, db_name)
 
-from django.db import connections, DEFAULT_DB_ALIAS
-if 'DENORM_BACKEND' in connections[DEFAULT_DB_ALIAS].settings_dict:
-    backend = connections[DEFAULT_DB_ALIAS].settings_dict['DENORM_BACKEND']
-else:
-    engine = connections[DEFAULT_DB_ALIAS].settings_dict['ENGINE']
-    backend = backend_for_dbname(engine.rsplit(".", 1)[1])
-
-try:
-    triggers = __import__('.'.join([backend, 'triggers']), {}, {}, [''])
-except ImportError:
-    raise ImportError("""There is no django-denorm database module for the engine '%s'. Please either choose a supported one, or remove 'denorm' from INSTALLED_APPS.\n""" % backend)
+
+def get_backend(using=None):
+    """
+    Returns the ``triggers`` module of the denorm backend for the database
+    ``using`` (the default database if not given).
+    """
+    using = using or DEFAULT_DB_ALIAS
+    try:
+        return backends[using]
+    except KeyError:
+        pass
+
+    settings_dict = connections.databases[using]
+    if 'DENORM_BACKEND' in settings_dict:
+        backend = settings_dict['DENORM_BACKEND']
+    else:
+        backend = backend_for_dbname(settings_dict['ENGINE'].rsplit(".", 1)[1])
+
+    try:
+        triggers = importlib.import_module('.'.join([backend, 'triggers']))
+    except ImportError:
+        raise ImportError("""There is no django-denorm database module for the engine '%s'. Please either choose a supported one, or remove 'denorm' from INSTALLED_APPS.\n""" % backend)
+    backends[using] = triggers
+    return triggers
+
+
+class DefaultBackend(object):
+    """
+    Proxy for the ``triggers`` module of the default database's backend,
+    which is only loaded on first access.
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_backend(DEFAULT_DB_ALIAS), name)
+
+
+triggers = DefaultBackend()
@@ -1,4 +1,8 @@
-from django.db import models, connections, connection
+import hashlib
+import time
+import uuid
+
+from django.db import models, connections, connection, transaction, DatabaseError
 from ..helpers import remote_field_model
 
 
@@ -10,6 +14,7 @@ class RandomBigInt(object):
 class TriggerNestedSelect:
     def __init__(self, table, columns, **kwargs):
         self.table = table
+        self.column_list = columns
         self.columns = ", ".join(columns)
         self.kwargs = kwargs
 
@@ -17,6 +22,19 @@ class TriggerNestedSelect:
         raise NotImplementedError
 
 
+class NestedSelect(TriggerNestedSelect):
+    """
+    A nested select given as SQL and parameters, used by actions that are
+    executed directly instead of in a trigger.
+    """
+    def __init__(self, sql, params=()):
+        self.select = sql
+        self.params = tuple(params)
+
+    def sql(self):
+        return self.select, self.params
+
+
 class TriggerAction(object):
     def __init__(self):
         pass
@@ -26,20 +44,54 @@ class TriggerAction(object):
 
 
 class TriggerActionInsert(TriggerAction):
-    def __init__(self, model, columns, values):
+    """
+    Inserts a dirty marker. If the marker already exists but has been
+    claimed by a flush, the claim is dropped instead, so the flush does not
+    delete it afterwards.
+
+    ``bypass`` can be a ``(content_type, key)`` tuple, ``key`` being the SQL
+    expression for the primary key of the changed row. The action is then
+    skipped while a ``TriggerBypass`` for ``'<content_type>:*'`` or
+    ``'<content_type>:<primary key>'`` is active on the connection.
+    """
+    def __init__(self, model, columns, values, bypass=None):
         self.model = model
         self.columns = columns
         self.values = values
+        self.bypass = bypass
+
+    def bypass_tokens(self):
+        """
+        Returns the SQL literal of the content type wide token and the
+        prefix of the per row token.
+        """
+        content_type, key = self.bypass
+        return "'%s:*'" % content_type, "'%s:'" % content_type, key
 
     def sql(self):
         raise NotImplementedError
 
+    def statements(self):
+        """
+        Returns the ``(sql, params)`` of the statements to execute the
+        action outside of a trigger.
+        """
+        return [self.sql()]
+
 
 class TriggerActionUpdate(TriggerAction):
-    def __init__(self, model, columns, values, where):
+    """
+    Updates ``columns`` of the rows of ``model`` matching ``where``.
+
+    If the update just adds a value to each column (like the incremental
+    updates of aggregates), ``deltas`` can give the added values, which
+    allows backends to combine the updates of many changed rows.
+    """
+    def __init__(self, model, columns, values, where, deltas=None):
         self.model = model
         self.columns = columns
         self.where = where
+        self.deltas = deltas
 
         self.values = []
         for value in values:
@@ -52,6 +104,50 @@ class TriggerActionUpdate(TriggerAction):
         raise NotImplementedError
 
 
+class TriggerBypass(object):
+    """
+    Context manager that makes the triggers skip all actions with a
+    matching ``bypass`` for the statements run on the connection inside it.
+    Used for writes of denormalized values that are already up to date:
+    by the flush and by ORM saves (see ``denorms.bypass_pre_save``).
+
+    Bypasses can be nested. Outside of atomic blocks a bypass can't be
+    tied to a transaction, so ORM saves in autocommit mode are not
+    bypassed and mark their instance dirty as usual.
+    """
+    # the table the tokens are kept in and the SQL creating it, if the
+    # backend needs one (see the denorm migration 0008_bypass_table)
+    table = None
+    table_sql = None
+
+    def __init__(self, token, using=None):
+        self.token = token
+        # identifies the row of the bypass in ``table``, so bypasses with
+        # the same token neither remove nor lock each other's rows
+        self.id = uuid.uuid4().hex
+        self.using = using
+        if self.using:
+            self.connection = connections[self.using]
+        else:
+            self.connection = connection
+
+    def enable_sql(self):
+        raise NotImplementedError
+
+    def disable_sql(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        self.connection.cursor().execute(*self.enable_sql())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # on errors inside a transaction it is rolled back, which also
+        # resets the bypass; outside of one it lasts for the session
+        if exc_type is None or not self.connection.in_atomic_block:
+            self.connection.cursor().execute(*self.disable_sql())
+
+
 def get_fields_with_model(model, meta):
     try:
         return [
@@ -66,11 +162,13 @@ def get_fields_with_model(model, meta):
 
 class Trigger(object):
 
-    def __init__(self, subject, time, event, actions, content_type, using=None, skip=None):
+    def __init__(self, subject, time, event, actions, content_type, using=None, skip=None, fields=None):
         self.subject = subject
         self.time = time
         self.event = event
         self.content_type = content_type
+        # the denorms using this trigger, see TriggerSet.append
+        self.denorms = set()
         self.content_type_field = None
         self.actions = []
         self.append(actions)
@@ -90,22 +188,29 @@ class Trigger(object):
             self.model = None
             self.db_table = subject.m2m_db_table()
             self.fields = [(subject.m2m_column_name(), ''), (subject.m2m_reverse_name(), '')]
+            try:
+                self.pk_column = subject.remote_field.through._meta.pk.column
+            except AttributeError:  # Django<1.9
+                self.pk_column = subject.rel.through._meta.pk.column
 
         elif isinstance(subject, GenericRelation):
             self.model = None
             self.db_table = remote_field_model(subject)._meta.db_table
+            self.pk_column = remote_field_model(subject)._meta.pk.column
             self.fields = [(k.attname, k.db_type(connection=self.connection)) for k, v in get_fields_with_model(remote_field_model(subject), remote_field_model(subject)._meta) if not v]
             self.content_type_field = subject.content_type_field_name + '_id'
 
         elif isinstance(subject, models.ForeignKey):
             self.model = subject.model
             self.db_table = self.model._meta.db_table
+            self.pk_column = self.model._meta.pk.column
             skip = skip or () + getattr(self.model, 'denorm_always_skip', ())
             self.fields = [(k.attname, k.db_type(connection=self.connection)) for k, v in get_fields_with_model(subject.model, self.model._meta) if not v and k.attname not in skip]
 
         elif hasattr(subject, "_meta"):
             self.model = subject
             self.db_table = self.model._meta.db_table
+            self.pk_column = self.model._meta.pk.column
             # FIXME: need to check get_parent_list and add triggers to those
             # The below will only check the fields on *this* model, not parents
             skip = skip or () + getattr(self.model, 'denorm_always_skip', ())
@@ -124,6 +229,14 @@ class Trigger(object):
         else:
             raise NotImplementedError
 
+        # Only compare the columns of the given fields, changes to any
+        # other column don't run the trigger. Such triggers get a name of
+        # their own, so they aren't merged with the ones for all columns.
+        self.narrowed = fields is not None and self.model is not None
+        if self.narrowed:
+            attnames = set(self.model._meta.get_field(name).attname for name in fields)
+            self.fields = [(k, v) for k, v in self.fields if k in attnames]
+
     def append(self, actions):
         if not isinstance(actions, list):
             actions = [actions]
@@ -132,7 +245,7 @@ class Trigger(object):
             self.actions.append(action)
 
     def name(self):
-        return "_".join([
+        name = "_".join([
             "denorm",
             self.time,
             "row",
@@ -140,6 +253,17 @@ class Trigger(object):
             "on",
             self.db_table
         ])
+        if self.narrowed:
+            columns = ",".join(sorted(field for field, native_type in self.fields))
+            name += "_of_%s" % hashlib.md5(columns.encode('utf-8')).hexdigest()[:8]
+        return name
+
+    def db_name(self):
+        """
+        Returns the name of the trigger in the database, shortened to fit
+        the backends limit on identifiers.
+        """
+        return self.name()
 
     def sql(self):
         raise NotImplementedError
@@ -157,19 +281,252 @@ class TriggerSet(object):
     def cursor(self):
         return self.connection.cursor()
 
-    def append(self, triggers):
+    def append(self, triggers, denorm=None):
+        """
+        Adds ``triggers``, merging the actions of triggers of the same name.
+        ``denorm`` is the denorm the triggers belong to, if any.
+        """
         if not isinstance(triggers, list):
             triggers = [triggers]
 
         for trigger in triggers:
+            if denorm is not None:
+                trigger.denorms.add(denorm)
             name = trigger.name()
             if name in self.triggers:
                 self.triggers[name].append(trigger.actions)
+                self.triggers[name].denorms.update(trigger.denorms)
             else:
                 self.triggers[name] = trigger
 
-    def install(self):
+    def desired(self):
+        """
+        Returns a dict mapping the database name of every trigger in the set
+        to its table, SQL, parameters, a checksum of SQL and parameters and
+        the denorms depending on it.
+        """
+        desired = {}
+        for trigger in self.triggers.values():
+            sql, params = trigger.sql()
+            params = tuple(params)
+            desired[trigger.db_name()] = (trigger.db_table, sql, params, self.checksum(sql, params), trigger.denorms)
+        return desired
+
+    def checksum(self, sql, params):
+        return hashlib.md5(repr((sql, tuple(params))).encode('utf-8')).hexdigest()
+
+    def db_name(self, name):
+        """
+        Returns the name a trigger called ``name`` has in the database,
+        see ``Trigger.db_name``.
+        """
+        return name
+
+    def installed(self):
+        """
+        Returns a dict mapping the names of all denorm triggers in the
+        database to their tables.
+        """
         raise NotImplementedError
 
-    def drop(self):
+    def definitions(self):
+        """
+        Returns a dict mapping the names of all denorm triggers in the
+        database to their definition as the database reports it.
+        """
+        return {}
+
+    def diff(self, desired=None, installed=None):
+        """
+        Compares the set with the triggers in the database. Returns the names
+        of the triggers that have to be created, replaced and dropped.
+        Triggers that aren't recorded with the same checksum in the
+        ``InstalledTrigger`` table are replaced, and so are triggers whose
+        definition in the database changed since they were installed, e.g.
+        because they were replaced by hand.
+        """
+        from ..models import InstalledTrigger
+
+        if desired is None:
+            desired = self.desired()
+        if installed is None:
+            installed = self.installed()
+        recorded = dict(
+            (name, (checksum, definition)) for name, checksum, definition in
+            InstalledTrigger.objects.using(self.connection.alias).values_list('name', 'checksum', 'definition')
+        )
+        definitions = self.definitions()
+
+        def changed(name):
+            checksum, definition = recorded.get(name, (None, ''))
+            if checksum != desired[name][3]:
+                return True
+            # triggers installed before their definitions were recorded
+            # are only compared by their checksum
+            return bool(definition) and self.checksum(definitions.get(name), ()) != definition
+
+        create = sorted(name for name in desired if name not in installed)
+        replace = sorted(name for name in desired if name in installed and changed(name))
+        drop = sorted(name for name in installed if name not in desired)
+        return create, replace, drop
+
+    def drop_trigger(self, cursor, name, table):
+        """
+        Drops a single trigger.
+        """
         raise NotImplementedError
+
+    def prepare(self, cursor):
+        """
+        Creates whatever the triggers need besides themselves.
+        """
+        pass
+
+    def apply(self, cursor, desired, installed, create, replace, drop):
+        """
+        Drops, replaces and creates the named triggers (see ``diff``) and
+        records them in the ``InstalledTrigger`` table, together with a
+        checksum of their definition in the database.
+        """
+        from ..models import InstalledTrigger
+
+        catalog = InstalledTrigger.objects.using(self.connection.alias)
+        for name in drop:
+            self.drop_trigger(cursor, name, installed[name])
+            catalog.filter(name=name).delete()
+        for name in create + replace:
+            table, sql, params, checksum = desired[name][:4]
+            if name in replace:
+                replace_sql = self.replace_sql(sql)
+                if replace_sql:
+                    sql = replace_sql
+                else:
+                    self.drop_trigger(cursor, name, installed[name])
+            cursor.execute(sql, params)
+        definitions = self.definitions() if create or replace else {}
+        for name in create + replace:
+            table, sql, params, checksum = desired[name][:4]
+            definition = self.checksum(definitions[name], ()) if name in definitions else ''
+            catalog.update_or_create(name=name, defaults={'table': table, 'checksum': checksum, 'definition': definition})
+
+    def install_atomic(self):
+        from ..models import InstalledTrigger
+
+        cursor = self.cursor()
+        self.prepare(cursor)
+        desired = self.desired()
+        installed = self.installed()
+        self.apply(cursor, desired, installed, *self.diff(desired, installed))
+        InstalledTrigger.objects.using(self.connection.alias).exclude(name__in=list(desired)).delete()
+
+    def replace_sql(self, sql):
+        """
+        Returns ``sql`` changed to replace an existing trigger of the same
+        name, or None if the database can't replace triggers in place.
+        """
+        return None
+
+    def lock_timeout_sql(self, lock_timeout):
+        """
+        Returns SQL limiting the time the following statements of the
+        transaction wait for locks to ``lock_timeout`` milliseconds, or None.
+        """
+        return None
+
+    def restore_lock_timeout_sql(self):
+        """
+        Returns SQL restoring the current lock timeout of the session, or
+        None if ``lock_timeout_sql`` only lasts for the transaction.
+        """
+        return None
+
+    def install_online(self, lock_timeout=1000, retries=5, backoff=1.0, progress=None):
+        """
+        Like ``install``, but changes the triggers one table at a time, each
+        in a short transaction of its own. Every transaction waits at most
+        ``lock_timeout`` milliseconds for its table lock, so long running
+        queries don't queue up all writers behind it. Failed attempts are
+        retried ``retries`` times, waiting ``backoff`` seconds doubling after
+        every attempt. ``progress`` is called with the table, the number of
+        tables done and the total number of tables after each table.
+
+        Returns the denorms whose values may have drifted while their
+        triggers were missing or being replaced.
+        """
+        from ..models import InstalledTrigger
+
+        self.prepare(self.cursor())
+        desired = self.desired()
+        installed = self.installed()
+        create, replace, drop = self.diff(desired, installed)
+
+        tables = {}
+        for name in create + replace:
+            tables.setdefault(desired[name][0], []).append(name)
+        for name in drop:
+            tables.setdefault(installed[name], []).append(name)
+
+        stale = set()
+        restore_sql = self.restore_lock_timeout_sql()
+        try:
+            for i, table in enumerate(sorted(tables)):
+                for attempt in range(retries + 1):
+                    try:
+                        with transaction.atomic(using=self.connection.alias):
+                            cursor = self.cursor()
+                            timeout_sql = self.lock_timeout_sql(lock_timeout)
+                            if timeout_sql:
+                                cursor.execute(timeout_sql)
+                            names = tables[table]
+                            self.apply(
+                                cursor, desired, installed,
+                                [name for name in create if name in names],
+                                [name for name in replace if name in names],
+                                [name for name in drop if name in names],
+                            )
+                        break
+                    except DatabaseError:
+                        if attempt == retries:
+                            raise
+                        time.sleep(backoff * 2 ** attempt)
+
+                for name in tables[table]:
+                    if name in create or (name in replace and not self.connection.features.can_rollback_ddl):
+                        # writes weren't tracked before the trigger was created
+                        stale.update(desired[name][4])
+                if progress:
+                    progress(table, i + 1, len(tables))
+        finally:
+            if restore_sql:
+                self.cursor().execute(restore_sql)
+
+        InstalledTrigger.objects.using(self.connection.alias).exclude(name__in=list(desired)).delete()
+        return stale
+
+    def drop_atomic(self):
+        from ..models import InstalledTrigger
+
+        cursor = self.cursor()
+        for name, table in self.installed().items():
+            self.drop_trigger(cursor, name, table)
+        InstalledTrigger.objects.using(self.connection.alias).all().delete()
+
+    def install(self):
+        """
+        Creates the triggers of the set that are missing or changed and
+        drops the denorm triggers that are no longer part of it.
+        """
+        try:
+            with transaction.atomic(using=self.connection.alias):
+                self.install_atomic()
+        except AttributeError:
+            self.install_atomic()
+            transaction.commit_unless_managed(using=self.using)
+
+    def drop(self):
+        try:
+            with transaction.atomic(using=self.connection.alias):
+                self.drop_atomic()
+        except AttributeError:
+            self.drop_atomic()
+            transaction.commit_unless_managed(using=self.using)
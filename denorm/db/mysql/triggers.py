@@ -1,6 +1,19 @@
-import random
-import string
+import math
+
 from denorm.db import base
+from django.db.backends.utils import truncate_name
+
+# User variables last for the session and are not reset by a rollback, so
+# the bypass tokens are kept in a table, created by the denorm migrations.
+# Rows are only visible to the transaction adding them.
+BYPASS_TABLE = 'denorm_bypass'
+CREATE_BYPASS_TABLE = (
+    'CREATE TABLE IF NOT EXISTS %s ('
+    'id CHAR(32) NOT NULL PRIMARY KEY, '
+    'token VARCHAR(255) NOT NULL, '
+    'KEY denorm_bypass_token (token)'
+    ') ENGINE=InnoDB' % BYPASS_TABLE
+)
 
 
 class RandomBigInt(base.RandomBigInt):
@@ -23,14 +36,22 @@ class TriggerActionInsert(base.TriggerActionInsert):
         table = self.model._meta.db_table
         columns = "(" + ", ".join(self.columns) + ")"
         params = []
-        if isinstance(self.values, TriggerNestedSelect):
+        if isinstance(self.values, base.TriggerNestedSelect):
             sql, nested_params = self.values.sql()
             values = "(" + sql + ")"
             params.extend(nested_params)
         else:
             values = "VALUES (" + ", ".join(self.values) + ")"
 
-        return 'INSERT IGNORE INTO %(table)s %(columns)s %(values)s' % locals(), tuple()
+        sql = 'INSERT INTO %(table)s %(columns)s %(values)s ON DUPLICATE KEY UPDATE claim = NULL' % locals()
+        if self.bypass:
+            any_row, row, key = self.bypass_tokens()
+            sql = (
+                "IF NOT EXISTS (SELECT 1 FROM %s WHERE token IN (%s, CONCAT(%s, %s))) THEN\n"
+                "    %s;\n"
+                "END IF"
+            ) % (BYPASS_TABLE, any_row, row, key, sql)
+        return sql, tuple(params)
 
 
 class TriggerActionUpdate(base.TriggerActionUpdate):
@@ -46,17 +67,26 @@ class TriggerActionUpdate(base.TriggerActionUpdate):
         return 'UPDATE %(table)s SET %(updates)s WHERE %(where)s' % locals(), tuple(where_params)
 
 
+class TriggerBypass(base.TriggerBypass):
+    table = BYPASS_TABLE
+    table_sql = CREATE_BYPASS_TABLE
+
+    def enable_sql(self):
+        return 'INSERT INTO %s (id, token) VALUES (%%s, %%s)' % BYPASS_TABLE, (self.id, self.token)
+
+    def disable_sql(self):
+        return 'DELETE FROM %s WHERE id = %%s' % BYPASS_TABLE, (self.id,)
+
+
 class Trigger(base.Trigger):
 
+    def db_name(self):
+        return truncate_name(self.name(), self.connection.ops.max_name_length())
+
     def sql(self):
         qn = self.connection.ops.quote_name
 
-        name = self.name()
-        if len(name) > 50:
-            name = name[:45] + ''.join(
-                random.choice(string.ascii_uppercase + string.digits)
-                for x in range(5)
-            )
+        name = self.db_name()
         params = []
         action_list = []
         actions_added = set()
@@ -107,20 +137,44 @@ CREATE TRIGGER %(name)s
 
 
 class TriggerSet(base.TriggerSet):
-    def drop(self):
-        qn = self.connection.ops.quote_name
+    def installed(self):
         cursor = self.cursor()
-
         # FIXME: according to MySQL docs the LIKE statement should work
         # but it doesn't. MySQL reports a Syntax Error
         #cursor.execute(r"SHOW TRIGGERS WHERE Trigger LIKE 'denorm_%%'")
         cursor.execute('SHOW TRIGGERS')
-        for result in cursor.fetchall():
-            if result[0].startswith('denorm_'):
-                cursor.execute('DROP TRIGGER %s;' % qn(result[0]))
+        return dict((result[0], result[2]) for result in cursor.fetchall() if result[0].startswith('denorm_'))
 
-    def install(self):
+    def definitions(self):
         cursor = self.cursor()
-        for name, trigger in self.triggers.items():
-            sql, args = trigger.sql()
-            cursor.execute(sql, args)
+        cursor.execute('SHOW TRIGGERS')
+        # timing, event, table and statement
+        return dict(
+            (result[0], ' '.join([result[4], result[1], result[2], result[3]]))
+            for result in cursor.fetchall() if result[0].startswith('denorm_')
+        )
+
+    def drop_trigger(self, cursor, name, table):
+        cursor.execute('DROP TRIGGER %s;' % self.connection.ops.quote_name(name))
+
+    def db_name(self, name):
+        return truncate_name(name, self.connection.ops.max_name_length())
+
+    def prepare(self, cursor):
+        cursor.execute(CREATE_BYPASS_TABLE)
+
+    def lock_timeout_sql(self, lock_timeout):
+        # lock_wait_timeout is set in seconds and lasts for the session
+        return "SET SESSION lock_wait_timeout = %d" % max(1, int(math.ceil(lock_timeout / 1000.0)))
+
+    def restore_lock_timeout_sql(self):
+        cursor = self.cursor()
+        cursor.execute('SELECT @@SESSION.lock_wait_timeout')
+        return "SET SESSION lock_wait_timeout = %d" % cursor.fetchone()[0]
+
+    def install(self):
+        # MySQL commits implicitly after every statement changing triggers
+        self.install_atomic()
+
+    def drop(self):
+        self.drop_atomic()
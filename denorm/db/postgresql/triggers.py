@@ -1,7 +1,22 @@
-from django.db import transaction
+import re
+
+from django.conf import settings
 from denorm.db import base
 from django.db.backends.utils import truncate_name
 
+# names of the transition tables of statement level triggers
+NEW_TABLE = 'denorm_new'
+OLD_TABLE = 'denorm_old'
+
+
+def transition_sql(sql):
+    """
+    Makes SQL written for a row level trigger read the columns of the
+    transition tables instead of the NEW and OLD records.
+    """
+    sql = re.sub(r'\bNEW\.', NEW_TABLE + '.', sql)
+    return re.sub(r'\bOLD\.', OLD_TABLE + '.', sql)
+
 
 class RandomBigInt(base.RandomBigInt):
     def sql(self):
@@ -16,6 +31,20 @@ class TriggerNestedSelect(base.TriggerNestedSelect):
         where = ", ".join(["%s = %s" % (k, v) for k, v in self.kwargs.items()])
         return 'SELECT DISTINCT %(columns)s FROM %(table)s WHERE %(where)s' % locals(), tuple()
 
+    def statement_sql(self, source, condition):
+        """
+        Returns the select for all rows in ``source`` (the transition
+        tables of a statement level trigger) matching ``condition``.
+        """
+        table = self.table
+        # the transition tables may have columns of the same name
+        columns = ", ".join([
+            column if column.isdigit() else "%s.%s" % (table, column)
+            for column in self.column_list
+        ])
+        join = " AND ".join(["%s.%s = %s" % (table, k, transition_sql(v)) for k, v in self.kwargs.items()])
+        return 'SELECT DISTINCT %(columns)s FROM %(source)s JOIN %(table)s ON (%(join)s) WHERE %(condition)s' % locals(), tuple()
+
 
 class TriggerActionInsert(base.TriggerActionInsert):
 
@@ -23,22 +52,58 @@ class TriggerActionInsert(base.TriggerActionInsert):
         table = self.model._meta.db_table
         columns = "(" + ", ".join(self.columns) + ")"
         params = []
-        if isinstance(self.values, TriggerNestedSelect):
+        if isinstance(self.values, base.TriggerNestedSelect):
             sql, nested_params = self.values.sql()
             values = "(" + sql + ")"
             params.extend(nested_params)
         else:
             values = "VALUES (" + ", ".join(self.values) + ")"
 
+        keys = ", ".join(self.columns)
         sql = (
-            'BEGIN\n'
-            '    INSERT INTO %(table)s %(columns)s %(values)s;\n'
-            'EXCEPTION WHEN unique_violation THEN\n'
-            '    -- do nothing\n'
-            'END'
+            'INSERT INTO %(table)s %(columns)s %(values)s\n'
+            'ON CONFLICT (%(keys)s) DO UPDATE SET claim = NULL WHERE %(table)s.claim IS NOT NULL'
         ) % locals()
+        if self.bypass:
+            any_row, row, key = self.bypass_tokens()
+            sql = (
+                "IF COALESCE(current_setting('denorm.bypass', true), '') NOT IN (%s, %s || %s) THEN\n"
+                "    %s;\n"
+                "END IF"
+            ) % (any_row, row, key, sql.replace('\n', '\n    '))
         return sql, params
 
+    def statement_sql(self, source, condition):
+        """
+        Inserts the markers for all rows in ``source`` (the transition
+        tables of a statement level trigger) matching ``condition`` with
+        a single statement.
+        """
+        table = self.model._meta.db_table
+        columns = "(" + ", ".join(self.columns) + ")"
+        keys = ", ".join(self.columns)
+        if self.bypass:
+            any_row, row, key = self.bypass_tokens()
+            condition = "(%s) AND COALESCE(current_setting('denorm.bypass', true), '') NOT IN (%s, %s || %s)" % (
+                condition, any_row, row, transition_sql(key))
+        if isinstance(self.values, TriggerNestedSelect):
+            values, params = self.values.statement_sql(source, condition)
+        else:
+            values = [transition_sql(value) for value in self.values]
+            # skips the missing side of rows whose primary key changed
+            condition = " AND ".join(["(%s)" % condition] + [
+                "%s IS NOT NULL" % value
+                for value, row_value in zip(values, self.values) if value != row_value
+            ])
+            values = "SELECT DISTINCT %s FROM %s WHERE %s" % (", ".join(values), source, condition)
+            params = ()
+
+        sql = (
+            'INSERT INTO %(table)s %(columns)s %(values)s\n'
+            'ON CONFLICT (%(keys)s) DO UPDATE SET claim = NULL WHERE %(table)s.claim IS NOT NULL'
+        ) % locals()
+        return sql, list(params)
+
 
 class TriggerActionUpdate(base.TriggerActionUpdate):
 
@@ -53,6 +118,47 @@ class TriggerActionUpdate(base.TriggerActionUpdate):
         params.extend(where_params)
         return 'UPDATE %(table)s SET %(updates)s WHERE %(where)s' % locals(), params
 
+    def statement_sql(self, source, condition):
+        """
+        Applies the sum of the ``deltas`` of all rows in ``source`` (the
+        transition tables of a statement level trigger) matching
+        ``condition`` with a single UPDATE. Returns None if the update
+        can't be combined.
+        """
+        if not self.deltas or None in self.deltas:
+            return None
+        table = self.model._meta.db_table
+        if isinstance(self.where, tuple):
+            where, where_params = self.where
+        else:
+            where, where_params = self.where, []
+        where = "(%s) AND (%s)" % (condition, transition_sql(where))
+        updates = ", ".join([
+            "%s = %s + (SELECT COALESCE(SUM(%s), 0) FROM %s WHERE %s)" % (k, k, transition_sql(delta), source, where)
+            for k, delta in zip(self.columns, self.deltas)
+        ])
+        params = list(where_params) * (len(self.columns) + 1)
+        return 'UPDATE %(table)s SET %(updates)s WHERE EXISTS (SELECT 1 FROM %(source)s WHERE %(where)s)' % locals(), params
+
+
+class TriggerBypass(base.TriggerBypass):
+    # the setting holds a single token, a nested bypass (e.g. a save() run
+    # by a flush) restores the one of the enclosing bypass when it ends
+    previous = ''
+
+    def __enter__(self):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT current_setting('denorm.bypass', true)")
+        self.previous = cursor.fetchone()[0] or ''
+        return super(TriggerBypass, self).__enter__()
+
+    def enable_sql(self):
+        # outside of transactions the setting has to last for the session
+        return "SELECT set_config('denorm.bypass', %s, %s)", (self.token, self.connection.in_atomic_block)
+
+    def disable_sql(self):
+        return "SELECT set_config('denorm.bypass', %s, %s)", (self.previous, self.connection.in_atomic_block)
+
 
 class Trigger(base.Trigger):
     def name(self):
@@ -61,10 +167,14 @@ class Trigger(base.Trigger):
             name += "_%s" % self.content_type
         return name
 
+    def db_name(self):
+        # leaves room for the "func_" prefix of the function
+        return truncate_name(self.name(), self.connection.ops.max_name_length() - 5)
+
     def sql(self):
         qn = self.connection.ops.quote_name
 
-        name = truncate_name(self.name(), self.connection.ops.max_name_length() - 5)
+        name = self.db_name()
         params = []
         action_list = []
         actions_added = set()
@@ -102,21 +212,94 @@ class Trigger(base.Trigger):
         if ct_field:
             ct_field = qn(ct_field)
             if event == "UPDATE":
-                conditions.append("(OLD.%(ctf)s = %(ct)s) OR (NEW.%(ctf)s = %(ct)s)" % {'ctf': ct_field, 'ct': content_type})
+                conditions.append("((OLD.%(ctf)s = %(ct)s) OR (NEW.%(ctf)s = %(ct)s))" % {'ctf': ct_field, 'ct': content_type})
             elif event == "INSERT":
                 conditions.append("(NEW.%s = %s)" % (ct_field, content_type))
             elif event == "DELETE":
                 conditions.append("(OLD.%s = %s)" % (ct_field, content_type))
 
+        # transition tables need PostgreSQL 10, older servers keep the row
+        # level triggers
+        if getattr(settings, 'DENORM_STATEMENT_TRIGGERS', False) and self.connection.pg_version >= 100000:
+            statement = self.statement_sql(conditions)
+            if statement:
+                return statement
+
+        # The conditions are checked by the executor before calling the
+        # function, so it isn't called at all for irrelevant changes.
+        when = ""
         if conditions:
-            cond = " AND ".join(conditions)
-            actions = "\n            ".join(action_list)
-            actions = """IF %(cond)s THEN
-            %(actions)s
-        END IF;""" % locals()
+            when = "WHEN (%s) " % " AND ".join(conditions)
+        actions = "\n        ".join(action_list)
+
+        if event == "UPDATE" and self.narrowed:
+            # don't even run the trigger for updates of other columns
+            event = "UPDATE OF %s" % ", ".join(qn(field) for field, native_type in self.fields)
+
+        sql = """
+CREATE OR REPLACE FUNCTION func_%(name)s()
+    RETURNS TRIGGER AS $$
+    BEGIN
+        %(actions)s
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER %(name)s
+    %(time)s %(event)s ON %(table)s
+    FOR EACH ROW %(when)sEXECUTE PROCEDURE func_%(name)s();
+""" % locals()
+        return sql, params
+
+    def statement_sql(self, conditions):
+        """
+        Returns the SQL for a statement level trigger, that handles all rows
+        changed by a statement at once using transition tables, or None if
+        some action can only be run for each row.
+        """
+        time = self.time.upper()
+        event = self.event.upper()
+        if time != "AFTER":
+            return None
+        if event == "INSERT":
+            source = NEW_TABLE
+            referencing = "NEW TABLE AS %s" % NEW_TABLE
+        elif event == "DELETE":
+            source = OLD_TABLE
+            referencing = "OLD TABLE AS %s" % OLD_TABLE
+        elif self.pk_column:
+            qn = self.connection.ops.quote_name
+            pk = qn(self.pk_column)
+            # a row whose primary key changed has no partner and is handled
+            # like a deleted old row and an inserted new row, its columns
+            # of the other side are NULL
+            source = "%s FULL JOIN %s ON (%s.%s = %s.%s)" % (OLD_TABLE, NEW_TABLE, OLD_TABLE, pk, NEW_TABLE, pk)
+            referencing = "OLD TABLE AS %s NEW TABLE AS %s" % (OLD_TABLE, NEW_TABLE)
         else:
-            actions = "\n        ".join(action_list)
+            return None
+        condition = transition_sql(" AND ".join(conditions) or "TRUE")
 
+        params = []
+        action_list = []
+        actions_added = set()
+        for a in self.actions:
+            statement_sql = getattr(a, 'statement_sql', None)
+            if statement_sql is None:
+                return None
+            action = statement_sql(source, condition)
+            if action is None:
+                return None
+            sql, action_params = action
+            if not sql.endswith(';'):
+                sql += ';'
+            action_params = tuple(action_params)
+            if (sql, action_params) not in actions_added:
+                actions_added.add((sql, action_params))
+                action_list.extend(sql.split('\n'))
+                params.extend(action_params)
+
+        name = self.db_name()
+        table = self.db_table
+        actions = "\n        ".join(action_list)
         sql = """
 CREATE OR REPLACE FUNCTION func_%(name)s()
     RETURNS TRIGGER AS $$
@@ -127,40 +310,44 @@ CREATE OR REPLACE FUNCTION func_%(name)s()
 $$ LANGUAGE plpgsql;
 CREATE TRIGGER %(name)s
     %(time)s %(event)s ON %(table)s
-    FOR EACH ROW EXECUTE PROCEDURE func_%(name)s();
+    REFERENCING %(referencing)s
+    FOR EACH STATEMENT EXECUTE PROCEDURE func_%(name)s();
 """ % locals()
         return sql, params
 
 
 class TriggerSet(base.TriggerSet):
-    def drop_atomic(self):
-        qn = self.connection.ops.quote_name
+    def installed(self):
         cursor = self.cursor()
-        cursor.execute("SELECT pg_class.relname, pg_trigger.tgname FROM pg_trigger LEFT JOIN pg_class ON (pg_trigger.tgrelid = pg_class.oid) WHERE pg_trigger.tgname LIKE 'denorm_%%';")
-        for table_name, trigger_name in cursor.fetchall():
-            cursor.execute('DROP TRIGGER %s ON %s;' % (qn(trigger_name), qn(table_name)))
-
-    def drop(self):
-        try:
-            with transaction.atomic():
-                self.drop_atomic()
-        except AttributeError:
-            self.drop_atomic()
-            transaction.commit_unless_managed(using=self.using)
-
-    def install_atomic(self):
+        cursor.execute("SELECT pg_trigger.tgname, pg_class.relname FROM pg_trigger LEFT JOIN pg_class ON (pg_trigger.tgrelid = pg_class.oid) WHERE pg_trigger.tgname LIKE 'denorm_%%';")
+        return dict(cursor.fetchall())
+
+    def definitions(self):
         cursor = self.cursor()
+        # the trigger and the source of its function
+        cursor.execute(
+            "SELECT pg_trigger.tgname, pg_get_triggerdef(pg_trigger.oid) || ';' || pg_proc.prosrc "
+            "FROM pg_trigger JOIN pg_proc ON (pg_trigger.tgfoid = pg_proc.oid) WHERE pg_trigger.tgname LIKE 'denorm_%%';")
+        return dict(cursor.fetchall())
+
+    def drop_trigger(self, cursor, name, table):
+        qn = self.connection.ops.quote_name
+        cursor.execute('DROP TRIGGER %s ON %s;' % (qn(name), qn(table)))
+        cursor.execute('DROP FUNCTION IF EXISTS %s();' % qn('func_%s' % name))
+
+    def replace_sql(self, sql):
+        # CREATE OR REPLACE TRIGGER is supported since PostgreSQL 14
+        if self.connection.pg_version >= 140000:
+            return sql.replace("CREATE TRIGGER", "CREATE OR REPLACE TRIGGER", 1)
+        return None
+
+    def lock_timeout_sql(self, lock_timeout):
+        return "SET LOCAL lock_timeout = %d" % lock_timeout
+
+    def db_name(self, name):
+        return truncate_name(name, self.connection.ops.max_name_length() - 5)
+
+    def prepare(self, cursor):
         cursor.execute("SELECT lanname FROM pg_catalog.pg_language WHERE lanname ='plpgsql'")
         if not cursor.fetchall():
             cursor.execute('CREATE LANGUAGE plpgsql')
-        for name, trigger in self.triggers.items():
-            sql, args = trigger.sql()
-            cursor.execute(sql, args)
-
-    def install(self):
-        try:
-            with transaction.atomic():
-                self.install_atomic()
-        except AttributeError:
-            self.install_atomic()
-            transaction.commit_unless_managed(using=self.using)
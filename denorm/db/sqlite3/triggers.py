@@ -1,4 +1,3 @@
-from django.db import transaction
 from denorm.db import base
 
 import logging
@@ -6,6 +5,12 @@ import logging
 
 logger = logging.getLogger('denorm-sqlite')
 
+# Triggers can't access temporary tables, so the bypass tokens are kept
+# in a regular table, created by the denorm migrations. Rows are only
+# visible to the transaction adding them.
+BYPASS_TABLE = 'denorm_bypass'
+CREATE_BYPASS_TABLE = 'CREATE TABLE IF NOT EXISTS %s (id TEXT PRIMARY KEY, token TEXT)' % BYPASS_TABLE
+
 
 class RandomBigInt(base.RandomBigInt):
     def sql(self):
@@ -23,17 +28,30 @@ class TriggerNestedSelect(base.TriggerNestedSelect):
 
 class TriggerActionInsert(base.TriggerActionInsert):
 
-    def sql(self):
+    def statements(self):
         table = self.model._meta.db_table
         columns = "(" + ", ".join(self.columns) + ")"
-        if isinstance(self.values, TriggerNestedSelect):
-            sql, params = self.values.sql()
-            values = "" + sql + ""
+        keys = ", ".join(self.columns)
+        if isinstance(self.values, base.TriggerNestedSelect):
+            values, params = self.values.sql()
+            params = tuple(params)
         else:
-            values = "VALUES(" + ", ".join(self.values) + ")"
-            params = []
+            values = "SELECT " + ", ".join(self.values)
+            params = ()
+        if self.bypass:
+            # sqlite has no session variables, see TriggerBypass
+            any_row, row, key = self.bypass_tokens()
+            values = "SELECT * FROM (%s) WHERE NOT EXISTS (SELECT 1 FROM %s WHERE token IN (%s, %s || %s))" % (
+                values, BYPASS_TABLE, any_row, row, key)
+
+        return [
+            ('UPDATE %(table)s SET claim = NULL WHERE claim IS NOT NULL AND (%(keys)s) IN (%(values)s)' % locals(), params),
+            ('INSERT OR IGNORE INTO %(table)s %(columns)s %(values)s' % locals(), params),
+        ]
 
-        return 'INSERT OR REPLACE INTO %(table)s %(columns)s %(values)s' % locals(), tuple(params)
+    def sql(self):
+        (update, params), (insert, params) = self.statements()
+        return update + ';\n' + insert, params + params
 
 
 class TriggerActionUpdate(base.TriggerActionUpdate):
@@ -49,6 +67,17 @@ class TriggerActionUpdate(base.TriggerActionUpdate):
         return 'UPDATE %(table)s SET %(updates)s WHERE %(where)s' % locals(), where_params
 
 
+class TriggerBypass(base.TriggerBypass):
+    table = BYPASS_TABLE
+    table_sql = CREATE_BYPASS_TABLE
+
+    def enable_sql(self):
+        return 'INSERT INTO %s (id, token) VALUES (%%s, %%s)' % BYPASS_TABLE, (self.id, self.token)
+
+    def disable_sql(self):
+        return 'DELETE FROM %s WHERE id = %%s' % BYPASS_TABLE, (self.id,)
+
+
 class Trigger(base.Trigger):
 
     def name(self):
@@ -107,33 +136,18 @@ CREATE TRIGGER %(name)s
 
 
 class TriggerSet(base.TriggerSet):
-    def drop_atomic(self):
-        qn = self.connection.ops.quote_name
+    def installed(self):
         cursor = self.cursor()
-
         cursor.execute("SELECT name, tbl_name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'denorm_%%';")
-        for trigger_name, table_name in cursor.fetchall():
-            cursor.execute("DROP TRIGGER %s;" % (qn(trigger_name),))
-
-    def drop(self):
-        try:
-            with transaction.atomic():
-                self.drop_atomic()
-        except AttributeError:
-            self.drop_atomic()
-            transaction.commit_unless_managed(using=self.using)
-
-    def install_atomic(self):
+        return dict(cursor.fetchall())
+
+    def definitions(self):
         cursor = self.cursor()
+        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'denorm_%%';")
+        return dict(cursor.fetchall())
+
+    def drop_trigger(self, cursor, name, table):
+        cursor.execute("DROP TRIGGER %s;" % (self.connection.ops.quote_name(name),))
 
-        for name, trigger in self.triggers.items():
-            sql, args = trigger.sql()
-            cursor.execute(sql, args)
-
-    def install(self):
-        try:
-            with transaction.atomic():
-                self.install_atomic()
-        except AttributeError:
-            self.install_atomic()
-            transaction.commit_unless_managed(using=self.using)
+    def prepare(self, cursor):
+        cursor.execute(CREATE_BYPASS_TABLE)
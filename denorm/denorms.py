@@ -1,80 +1,86 @@
 # -*- coding: utf-8 -*-
 import abc
-
+import datetime
+import sys
+import traceback
+import uuid
+import zlib
+from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from django.apps import apps
+from django.conf import settings
 from django.contrib import contenttypes
-from django.db import connections, connection
-from django.apps import apps as gmodels
-from django.db.models import sql, ManyToManyField
-from django.db.models.aggregates import Sum
+from django.db import connections, connection, router, transaction
+from django.db.models import sql, ManyToManyField, Value
+from django.db.models.aggregates import Count, Sum
+from django.db.models.functions import Coalesce
 from django.db.models.manager import Manager
 from django.db.models.query_utils import Q
 from django.db.models.sql.compiler import SQLCompiler
 from django.db.models.sql.datastructures import Join
 from django.db.models.sql.query import Query
 from django.db.models.sql.where import WhereNode
+from django.utils import timezone
+from django.utils.encoding import force_bytes, force_text
 import django
 from decimal import Decimal
 
+try:
+    from django.db.models import OuterRef, Subquery
+except ImportError:  # Django<1.11
+    OuterRef = Subquery = None
+
+from .db import get_backend
+from .helpers import bulk_update, chunked, in_pk_range, model_label, pk_ranges, Throttle
+from .registry import registry
+from .shadow import rebuild_shadow, sync_shadows
+
 def many_to_many_pre_save(sender, instance, **kwargs):
     """
     Updates denormalised many-to-many fields for the model
     """
     if instance.pk:
         # Need a primary key to do m2m stuff
-        for m2m in sender._meta.local_many_to_many:
-            # This gets us all m2m fields, so limit it to just those that are denormed
-            if hasattr(m2m, 'denorm'):
-                # Does some extra jiggery-pokery for "through" m2m models.
-                # May not work under lots of conditions.
-                try:
-                    remote = m2m.remote_field  # Django>=1.10
-                except AttributeError:
-                    remote = m2m.rel
-                if hasattr(remote, 'through_model'):
-                    # Clear exisiting through records (bit heavy handed?)
-                    kwargs = {m2m.related.var_name: instance}
-
-                    # Can't use m2m_column_name in a filter
-                    # kwargs = { m2m.m2m_column_name(): instance.pk, }
-                    remote.through_model.objects.filter(**kwargs).delete()
-
-                    values = m2m.denorm.func(instance)
-                    for value in values:
-                        kwargs.update({m2m.m2m_reverse_name(): value.pk})
-                        remote.through_model.objects.create(**kwargs)
+        for m2m in registry.m2m_fields(sender):
+            # Does some extra jiggery-pokery for "through" m2m models.
+            # May not work under lots of conditions.
+            try:
+                remote = m2m.remote_field  # Django>=1.10
+            except AttributeError:
+                remote = m2m.rel
+            if hasattr(remote, 'through_model'):
+                # Clear exisiting through records (bit heavy handed?)
+                kwargs = {m2m.related.var_name: instance}
+
+                # Can't use m2m_column_name in a filter
+                # kwargs = { m2m.m2m_column_name(): instance.pk, }
+                remote.through_model.objects.filter(**kwargs).delete()
+
+                values = m2m.denorm.func(instance)
+                for value in values:
+                    kwargs.update({m2m.m2m_reverse_name(): value.pk})
+                    remote.through_model.objects.create(**kwargs)
 
-                else:
-                    values = m2m.denorm.func(instance)
-                    try:
-                        getattr(instance, m2m.attname).set(values)
-                    except AttributeError:  # Django<1.10
-                        setattr(instance, m2m.attname, values)
+            else:
+                values = m2m.denorm.func(instance)
+                try:
+                    getattr(instance, m2m.attname).set(values)
+                except AttributeError:  # Django<1.10
+                    setattr(instance, m2m.attname, values)
 
 
 def many_to_many_post_save(sender, instance, created, **kwargs):
-    if created:
-        def check_resave():
-            for m2m in sender._meta.local_many_to_many:
-                if hasattr(m2m, 'denorm'):
-                    return True
-            return False
-
-        if check_resave():
-            instance.save()
+    if created and registry.m2m_fields(sender):
+        instance.save()
 
 
 def get_alldenorms():
     """
     Get all denormalizations.
     """
-    alldenorms = []
-    for model in gmodels.get_models(include_auto_created=True):
-        if not model._meta.proxy:
-            for field in model._meta.fields:
-                if hasattr(field, 'denorm'):
-                    if not field.denorm.model._meta.swapped:
-                        alldenorms.append(field.denorm)
-    return alldenorms
+    return registry.all()
 
 
 class Denorm(object):
@@ -189,11 +195,15 @@ class CallbackDenorm(BaseCallbackDenorm):
         # In those cases the self_save_handler won't get called by the
         # pre_save signal, so we need to ensure flush() does this later.
         from .models import DirtyInstance
-        from .db import triggers
+        triggers = get_backend(using)
+        # flush() and ORM saves bypass this action, as they have
+        # just computed the denormalized values.
+        pk = "NEW.%s" % qn(self.model._meta.pk.get_attname_column()[1])
         action = triggers.TriggerActionInsert(
             model=DirtyInstance,
             columns=("content_type_id", "object_id"),
-            values=(content_type, "NEW.%s" % qn(self.model._meta.pk.get_attname_column()[1]))
+            values=(content_type, pk),
+            bypass=(content_type, pk),
         )
         trigger_list = [
             triggers.Trigger(self.model, "after", "update", [action], content_type, using, self.skip),
@@ -248,7 +258,7 @@ class CacheKeyDenorm(BaseCacheKeyDenorm):
         # using the ORM or if it was part of a bulk update.
         # In those cases the self_save_handler won't get called by the
         # pre_save signal
-        from .db import triggers
+        triggers = get_backend(using)
         action = triggers.TriggerActionUpdate(
             model=self.model,
             columns=(self.fieldname,),
@@ -320,6 +330,57 @@ class AggregateDenorm(Denorm):
         if not self.manager and hasattr(self.model, str(self.manager_name)):
             self.manager = getattr(self.model, self.manager_name)
 
+    def get_related_field(self):
+        """
+        Returns the ForeignKey or ManyToManyField of the aggregated relation.
+        """
+        try:  # Django>=1.9
+            return self.manager.field
+        except AttributeError:
+            return self.manager.related.field
+
+    def get_rebuild_aggregate(self):
+        """
+        Returns the aggregate computing the value from scratch over the
+        related instances, used by ``rebuild_queryset``.
+        """
+        return None
+
+    def get_rebuild_value(self):
+        """
+        Returns an expression computing the value of the field from scratch
+        with a subquery grouping the related instances, or None if the value
+        can't be computed in SQL (aggregates over many to many relations).
+        """
+        aggregate = self.get_rebuild_aggregate()
+        related_field = self.get_related_field()
+        if aggregate is None or Subquery is None or isinstance(related_field, ManyToManyField):
+            return None
+        related = (
+            related_field.model._base_manager
+            .filter(**{related_field.name: OuterRef(related_field.target_field.attname)})
+            .filter(**self.filter)
+            .exclude(**self.exclude)
+            .order_by()
+            .values(related_field.name)
+            .annotate(denorm_value=aggregate)
+            .values('denorm_value')
+        )
+        field = self.model._meta.get_field(self.fieldname)
+        return Coalesce(Subquery(related, output_field=field), Value(0), output_field=field)
+
+    def rebuild_queryset(self, queryset):
+        """
+        Recalculates the field of all instances in ``queryset`` with one
+        set based UPDATE, only writing the values that changed. Returns the
+        number of written rows, or None if the value can't be computed in
+        SQL (see ``get_rebuild_value``).
+        """
+        value = self.get_rebuild_value()
+        if value is None:
+            return None
+        return queryset.exclude(**{self.fieldname: value}).update(**{self.fieldname: value})
+
     def get_related_where(self, fk_name, using, type):
         qn = self.get_quote_name(using)
 
@@ -344,7 +405,7 @@ class AggregateDenorm(Denorm):
         """
         Returns triggers for m2m relation
         """
-        from .db import triggers
+        triggers = get_backend(using)
         related_inc_where, _ = self.get_related_where(fk_name, using, 'NEW')
         related_dec_where, related_where_params = self.get_related_where(fk_name, using, 'OLD')
         related_increment = triggers.TriggerActionUpdate(
@@ -369,7 +430,7 @@ class AggregateDenorm(Denorm):
         return trigger_list
 
     def get_triggers(self, using):
-        from .db import triggers
+        triggers = get_backend(using)
         if using:
             cconnection = connections[using]
         else:
@@ -390,11 +451,13 @@ class AggregateDenorm(Denorm):
                 'reverse_related': qn(fk_name),
             }]
             dec_where = [action.replace('NEW.', 'OLD.') for action in inc_where]
+            deltas = (None, None)
         else:
-            pk_name = qn(self.model._meta.pk.get_attname_column()[1])
+            pk_name = "%s.%s" % (qn(self.model._meta.db_table), qn(self.model._meta.pk.get_attname_column()[1]))
             fk_name = qn(related_field.attname)
             inc_where = ["%s = NEW.%s" % (pk_name, fk_name)]
             dec_where = ["%s = OLD.%s" % (pk_name, fk_name)]
+            deltas = ((self.get_increment_delta(using),), (self.get_decrement_delta(using),))
 
         content_type = str(contenttypes.models.ContentType.objects.get_for_model(self.model).pk)
 
@@ -424,12 +487,14 @@ class AggregateDenorm(Denorm):
             columns=(self.fieldname,),
             values=(self.get_increment_value(using),),
             where=(' AND '.join(inc_where), where_params),
+            deltas=deltas[0],
         )
         decrement = triggers.TriggerActionUpdate(
             model=self.model,
             columns=(self.fieldname,),
             values=(self.get_decrement_value(using),),
             where=(' AND '.join(dec_where), where_params),
+            deltas=deltas[1],
         )
 
         trigger_list = [
@@ -453,6 +518,20 @@ class AggregateDenorm(Denorm):
         Returns SQL for decrementing value
         """
 
+    def get_increment_delta(self, using):
+        """
+        Returns SQL for the value added by get_increment_value, or None
+        if the increment can't be expressed as a sum of deltas
+        """
+        return None
+
+    def get_decrement_delta(self, using):
+        """
+        Returns SQL for the value added by get_decrement_value, or None
+        if the decrement can't be expressed as a sum of deltas
+        """
+        return None
+
 
 class SumDenorm(AggregateDenorm):
     """
@@ -464,7 +543,10 @@ class SumDenorm(AggregateDenorm):
         # correctness of the incremental updates we create a function that
         # calculates it from scratch.
         self.sum_field = field
-        self.func = lambda obj: (getattr(obj, self.manager_name).filter(**self.filter).exclude(**self.exclude).aggregate(Sum(self.sum_field)).values()[0] or 0)
+        self.func = lambda obj: (getattr(obj, self.manager_name).filter(**self.filter).exclude(**self.exclude).aggregate(Sum(self.sum_field)).popitem()[1] or 0)
+
+    def get_rebuild_aggregate(self):
+        return Sum(self.sum_field)
 
     def get_increment_value(self, using):
         qn = self.get_quote_name(using)
@@ -476,6 +558,16 @@ class SumDenorm(AggregateDenorm):
 
         return "%s - OLD.%s" % (qn(self.fieldname), qn(self.sum_field))
 
+    def get_increment_delta(self, using):
+        qn = self.get_quote_name(using)
+
+        return "NEW.%s" % qn(self.sum_field)
+
+    def get_decrement_delta(self, using):
+        qn = self.get_quote_name(using)
+
+        return "-OLD.%s" % qn(self.sum_field)
+
     def get_related_increment_value(self, using):
         qn = self.get_quote_name(using)
 
@@ -516,6 +608,9 @@ class CountDenorm(AggregateDenorm):
         # calculates it from scratch.
         self.func = lambda obj: getattr(obj, self.manager_name).filter(**self.filter).exclude(**self.exclude).count()
 
+    def get_rebuild_aggregate(self):
+        return Count('pk')
+
     def get_increment_value(self, using):
         qn = self.get_quote_name(using)
 
@@ -526,6 +621,12 @@ class CountDenorm(AggregateDenorm):
 
         return "%s - 1" % qn(self.fieldname)
 
+    def get_increment_delta(self, using):
+        return "1"
+
+    def get_decrement_delta(self, using):
+        return "-1"
+
     def get_related_increment_value(self, using):
         return self.get_increment_value(using)
 
@@ -533,103 +634,1060 @@ class CountDenorm(AggregateDenorm):
         return self.get_decrement_value(using)
 
 
-def rebuildall(verbose=False, model_name=None, field_name=None):
+def rebuildall(verbose=False, model_name=None, field_name=None, chunk_size=None, direct=False, max_rows_per_sec=None,
+               workers=None, executor='process', shadow=False):
     """
     Updates all models containing denormalized fields.
     Used by the 'denormalize' management command.
+
+    Counts and sums are recalculated with set based UPDATEs (see
+    ``rebuild_aggregates``). For all other fields the instances are marked
+    dirty (see ``mark_all_dirty``, which also explains ``chunk_size``) and
+    flushed.
+
+    With ``direct`` the instances are rebuilt without going through the
+    dirty queue instead, in chunks of ``chunk_size`` (1000 by default) and
+    at most ``max_rows_per_sec`` instances per second, see
+    ``rebuild_model``. Models are rebuilt in dependency order.
+
+    ``workers`` and ``executor`` parallelize the rebuild of every model
+    (with ``direct``) and the flush, see ``rebuild_model`` and ``flush``.
+
+    With ``shadow`` the values of every model are computed into a shadow
+    table and swapped in at the end, so the columns only hold a mix of old
+    and new values during the swap, see ``denorm.shadow.rebuild_shadow``.
     """
-    from .models import DirtyInstance
     alldenorms = get_alldenorms()
-    models = {}
-    for denorm in alldenorms:
+    models = select_denorms(model_name, field_name)
+
+    if direct or shadow:
+        for model in dependency_order(models):
+            if shadow:
+                rebuild_shadow(
+                    model,
+                    denorms=models[model] if field_name else None,
+                    chunk_size=chunk_size or 1000,
+                    max_rows_per_sec=max_rows_per_sec,
+                    verbose=verbose,
+                )
+                continue
+            rebuild_model(
+                model,
+                denorms=models[model] if field_name else None,
+                chunk_size=chunk_size or 1000,
+                max_rows_per_sec=max_rows_per_sec,
+                verbose=verbose,
+                workers=workers,
+                executor=executor,
+            )
+    else:
+        i = 0
+        for model, denorms in models.items():
+            if verbose:
+                for denorm in denorms:
+                    msg = 'making dirty instances', '%s/%s' % (i + 1, len(alldenorms)), denorm.fieldname, 'in', denorm.model
+                    print(msg)
+                    i += 1
+            # aggregates are recalculated in SQL right away
+            aggregates = [denorm for denorm in denorms if rebuilds_in_sql(denorm)]
+            if aggregates:
+                rebuild_aggregates(model, aggregates, chunk_size=chunk_size)
+            # create DirtyInstance for all objects, so the rebuild is done during flush
+            if len(aggregates) < len(denorms):
+                mark_all_dirty(model, chunk_size=chunk_size)
+    flush(verbose, workers=workers, executor=executor)
+
+
+def select_denorms(model_name=None, field_name=None):
+    """
+    Returns a dict mapping every model to its denorms, limited to the
+    models matching ``model_name`` (an app label, model name or
+    ``app_label.ModelName``) and the fields named ``field_name``.
+    """
+    models = OrderedDict()
+    for denorm in get_alldenorms():
         current_app_label = denorm.model._meta.app_label
         current_model_name = denorm.model._meta.model.__name__
         current_app_model = '%s.%s' % (current_app_label, current_model_name)
         if model_name is None or model_name in (current_app_label, current_model_name, current_app_model):
             if field_name is None or field_name == denorm.fieldname:
                 models.setdefault(denorm.model, []).append(denorm)
+    return models
 
-    i = 0
-    for model, denorms in models.items():
-        if verbose:
-            for denorm in denorms:
-                msg = 'making dirty instances', '%s/%s' % (i + 1, len(alldenorms)), denorm.fieldname, 'in', denorm.model
-                print(msg)
-                i += 1
-        # create DirtyInstance for all objects, so the rebuild is done during flush
-        content_type = contenttypes.models.ContentType.objects.get_for_model(model)
-        for instance in model.objects.all():
-                DirtyInstance.objects.create(
-                    content_type=content_type,
-                    object_id=instance.pk,
-                )
-    flush(verbose)
+
+def rebuild_model(model, denorms=None, using=None, chunk_size=1000, max_rows_per_sec=None, verbose=False,
+                  workers=None, executor='process', sleep=None):
+    """
+    Recalculates ``denorms`` (all denormalized fields by default) of every
+    instance of ``model`` without going through the dirty queue.
+
+    The instances are walked in chunks of ``chunk_size`` primary keys, see
+    ``rebuild_range``. After every chunk a ``RebuildCheckpoint`` is saved.
+    An interrupted rebuild of the same fields continues after the last
+    completed chunk. ``max_rows_per_sec`` limits the rate of the rebuild,
+    e.g. to keep the replication lag low, and ``sleep`` pauses that many
+    seconds after every chunk.
+
+    With ``workers`` the chunks are rebuilt in parallel by a pool of
+    ``workers`` processes (or threads, if ``executor`` is ``'thread'``),
+    each with its own database connection. The checkpoint only advances
+    past chunks whose predecessors are all done. Errors are collected and
+    raised as one ``RebuildError`` at the end. On sqlite ``workers`` is
+    ignored, elsewhere a parallel rebuild can't run inside an atomic block.
+
+    Returns the number of rebuilt instances.
+    """
+    from .models import RebuildCheckpoint
+    using = using or router.db_for_write(model)
+
+    if denorms is None:
+        fieldnames = None
+        name = '%s.%s:*' % (model._meta.app_label, model._meta.model_name)
+    else:
+        fieldnames = sorted(denorm.fieldname for denorm in denorms)
+        name = '%s.%s:%s' % (model._meta.app_label, model._meta.model_name, ','.join(fieldnames))
+
+    checkpoints = RebuildCheckpoint.objects.using(using)
+    checkpoint = checkpoints.filter(name=name).first()
+    if checkpoint is not None:
+        lower = model._meta.pk.to_python(checkpoint.last_pk)
+        rows = checkpoint.rows
+    else:
+        lower = None
+        rows = 0
+
+    if connections[using].vendor == 'sqlite':
+        # sqlite allows only one writer at a time
+        workers = None
+    ranges = pk_ranges(model._base_manager.using(using), chunk_size, lower)
+    # the shadow rebuilds in progress are looked up once, see sync_shadows
+    shadows = {}
+    if workers:
+        # the bounds are looked up before the pool takes the connection away
+        ranges = list(ranges)
+        pool = get_pool(workers, executor)
+        tasks = [
+            (model_label(model), fieldnames, lower, upper, using, max_rows_per_sec and float(max_rows_per_sec) / workers, sleep, executor, shadows)
+            for lower, upper in ranges
+        ]
+        results = pool.imap(rebuild_partition, tasks)
+    else:
+        pool = None
+        throttle = Throttle(max_rows_per_sec, sleep)
+        rebuild_denorms = get_rebuild_denorms(model, fieldnames)
+
+        def rebuild_ranges():
+            for lower, upper in ranges:
+                count = rebuild_range(model, rebuild_denorms, lower, upper, using=using, m2m=fieldnames is None, shadows=shadows)
+                yield lower, upper, count, None
+                throttle.wait(count)
+        results = rebuild_ranges()
+
+    errors = []
+    try:
+        for lower, upper, count, error in results:
+            if error:
+                errors.append((model, lower, upper, error))
+                continue
+            rows += count
+            if upper is not None and not errors:
+                checkpoints.update_or_create(name=name, defaults={'last_pk': force_text(upper), 'rows': rows})
+            if verbose:
+                print('rebuilt', rows, 'instances of', model)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if errors:
+        raise RebuildError(errors)
+    checkpoints.filter(name=name).delete()
+    return rows
+
+
+def get_rebuild_denorms(model, fieldnames=None):
+    """
+    Returns the denorms of ``model`` recalculated by a rebuild of the
+    fields ``fieldnames``, or of all fields but the cache keys if None.
+    Cache keys are renewed anyway if something changed.
+    """
+    denorms = registry.for_model(model)
+    if fieldnames is None:
+        return [denorm for denorm in denorms if not isinstance(denorm, BaseCacheKeyDenorm)]
+    return [denorm for denorm in denorms if denorm.fieldname in fieldnames]
+
+
+def rebuild_range(model, denorms, lower=None, upper=None, using=None, m2m=False, shadows=None):
+    """
+    Recalculates ``denorms`` of the instances of ``model`` in the primary
+    key range ``(lower, upper]`` in one transaction and returns their
+    number.
+
+    Only the values that changed are written back, with one bulk UPDATE
+    per set of changed fields. Counts and sums are recalculated with one
+    set based UPDATE each instead (see ``AggregateDenorm.rebuild_queryset``).
+    The writes don't mark the instances dirty again, but instances of
+    other models depending on them are marked dirty as usual.
+
+    The denormalized ManyToManyFields are recalculated as well if ``m2m``
+    is set. ``shadows`` caches the shadow rebuilds in progress, see
+    ``sync_shadows``.
+    """
+    using = using or router.db_for_write(model)
+    triggers = get_backend(using)
+    content_type = contenttypes.models.ContentType.objects.db_manager(using).get_for_model(model)
+    m2m = m2m and has_m2m_denorms(model)
+
+    # aggregates are rebuilt first, as the other fields may depend on them
+    aggregates = [denorm for denorm in denorms if rebuilds_in_sql(denorm)]
+    denorms = [denorm for denorm in denorms if denorm not in aggregates]
+
+    chunk = in_pk_range(model._base_manager.using(using), lower, upper).order_by('pk')
+    with transaction.atomic(using=using):
+        with triggers.TriggerBypass(bypass_token(content_type.pk), using=using):
+            for denorm in aggregates:
+                denorm.rebuild_queryset(chunk)
+            if denorms or m2m:
+                instances = list(chunk)
+                update_instances(model, instances, denorms, m2m=m2m, using=using, shadows=shadows)
+                return len(instances)
+            return chunk.count()
+
+
+def rebuild_partition(args):
+    """
+    Runs ``rebuild_range`` in a worker of a parallel rebuild.
+    Returns ``(lower, upper, count, error)``, where ``error`` is the
+    formatted traceback if the rebuild failed and None otherwise.
+    Threads share the cache of the shadow rebuilds in progress, processes
+    get a copy of their own.
+    """
+    label, fieldnames, lower, upper, using, max_rows_per_sec, sleep, executor, shadows = args
+    try:
+        throttle = Throttle(max_rows_per_sec, sleep)
+        model = apps.get_model(label)
+        denorms = get_rebuild_denorms(model, fieldnames)
+        count = rebuild_range(model, denorms, lower, upper, using=using, m2m=fieldnames is None, shadows=shadows)
+        throttle.wait(count)
+        return lower, upper, count, None
+    except Exception:
+        return lower, upper, 0, traceback.format_exc()
+    finally:
+        if executor == 'thread':
+            # connections are per thread and would be leaked otherwise
+            connections.close_all()
+
+
+class RebuildError(Exception):
+    """
+    Raised by a parallel rebuild after all chunks have been processed, if
+    some of them failed. ``errors`` is a list of
+    ``(model, lower, upper, traceback)`` tuples. The checkpoint stays
+    before the first failed chunk.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super(RebuildError, self).__init__(
+            "%s chunk(s) failed to rebuild:\n%s" % (len(errors), "\n".join(error[3] for error in errors)))
+
+
+def rebuilds_in_sql(denorm):
+    """
+    Returns whether ``denorm`` can be rebuilt with a set based UPDATE,
+    see ``AggregateDenorm.rebuild_queryset``.
+    """
+    return isinstance(denorm, AggregateDenorm) and denorm.get_rebuild_value() is not None
+
+
+def rebuild_aggregates(model, denorms, using=None, chunk_size=None):
+    """
+    Recalculates the aggregate ``denorms`` of all instances of ``model``
+    with set based UPDATEs, one per range of ``chunk_size`` primary keys if
+    given, instead of one query per instance. Returns the number of
+    written rows.
+    """
+    using = using or router.db_for_write(model)
+    triggers = get_backend(using)
+    content_type = contenttypes.models.ContentType.objects.db_manager(using).get_for_model(model)
+    queryset = model._base_manager.using(using)
+    if chunk_size:
+        ranges = pk_ranges(queryset, chunk_size)
+    else:
+        ranges = [(None, None)]
+    written = 0
+    for lower, upper in ranges:
+        with transaction.atomic(using=using):
+            with triggers.TriggerBypass(bypass_token(content_type.pk), using=using):
+                for denorm in denorms:
+                    written += denorm.rebuild_queryset(in_pk_range(queryset, lower, upper))
+    return written
+
+
+def verifyall(verbose=False, model_name=None, field_name=None, chunk_size=1000, repair=True, sample=None, out=None):
+    """
+    Finds the denormalized values that differ from what their denorm
+    computes, e.g. because they were changed while the triggers were
+    missing or bypassed, and repairs them unless ``repair`` is False.
+    ``model_name`` and ``field_name`` limit the checked fields like in
+    ``rebuildall``. Returns a dict mapping every checked model to the
+    number of wrong values of each field, see ``verify_model``.
+    """
+    results = OrderedDict()
+    for model, denorms in select_denorms(model_name, field_name).items():
+        denorms = [denorm for denorm in denorms if not isinstance(denorm, BaseCacheKeyDenorm)]
+        if denorms:
+            results[model] = verify_model(
+                model, denorms, chunk_size=chunk_size, repair=repair, verbose=verbose, sample=sample, out=out)
+    return results
+
+
+def verify_model(model, denorms=None, using=None, chunk_size=1000, repair=True, verbose=False, sample=None, out=None):
+    """
+    Compares the stored values of ``denorms`` (all denormalized fields
+    but the cache keys by default) of the instances of ``model`` with the
+    recalculated ones, range by range of ``chunk_size`` primary keys, and
+    returns a dict mapping every field name to the number of wrong values.
+
+    Counts and sums are compared in SQL, with a subquery grouping the
+    related rows, so only the primary keys of the wrong rows are
+    transferred. As the flush doesn't recalculate them, they are repaired
+    right away with one set based UPDATE per range writing just these
+    rows. The other fields are recalculated in python without writing
+    anything and the instances with wrong values are marked dirty, so the
+    next flush repairs them. Repairing thus costs time proportional to the
+    drift.
+
+    Recalculating the other fields loads every instance. With ``sample``
+    only about that many instances, spread evenly over the primary keys,
+    are recalculated and the numbers of wrong values of these fields only
+    count the sampled instances. If ``verbose`` is set, the numbers are
+    written to ``out`` (``sys.stdout`` by default).
+    """
+    using = using or router.db_for_write(model)
+    if denorms is None:
+        denorms = get_rebuild_denorms(model)
+    triggers = get_backend(using)
+    content_type = contenttypes.models.ContentType.objects.db_manager(using).get_for_model(model)
+    aggregates = [denorm for denorm in denorms if rebuilds_in_sql(denorm)]
+    callbacks = [denorm for denorm in denorms if denorm not in aggregates]
+    queryset = model._base_manager.using(using)
+
+    mismatches = OrderedDict((denorm.fieldname, 0) for denorm in denorms)
+    step = 1
+    if sample and callbacks:
+        step = max(1, -(-queryset.count() // sample))
+    seen = 0
+    for lower, upper in pk_ranges(queryset, chunk_size):
+        chunk = in_pk_range(queryset, lower, upper)
+        for denorm in aggregates:
+            wrong = chunk.exclude(**{denorm.fieldname: denorm.get_rebuild_value()})
+            object_ids = list(wrong.values_list('pk', flat=True))
+            mismatches[denorm.fieldname] += len(object_ids)
+            if object_ids and repair:
+                with transaction.atomic(using=using):
+                    with triggers.TriggerBypass(bypass_token(content_type.pk), using=using):
+                        denorm.rebuild_queryset(chunk)
+        if not callbacks:
+            continue
+        instances = chunk.order_by('pk')
+        if step > 1:
+            # every step-th instance, counting across the ranges
+            pks = list(instances.values_list('pk', flat=True))
+            instances = instances.filter(pk__in=pks[-seen % step::step])
+            seen += len(pks)
+        object_ids = []
+        for instance in instances:
+            wrong = [denorm.fieldname for denorm in callbacks if denorm.update(instance)]
+            for fieldname in wrong:
+                mismatches[fieldname] += 1
+            if wrong:
+                object_ids.append(instance.pk)
+        if object_ids and repair:
+            mark_dirty(model, object_ids, using=using)
+
+    if verbose:
+        out = out or sys.stdout
+        for fieldname, count in mismatches.items():
+            out.write('%s wrong values of %s.%s.%s\n' % (count, model._meta.app_label, model._meta.object_name, fieldname))
+    return mismatches
+
+
+def mark_all_dirty(model, using=None, chunk_size=None):
+    """
+    Marks every instance of ``model`` dirty, so the next flush rebuilds
+    its denormalized fields.
+
+    The markers are added with a single ``INSERT ... SELECT`` without
+    loading any instance. With ``chunk_size`` one statement is run per range
+    of that many primary keys instead, keeping the transactions short on
+    big tables.
+    """
+    from .models import DirtyInstance
+    using = using or router.db_for_write(DirtyInstance)
+    cconnection = connections[using]
+    qn = cconnection.ops.quote_name
+    pk = model._meta.pk
+
+    if chunk_size:
+        ranges = pk_ranges(model._base_manager.using(using), chunk_size)
+    else:
+        ranges = [(None, None)]
+    for lower, upper in ranges:
+        where = []
+        params = []
+        if lower is not None:
+            where.append("%s > %%s" % qn(pk.column))
+            params.append(pk.get_db_prep_value(lower, cconnection))
+        if upper is not None:
+            where.append("%s <= %%s" % qn(pk.column))
+            params.append(pk.get_db_prep_value(upper, cconnection))
+        insert_dirty_markers(model, where, params, using)
+
+
+def mark_dirty(model, object_ids, using=None, batch_size=500):
+    """
+    Marks the instances of ``model`` with the primary keys ``object_ids``
+    dirty, with one ``INSERT ... SELECT`` per ``batch_size`` instances.
+    """
+    from .models import DirtyInstance
+    using = using or router.db_for_write(DirtyInstance)
+    cconnection = connections[using]
+    pk = model._meta.pk
+    for batch in chunked(object_ids, batch_size):
+        where = ["%s IN (%s)" % (cconnection.ops.quote_name(pk.column), ", ".join(["%s"] * len(batch)))]
+        insert_dirty_markers(model, where, [pk.get_db_prep_value(object_id, cconnection) for object_id in batch], using)
+
+
+def insert_dirty_markers(model, where, params, using):
+    """
+    Marks the rows of ``model`` matching the SQL conditions ``where`` dirty
+    with an ``INSERT ... SELECT`` through the backend, which skips the
+    instances already marked dirty.
+    """
+    from .db.base import NestedSelect
+    from .models import DirtyInstance
+    cconnection = connections[using]
+    qn = cconnection.ops.quote_name
+    triggers = get_backend(using)
+    content_type = contenttypes.models.ContentType.objects.db_manager(using).get_for_model(model)
+
+    select = ["SELECT %s, %s FROM %s" % (int(content_type.pk), qn(model._meta.pk.column), qn(model._meta.db_table))]
+    if where:
+        select.append("WHERE " + " AND ".join(where))
+    action = triggers.TriggerActionInsert(
+        model=DirtyInstance,
+        columns=("content_type_id", "object_id"),
+        values=NestedSelect(" ".join(select), params),
+    )
+    with transaction.atomic(using=using):
+        cursor = cconnection.cursor()
+        for sql, sql_params in action.statements():
+            cursor.execute(sql, sql_params)
 
 
 def drop_triggers(using=None):
-    from .db import triggers
+    triggers = get_backend(using)
     triggerset = triggers.TriggerSet(using=using)
     triggerset.drop()
 
 
-def install_triggers(using=None):
+def install_triggers(using=None, online=False, lock_timeout=1000, retries=5, progress=None, chunk_size=1000):
     """
-    Installs all required triggers in the database
+    Installs all required triggers in the database. Triggers that are
+    already installed unchanged are left alone, triggers that are no
+    longer needed are dropped.
+
+    With ``online`` the triggers are installed one table at a time in short
+    transactions waiting at most ``lock_timeout`` milliseconds for locks
+    (see ``TriggerSet.install_online``). The fields whose triggers were
+    missing or being replaced may have drifted in the meantime and are
+    rebuilt directly afterwards (see ``rebuild_model``), in chunks of
+    ``chunk_size`` primary keys. Counts and sums are rebuilt in SQL, they
+    wouldn't be fixed by a flush.
     """
-    build_triggerset(using=using).install()
+    triggerset = build_triggerset(using=using)
+    if not online:
+        triggerset.install()
+        return
+
+    stale = triggerset.install_online(lock_timeout=lock_timeout, retries=retries, progress=progress)
+    models = OrderedDict()
+    for denorm in stale:
+        # cache keys are renewed along with the other fields
+        if not isinstance(denorm, BaseCacheKeyDenorm):
+            models.setdefault(denorm.model, []).append(denorm)
+    for model in dependency_order(models):
+        denorms = sorted(models[model], key=lambda denorm: denorm.fieldname)
+        rebuild_model(model, denorms=denorms, using=using, chunk_size=chunk_size)
 
 
 def build_triggerset(using=None):
-    from .db import triggers
+    triggers = get_backend(using)
     alldenorms = get_alldenorms()
 
     # Use a TriggerSet to ensure each event gets just one trigger
     triggerset = triggers.TriggerSet(using=using)
     for denorm in alldenorms:
-        triggerset.append(denorm.get_triggers(using=using))
+        triggerset.append(denorm.get_triggers(using=using), denorm)
     return triggerset
 
 
-def flush(verbose=False):
+def dependency_graph():
+    """
+    Returns a dict mapping every model involved in a denormalization to the
+    set of models whose denormalized fields depend on it, i.e. the models
+    that may be marked dirty when it changes.
+    """
+    return registry.dependency_graph()
+
+
+def strongly_connected_components(graph):
+    """
+    Returns the strongly connected components of ``graph`` (Tarjan's
+    algorithm) in topological order: every component comes before all
+    components reachable from it.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    components = []
+
+    def visit(node):
+        index[node] = lowlink[node] = len(index)
+        stack.append(node)
+        for successor in graph.get(node, ()):
+            if successor not in index:
+                visit(successor)
+                lowlink[node] = min(lowlink[node], lowlink[successor])
+            elif successor in stack:
+                lowlink[node] = min(lowlink[node], index[successor])
+        if lowlink[node] == index[node]:
+            component = []
+            while True:
+                successor = stack.pop()
+                component.append(successor)
+                if successor is node:
+                    break
+            components.append(component)
+
+    for node in graph:
+        if node not in index:
+            visit(node)
+    components.reverse()
+    return components
+
+
+def dependency_order(models):
+    """
+    Returns ``models`` sorted in the order of the strongly connected
+    components of the dependency graph, see ``flush_order``.
+    """
+    order = dict(
+        (model, i)
+        for i, component in enumerate(strongly_connected_components(dependency_graph()))
+        for model in component
+    )
+    return sorted(models, key=lambda model: order.get(model, len(order)))
+
+
+def flush_order():
+    """
+    Returns the content type ids of all models with denormalized fields,
+    grouped by strongly connected component of the dependency graph and in
+    topological order. Flushing the groups in this order means a flushed
+    model only marks models of its own or a later group dirty, so a single
+    pass is enough for models that don't depend on themselves.
+    """
+    ContentType = contenttypes.models.ContentType
+    return [
+        [ContentType.objects.get_for_model(model).pk for model in component]
+        for component in strongly_connected_components(dependency_graph())
+    ]
+
+
+class FlushError(Exception):
+    """
+    Raised by a parallel flush after all partitions have been processed,
+    if some of them failed. ``errors`` is a list of
+    ``(content_type_id, object_ids, traceback)`` tuples. The dirty markers
+    of failed partitions stay in the queue.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super(FlushError, self).__init__(
+            "%s partition(s) failed to flush:\n%s" % (len(errors), "\n".join(error[2] for error in errors)))
+
+
+def flush(verbose=False, batch_size=None, workers=None, executor='process', concurrent=False):
     """
     Updates all model instances marked as dirty by the DirtyInstance
     model.
     After this method finishes the DirtyInstance table is empty and
     all denormalized fields have consistent data.
+
+    If ``batch_size`` (or the ``DENORM_FLUSH_BATCH_SIZE`` setting) is given,
+    dirty instances are processed in batches of that size, see
+    ``flush_batched``. Otherwise every dirty instance is claimed,
+    recalculated and written back on its own, see ``flush_instance``.
+    Either way a marker whose instance changes again while it is flushed
+    stays in the queue.
+
+    If ``workers`` is given, the batches are split up and flushed in
+    parallel by that many processes or threads (``executor='thread'``).
+
+    Flushes that may run at the same time as others (the
+    ``DenormMiddleware`` in several web workers, daemons) pass
+    ``concurrent=True`` to be batched even without a batch size, which
+    claims the markers a page at a time.
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'DENORM_FLUSH_BATCH_SIZE', None)
+    if (workers or concurrent) and not batch_size:
+        batch_size = DEFAULT_BATCH_SIZE
+    if batch_size:
+        return flush_batched(verbose=verbose, batch_size=batch_size, workers=workers, executor=executor)
+
+    from .models import DirtyInstance
+    from .db import triggers
+    # the shadow rebuilds in progress are looked up once, see sync_shadows
+    shadows = {}
+    # Flush the models in dependency order, so instances marked dirty by
+    # flushing an other model are flushed later in the same pass.
+    # The final pass without a filter catches everything else.
+    for content_type_ids in flush_order() + [None]:
+        # Loop until break.
+        # We may need multiple passes, because an update on one instance
+        # may cause an other instance to be marked dirty (dependency chains)
+        while True:
+            # Get all dirty markers, there is at most one per instance.
+            # Markers claimed by a batched flush are left to it.
+            qs = DirtyInstance.objects.filter(claimable_markers())
+            if content_type_ids is not None:
+                qs = qs.filter(content_type_id__in=content_type_ids)
+
+            # No dirty markers left -> all data is consistent -> we're done
+            if not qs.exists():
+                break
+
+            # Recalculate all dirty instances, writing only the changed
+            # denormalized fields. Like in ``flush_batch`` every marker is
+            # claimed first and only removed if the triggers didn't drop the
+            # claim, i.e. the instance wasn't changed again in the meantime.
+            for i, dirty_instance in enumerate(qs.iterator()):
+                if verbose:
+                    print("flushing dirty instance %s" % (i + 1))
+                token = uuid.uuid4().hex
+                claimed = DirtyInstance.objects.filter(claimable_markers(), pk=dirty_instance.pk).update(
+                    claim=token, claimed_at=timezone.now())
+                if not claimed:
+                    continue
+                with transaction.atomic():
+                    instance = dirty_instance.content_object
+                    if instance:
+                        with triggers.TriggerBypass(bypass_token(dirty_instance.content_type_id)):
+                            flush_instance(instance, shadows)
+                    DirtyInstance.objects.filter(pk=dirty_instance.pk, claim=token).delete()
+
+
+def get_flush_denorms(model):
+    """
+    Returns the callback denorms of ``model``, that get recalculated
+    for every dirty instance during a batched flush.
+    """
+    return [denorm for denorm in registry.for_model(model) if isinstance(denorm, BaseCallbackDenorm)]
+
+
+def update_denorms(model, instance, denorms=None):
+    """
+    Recalculates the callback denorms of ``instance`` (or the given
+    ``denorms``) and returns a dict mapping the names of the fields whose
+    value changed to their new value.
+    If anything changed, the instance's cache keys are renewed as well,
+    like ``save()`` would do.
+    """
+    if denorms is None:
+        denorms = get_flush_denorms(model)
+    changed = {}
+    for denorm in denorms:
+        changed.update(denorm.update(instance) or {})
+    if changed:
+        for field in model._meta.fields:
+            if isinstance(getattr(field, 'denorm', None), BaseCacheKeyDenorm):
+                changed[field.name] = field.pre_save(instance, False)
+    return changed
+
+
+def has_m2m_denorms(model):
+    return bool(registry.m2m_fields(model))
+
+
+def flush_instance(instance, shadows=None):
+    """
+    Recalculates the denormalized fields of ``instance`` and writes the
+    ones that changed back to the database with a single UPDATE. Unlike
+    ``save()`` this neither rewrites the other columns nor sends any
+    signals, and nothing is written if nothing changed.
+
+    ``shadows`` caches the shadow rebuilds in progress, see ``sync_shadows``.
     """
+    model = instance.__class__
+    changed = update_denorms(model, instance)
+    if changed:
+        model._base_manager.filter(pk=instance.pk).update(**changed)
+    if has_m2m_denorms(model):
+        many_to_many_pre_save(model, instance)
+    sync_shadows(model, [instance], cache=shadows, changed=[instance] if changed else [])
 
-    # Loop until break.
-    # We may need multiple passes, because an update on one instance
-    # may cause an other instance to be marked dirty (dependency chains)
+
+def flush_instances(model, object_ids, shadows=None):
+    """
+    Recalculates the denormalized fields of all instances of ``model``
+    whose primary key is in ``object_ids`` and writes them back to the
+    database.
+
+    Instead of calling ``save()`` on every single instance, the instances
+    are loaded with one query. Instances are grouped by the set of their
+    changed fields and each group is written back with one bulk UPDATE of
+    only these columns. Unchanged instances are not written at all.
+    ``shadows`` caches the shadow rebuilds in progress, see ``sync_shadows``.
+    """
+    object_ids = [object_id for object_id in object_ids if object_id is not None]
+    update_instances(model, model._base_manager.in_bulk(object_ids).values(), shadows=shadows)
+
+
+def update_instances(model, instances, denorms=None, m2m=True, using=None, shadows=None):
+    """
+    Recalculates ``denorms`` (see ``update_denorms``) and, if ``m2m`` is
+    set, the denormalized ManyToManyFields of ``instances`` and writes the
+    changed values back with one bulk UPDATE per set of changed fields.
+    The recalculated values are also written to the shadow rebuilds of
+    ``model`` in progress, looked up with the cache ``shadows``, see
+    ``denorm.shadow``.
+    """
+    m2m_denorms = m2m and has_m2m_denorms(model)
+    instances = list(instances)
+
+    groups = OrderedDict()
+    changed_instances = []
+    for instance in instances:
+        changed = update_denorms(model, instance, denorms)
+        if changed:
+            groups.setdefault(tuple(sorted(changed)), []).append(instance)
+            changed_instances.append(instance)
+        if m2m_denorms:
+            many_to_many_pre_save(model, instance)
+    for fieldnames, group in groups.items():
+        bulk_update(model, group, fieldnames, using=using)
+    sync_shadows(model, instances, denorms, using=using, cache=shadows, changed=changed_instances)
+
+
+def claimable_markers(now=None):
+    """
+    Returns a filter for the dirty markers that are not claimed, or whose
+    claim is older than the ``DENORM_FLUSH_CLAIM_TIMEOUT`` setting.
+    """
+    now = now or timezone.now()
+    timeout = getattr(settings, 'DENORM_FLUSH_CLAIM_TIMEOUT', 300)
+    return Q(claim__isnull=True) | Q(claimed_at__lt=now - datetime.timedelta(seconds=timeout))
+
+
+def claim_dirty_instances(token, batch_size, content_type_ids=None, after=None):
+    """
+    Claims up to ``batch_size`` dirty markers for the worker identified by
+    ``token`` and returns them as ``(pk, content_type_id, object_id)``
+    tuples.
+
+    Markers claimed by other workers are skipped unless their claim is
+    older than the ``DENORM_FLUSH_CLAIM_TIMEOUT`` setting (in seconds,
+    defaults to 300), in which case the worker is assumed to have died.
+    Where the backend supports it the candidates are locked with
+    ``SELECT ... FOR UPDATE SKIP LOCKED``, so concurrent workers never wait
+    for each other. Otherwise the claim is taken with a conditional UPDATE
+    and a concurrent worker simply ends up with fewer markers.
+
+    If ``content_type_ids`` is given only markers of these content types
+    are claimed. If ``after`` is given only markers with a greater primary
+    key are claimed.
+    """
+    from .models import DirtyInstance
+    now = timezone.now()
+    claimable = claimable_markers(now)
+    qs = DirtyInstance.objects.filter(claimable).order_by('pk')
+    if content_type_ids is not None:
+        qs = qs.filter(content_type_id__in=content_type_ids)
+    if after is not None:
+        qs = qs.filter(pk__gt=after)
+    columns = ('pk', 'content_type_id', 'object_id')
+
+    with transaction.atomic():
+        if getattr(connection.features, 'has_select_for_update_skip_locked', False):
+            page = list(qs.select_for_update(skip_locked=True).values_list(*columns)[:batch_size])
+            DirtyInstance.objects.filter(pk__in=[row[0] for row in page]).update(claim=token, claimed_at=now)
+            return page
+
+        candidates = list(qs.values_list('pk', flat=True)[:batch_size])
+        DirtyInstance.objects.filter(claimable, pk__in=candidates).update(claim=token, claimed_at=now)
+    return list(DirtyInstance.objects.filter(claim=token).order_by('pk').values_list(*columns)[:batch_size])
+
+
+def dirty_pages(batch_size, content_type_ids=None):
+    """
+    Yields all dirty markers as ``(token, page)`` pairs, where ``page`` is
+    a list of at most ``batch_size`` ``(pk, content_type_id, object_id)``
+    tuples claimed with ``token``.
+
+    Every page is claimed before it is yielded (see
+    ``claim_dirty_instances``), so several workers can flush at the same
+    time without processing a marker twice. The pages are read with keyset
+    pagination on the primary key, so markers claimed by other workers are
+    not scanned again for every page. Neither the number of queries per
+    page nor the memory used depends on the size of the queue, which is why
+    no server-side cursor is needed. Markers added while iterating are
+    picked up by the following pages, markers behind the last page (e.g.
+    released by a trigger or with an expired claim) by a final pass from
+    the start.
+
+    If ``content_type_ids`` is given only markers of these content types
+    are yielded.
+    """
+    from .models import DirtyInstance
+    unclaimed = DirtyInstance.objects.filter(claim__isnull=True)
+    if content_type_ids is not None:
+        unclaimed = unclaimed.filter(content_type_id__in=content_type_ids)
+    after = None
     while True:
-        # Get all dirty markers
-        from .models import DirtyInstance
-        qs = DirtyInstance.objects.all()
-
-        try:  # If possible, dont flush the same object twice
-            qs_unified = qs.distinct('content_type', 'object_id')
-            '%s' % qs_unified   # Triggers SQL evaluation: NotImplementedError if not supported
-            qs = qs_unified
-        except NotImplementedError:  # SQLite does not suport DISTINCT ON
-            pass
-
-        # DirtyInstance table is empty -> all data is consistent -> we're done
-        if not qs:
-            break
-
-        # Call save() on all dirty instances, causing the self_save_handler()
-        # getting called by the pre_save signal.
-        if verbose:
-            size = qs.count()
-            i = 0
-        for dirty_instance in qs.iterator():
+        token = uuid.uuid4().hex
+        page = claim_dirty_instances(token, batch_size, content_type_ids, after)
+        if page:
+            after = page[-1][0]
+            yield token, page
+        elif after is not None:
+            after = None
+        elif not unclaimed.exists():
+            # everything left is claimed by other workers
+            return
+
+
+def bypass_token(content_type_id, pk=None):
+    """
+    Returns the token that makes the triggers skip marking the instance
+    with primary key ``pk`` dirty, or all instances of the content type if
+    ``pk`` is None. See ``TriggerBypass``.
+    """
+    return '%s:%s' % (content_type_id, '*' if pk is None else pk)
+
+
+def bypass_pre_save(sender, instance, raw=False, using=None, update_fields=None, **kwargs):
+    """
+    Makes the triggers skip marking ``instance`` dirty while it is saved,
+    as its denormalized fields are computed by the save itself. Raw SQL
+    and queryset updates still mark it dirty.
+
+    Only saves inside an atomic block are bypassed, so that a failed save
+    can't leave the bypass behind: the rollback removes it. Inserts
+    without a primary key are not bypassed either, as their token would
+    match every instance of the model.
+    """
+    triggers = get_backend(using)
+    if raw or update_fields is not None or instance.pk is None:
+        # the denormalized fields are not computed, or the
+        # instance can't be told apart from the others yet
+        return
+    bypass_connection = connections[using or router.db_for_write(sender)]
+    if not bypass_connection.in_atomic_block:
+        return
+    content_type = contenttypes.models.ContentType.objects.get_for_model(sender)
+    pk = sender._meta.pk.get_db_prep_value(instance.pk, bypass_connection)
+    bypass = triggers.TriggerBypass(bypass_token(content_type.pk, pk), using=bypass_connection.alias)
+    bypass.__enter__()
+    instance._denorm_bypass = bypass
+
+
+def bypass_post_save(sender, instance, **kwargs):
+    bypass = instance.__dict__.pop('_denorm_bypass', None)
+    if bypass is not None:
+        bypass.__exit__(None, None, None)
+
+
+def flush_batch(token, content_type_id, model, object_ids, shadows=None):
+    """
+    Flushes the instances of ``model`` in ``object_ids`` and removes
+    their dirty markers in one transaction.
+
+    Only markers claimed with ``token`` are removed. The triggers drop the
+    claim of a marker if its instance is changed again in the meantime, so
+    such a marker stays in the queue. The flush's own writes don't mark
+    the instances dirty again. ``shadows`` caches the shadow rebuilds in
+    progress, see ``sync_shadows``.
+    """
+    from .models import DirtyInstance
+    from .db import triggers
+    # markers pointing to NULL (e.g. created from a nullable
+    # ForeignKey) don't match an IN lookup
+    batch_filter = Q(object_id__in=object_ids)
+    if None in object_ids:
+        batch_filter |= Q(object_id__isnull=True)
+    with transaction.atomic():
+        if model is not None:
+            with triggers.TriggerBypass(bypass_token(content_type_id)):
+                flush_instances(model, object_ids, shadows)
+        DirtyInstance.objects.filter(
+            batch_filter,
+            claim=token,
+            content_type_id=content_type_id,
+        ).delete()
+
+
+def partition_page(page, partitions=1):
+    """
+    Groups the markers of ``page`` by content type and, if ``partitions``
+    is greater than 1, by a hash of their object id. Returns a dict mapping
+    ``(content_type_id, partition)`` to the list of object ids.
+    The same object always ends up in the same partition.
+    """
+    groups = OrderedDict()
+    for pk, content_type_id, object_id in page:
+        partition = zlib.crc32(force_bytes(object_id)) % partitions
+        groups.setdefault((content_type_id, partition), OrderedDict())[object_id] = None
+    return OrderedDict((key, list(object_ids)) for key, object_ids in groups.items())
+
+
+def flush_partition(args):
+    """
+    Runs ``flush_batch`` in a worker of a parallel flush.
+    Returns ``(content_type_id, object_ids, error)``, where ``error`` is
+    the formatted traceback if flushing failed and None otherwise.
+    Threads share the cache of the shadow rebuilds in progress, processes
+    get a copy of their own.
+    """
+    token, content_type_id, object_ids, executor, shadows = args
+    try:
+        model = contenttypes.models.ContentType.objects.get_for_id(content_type_id).model_class()
+        flush_batch(token, content_type_id, model, object_ids, shadows)
+        return content_type_id, object_ids, None
+    except Exception:
+        return content_type_id, object_ids, traceback.format_exc()
+    finally:
+        if executor == 'thread':
+            # connections are per thread and would be leaked otherwise
+            connections.close_all()
+
+
+# connections a forked worker inherited from its parent, see init_worker
+inherited_connections = []
+
+
+def init_worker(databases):
+    """
+    Sets up Django in a worker process of ``get_pool``. Processes that
+    are spawned instead of forked start without it. The workers use the
+    same databases as the parent, e.g. the test databases during tests.
+
+    A forked worker gets connections of its own. The ones inherited from
+    the parent are put aside without closing them, as closing them would
+    also end the parent's sessions.
+    """
+    django.setup()
+    for alias, settings_dict in databases.items():
+        conn = connections[alias]
+        conn.settings_dict.update(settings_dict)
+        if conn.connection is not None:
+            inherited_connections.append(conn.connection)
+            conn.connection = None
+
+
+def get_pool(workers, executor):
+    if executor not in ('process', 'thread'):
+        raise ValueError("executor must be 'process' or 'thread', not '%s'" % executor)
+    for conn in connections.all():
+        if conn.in_atomic_block:
+            # the workers commit on their own connections and the pool
+            # would close the connection of the enclosing transaction
+            raise transaction.TransactionManagementError(
+                "A parallel flush or rebuild can't run inside an atomic block.")
+    if executor == 'thread':
+        return ThreadPool(workers)
+    databases = dict((conn.alias, conn.settings_dict) for conn in connections.all())
+    return Pool(workers, init_worker, (databases,))
+
+
+# batch size of flushes that have to be batched if none is configured
+DEFAULT_BATCH_SIZE = 1000
+
+
+def flush_batched(verbose=False, batch_size=1000, workers=None, executor='process'):
+    """
+    Like ``flush`` but streams through the dirty markers in pages of
+    ``batch_size`` and processes each page grouped by content type.
+    Each group is loaded with one query, the denormalized columns are
+    written back with one UPDATE and the dirty markers are removed with
+    one DELETE. Memory usage is bounded by ``batch_size``.
+
+    If updating an instance invalidates an other instance in the same batch
+    (e.g. with ``depend_on_related('self')``), the marker of the other
+    instance is kept and it is processed again in a later page.
+
+    Models are flushed in dependency order (see ``flush_order``).
+
+    Several processes can run a batched flush at the same time, each of
+    them only processes and removes the markers it claimed. Markers claimed
+    by an other process are left to it.
+
+    With ``workers`` every page is further partitioned by a hash of the
+    object ids and the partitions are flushed by a pool of ``workers``
+    processes (or threads, if ``executor`` is ``'thread'``), each with its
+    own database connection. Errors are collected and raised as one
+    ``FlushError`` at the end. On sqlite ``workers`` is ignored, elsewhere
+    a parallel flush can't run inside an atomic block.
+
+    Returns the number of flushed instances.
+    """
+    ContentType = contenttypes.models.ContentType
+    max_query_params = connection.features.max_query_params or batch_size
+    batch_size = min(batch_size, max_query_params - 1)
+
+    if connection.vendor == 'sqlite':
+        # sqlite allows only one writer at a time
+        workers = None
+    pool = get_pool(workers, executor) if workers else None
+    # the shadow rebuilds in progress are looked up once, see sync_shadows
+    shadows = {}
+    flushed = 0
+    errors = []
+    pages = (
+        page
+        for content_type_ids in flush_order() + [None]
+        for page in dirty_pages(batch_size, content_type_ids)
+    )
+    try:
+        for token, page in pages:
+            partitions = partition_page(page, workers or 1)
             if verbose:
-                i += 1
-                print("flushing %s of %s all dirty instances" % (i, size))
-            if dirty_instance.content_object:
-                dirty_instance.content_object.save()
-
-            DirtyInstance.objects.filter(
-                content_type_id=dirty_instance.content_type_id,
-                object_id=dirty_instance.object_id
-            ).delete()
+                for (content_type_id, partition), object_ids in partitions.items():
+                    model = ContentType.objects.get_for_id(content_type_id).model_class()
+                    print("flushing %s dirty instances of %s" % (len(object_ids), model))
+
+            if pool is None:
+                for (content_type_id, partition), object_ids in partitions.items():
+                    model = ContentType.objects.get_for_id(content_type_id).model_class()
+                    flush_batch(token, content_type_id, model, object_ids, shadows)
+                    flushed += len(object_ids)
+                continue
+
+            tasks = [
+                (token, content_type_id, object_ids, executor, shadows)
+                for (content_type_id, partition), object_ids in partitions.items()
+            ]
+            for content_type_id, object_ids, error in pool.map(flush_partition, tasks):
+                if error:
+                    errors.append((content_type_id, object_ids, error))
+                else:
+                    flushed += len(object_ids)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if errors:
+        raise FlushError(errors)
+    return flushed
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from denorm.db import get_backend
 from denorm.helpers import find_fks, find_m2ms, remote_field_model
 from django.db import models
 from django.db.models.fields import related
@@ -35,11 +36,12 @@ class DenormDependency(object):
 
 
 class DependOnRelated(DenormDependency):
-    def __init__(self, othermodel, foreign_key=None, type=None, skip=None):
+    def __init__(self, othermodel, foreign_key=None, type=None, skip=None, fields=None):
         self.other_model = othermodel
         self.fk_name = foreign_key
         self.type = type
         self.skip = skip or ()
+        self.fields = fields
 
     def setup(self, this_model):
         super(DependOnRelated, self).setup(this_model)
@@ -91,11 +93,24 @@ class DependOnRelated(DenormDependency):
         # Now the candidates list contains exactly one item, thats our winner.
         self.type, self.field = candidates[0]
 
+    def tracked_fields(self):
+        """
+        Returns the names of the fields of ``other_model`` whose changes
+        have to be tracked, or None if all of them are.
+        """
+        if self.fields is None:
+            return None
+        fields = list(self.fields) + [self.other_model._meta.pk.name]
+        if self.type == "backward":
+            # Changing the ForeignKey affects the old and the new related instance.
+            fields.append(self.field.name)
+        return fields
+
 
 class CacheKeyDependOnRelated(DependOnRelated):
 
     def get_triggers(self, using):
-        from denorm.db import triggers
+        triggers = get_backend(using)
         qn = self.get_quote_name(using)
 
         if not self.type:
@@ -105,7 +120,7 @@ class CacheKeyDependOnRelated(DependOnRelated):
         content_type = str(contenttypes.models.ContentType.objects.get_for_model(self.this_model).pk)
 
         if self.type == "forward":
-            from denorm.db import triggers
+            triggers = get_backend(using)
             # With forward relations many instances of ``this_model``
             # may be related to one instance of ``other_model``
             action_new = triggers.TriggerActionUpdate(
@@ -127,7 +142,7 @@ class CacheKeyDependOnRelated(DependOnRelated):
                 ),
             )
             return [
-                triggers.Trigger(self.other_model, "after", "update", [action_new], content_type, using, self.skip),
+                triggers.Trigger(self.other_model, "after", "update", [action_new], content_type, using, self.skip, self.tracked_fields()),
                 triggers.Trigger(self.other_model, "after", "insert", [action_new], content_type, using, self.skip),
                 triggers.Trigger(self.other_model, "after", "delete", [action_old], content_type, using, self.skip),
             ]
@@ -157,7 +172,7 @@ class CacheKeyDependOnRelated(DependOnRelated):
                 ),
             )
             return [
-                triggers.Trigger(self.other_model, "after", "update", [action_new, action_old], content_type, using, self.skip),
+                triggers.Trigger(self.other_model, "after", "update", [action_new, action_old], content_type, using, self.skip, self.tracked_fields()),
                 triggers.Trigger(self.other_model, "after", "insert", [action_new], content_type, using, self.skip),
                 triggers.Trigger(self.other_model, "after", "delete", [action_old], content_type, using, self.skip),
             ]
@@ -228,7 +243,7 @@ class CacheKeyDependOnRelated(DependOnRelated):
                     values=(triggers.RandomBigInt(),),
                     where=(self.this_model._meta.pk.get_attname_column()[1] + ' IN (' + sql + ')', params),
                 )
-                trigger_list.append(triggers.Trigger(self.other_model, "after", "update", [action_new], content_type, using, self.skip))
+                trigger_list.append(triggers.Trigger(self.other_model, "after", "update", [action_new], content_type, using, self.skip, self.tracked_fields()))
 
             return trigger_list
 
@@ -245,7 +260,7 @@ class CallbackDependOnRelated(DependOnRelated):
     on either of them pointing to the other one.
     """
 
-    def __init__(self, othermodel, foreign_key=None, type=None, skip=None):
+    def __init__(self, othermodel, foreign_key=None, type=None, skip=None, fields=None):
         """
         Attaches a dependency to a callable, indicating the return value depends on
         fields in an other model that is related to the model the callable belongs to
@@ -268,11 +283,15 @@ class CallbackDependOnRelated(DependOnRelated):
         skip
             Use this to specify what fields change on every save().
             These fields will not be checked and will not make a model dirty when they change, to prevent infinite loops.
+
+        fields
+            The names of the fields of the other model the return value depends on.
+            Changes to any other field will not make a model dirty. By default all fields are checked.
         """
-        super(CallbackDependOnRelated, self).__init__(othermodel, foreign_key, type, skip)
+        super(CallbackDependOnRelated, self).__init__(othermodel, foreign_key, type, skip, fields)
 
     def get_triggers(self, using):
-        from denorm.db import triggers
+        triggers = get_backend(using)
         qn = self.get_quote_name(using)
 
         if not self.type:
@@ -307,7 +326,7 @@ class CallbackDependOnRelated(DependOnRelated):
                 )
             )
             return [
-                triggers.Trigger(self.other_model, "after", "update", [action_new], content_type, using, self.skip),
+                triggers.Trigger(self.other_model, "after", "update", [action_new], content_type, using, self.skip, self.tracked_fields()),
                 triggers.Trigger(self.other_model, "after", "insert", [action_new], content_type, using, self.skip),
                 triggers.Trigger(self.other_model, "after", "delete", [action_old], content_type, using, self.skip),
             ]
@@ -337,7 +356,7 @@ class CallbackDependOnRelated(DependOnRelated):
                 ),
             )
             return [
-                triggers.Trigger(self.other_model, "after", "update", [action_new, action_old], content_type, using, self.skip),
+                triggers.Trigger(self.other_model, "after", "update", [action_new, action_old], content_type, using, self.skip, self.tracked_fields()),
                 triggers.Trigger(self.other_model, "after", "insert", [action_new], content_type, using, self.skip),
                 triggers.Trigger(self.other_model, "after", "delete", [action_old], content_type, using, self.skip),
             ]
@@ -404,7 +423,7 @@ class CallbackDependOnRelated(DependOnRelated):
                         **{reverse_column_name: 'NEW.%s' % qn(self.other_model._meta.pk.get_attname_column()[1])}
                     )
                 )
-                trigger_list.append(triggers.Trigger(self.other_model, "after", "update", [action_new], content_type, using, self.skip))
+                trigger_list.append(triggers.Trigger(self.other_model, "after", "update", [action_new], content_type, using, self.skip, self.tracked_fields()))
 
             return trigger_list
 
@@ -42,6 +42,9 @@ def denormalized(DBField, *args, **kwargs):
                 self.denorm = denorms.BaseCallbackDenorm(skip=self.skip)
             else:
                 self.denorm = denorms.CallbackDenorm(skip=self.skip)
+                # Don't let the triggers mark instances dirty, that are saved through the ORM
+                models.signals.pre_save.connect(denorms.bypass_pre_save, sender=cls)
+                models.signals.post_save.connect(denorms.bypass_post_save, sender=cls)
             self.denorm.func = self.func
             self.denorm.depend = [dcls(*dargs, **dkwargs) for (dcls, dargs, dkwargs) in getattr(self.func, 'depend', [])]
             self.denorm.model = cls
@@ -1,7 +1,16 @@
 # -*- coding: utf-8 -*-
-from django.db import models
+import time
+
+from django.conf import settings
+from django.db import connections, models, router
+from django.db.models import Case, Value, When
 import six
 
+try:
+    from django.db.models.functions import Cast
+except ImportError:  # Django<1.10
+    Cast = None
+
 
 def remote_field_model(field):
     if hasattr(field, 'remote_field') and field.remote_field:  # in Django>=1.9
@@ -12,6 +21,27 @@ def remote_field_model(field):
     if hasattr(field, 'rel') and field.rel:
         return field.rel.to
 
+def model_label(model):
+    """
+    Returns the lowercase ``app_label.model_name`` of a model class or of a
+    lazy ``'app_label.ModelName'`` reference.
+    """
+    if isinstance(model, six.string_types):
+        return model.lower()
+    return '%s.%s' % (model._meta.app_label, model._meta.model_name)
+
+
+def is_same_model(model, other):
+    """
+    Returns whether ``model`` and ``other`` refer to the same model.
+    """
+    if model is other:
+        return True
+    if model is None or other is None:
+        return False
+    return model_label(model) == model_label(other)
+
+
 def find_fks(from_model, to_model, fk_name=None):
     """
     Finds all ForeignKeys on 'from_model' pointing to 'to_model'.
@@ -21,7 +51,7 @@ def find_fks(from_model, to_model, fk_name=None):
     fkeys = [x for x in from_model._meta.fields if isinstance(x, models.ForeignKey)]
 
     # filter out all FKs not pointing to 'to_model'
-    fkeys = [x for x in fkeys if repr(remote_field_model(x)).lower() == repr(to_model).lower()]
+    fkeys = [x for x in fkeys if is_same_model(remote_field_model(x), to_model)]
 
     # if 'fk_name' was given, filter out all FKs not matching that name, leaving
     # only one (or none)
@@ -45,7 +75,7 @@ def find_m2ms(from_model, to_model, m2m_name=None):
     m2ms = list(from_model._meta.many_to_many) + private_fields
 
     # filter out all M2Ms not pointing to 'to_model'
-    m2ms = [x for x in m2ms if repr(remote_field_model(x)).lower() == repr(to_model).lower()]
+    m2ms = [x for x in m2ms if is_same_model(remote_field_model(x), to_model)]
 
     # if 'm2m_name' was given, filter out all M2Ms not matching that name, leaving
     # only one (or none)
@@ -54,3 +84,143 @@ def find_m2ms(from_model, to_model, m2m_name=None):
         m2ms = [x for x in m2ms if x.attname == m2m_name]
 
     return m2ms
+
+
+OBJECT_ID_FIELDS = {
+    'text': lambda: models.CharField(max_length=255, blank=True, null=True),
+    'integer': lambda: models.IntegerField(blank=True, null=True),
+    'bigint': lambda: models.BigIntegerField(blank=True, null=True),
+    'uuid': lambda: models.UUIDField(blank=True, null=True),
+}
+
+_object_id_classes = {}
+
+
+class ObjectIdField(object):
+    """
+    Mixin for the field of ``DirtyInstance.object_id``. The migrations always
+    see the text column they created, whatever ``DENORM_OBJECT_ID_TYPE`` is,
+    the column itself is converted with the ``denorm_object_id_type`` command.
+    """
+    def deconstruct(self):
+        name = super(ObjectIdField, self).deconstruct()[0]
+        path, args, kwargs = OBJECT_ID_FIELDS['text']().deconstruct()[1:]
+        return name, path, args, kwargs
+
+
+def object_id_field():
+    """
+    Returns the field used for ``DirtyInstance.object_id``.
+    Its type is chosen with the ``DENORM_OBJECT_ID_TYPE`` setting and should
+    match the primary keys of all models with denormalized fields, so the
+    triggers don't need to cast them to text.
+    """
+    object_id_type = getattr(settings, 'DENORM_OBJECT_ID_TYPE', 'text')
+    try:
+        field = OBJECT_ID_FIELDS[object_id_type]()
+    except KeyError:
+        raise ValueError(
+            "DENORM_OBJECT_ID_TYPE must be one of %s, not '%s'" % (
+                ", ".join(sorted(OBJECT_ID_FIELDS)), object_id_type))
+    field_class = field.__class__
+    if field_class not in _object_id_classes:
+        _object_id_classes[field_class] = type(
+            str('ObjectId%s' % field_class.__name__), (ObjectIdField, field_class), {})
+    args, kwargs = field.deconstruct()[2:]
+    return _object_id_classes[field_class](*args, **kwargs)
+
+
+def chunked(items, size):
+    """
+    Splits the list ``items`` into lists of at most ``size`` items.
+    """
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def pk_ranges(queryset, size, lower=None):
+    """
+    Splits the rows of ``queryset`` into ranges of at most ``size`` primary
+    keys and yields the ``(lower, upper)`` bounds of every range, ``lower``
+    being exclusive and ``upper`` inclusive. The first range starts after
+    ``lower`` (or has no lower bound) and the last one has no upper bound
+    (``None``).
+    """
+    pks = queryset.order_by('pk').values_list('pk', flat=True)
+    while True:
+        chunk = pks if lower is None else pks.filter(pk__gt=lower)
+        upper = list(chunk[size - 1:size])
+        if not upper:
+            yield lower, None
+            return
+        yield lower, upper[0]
+        lower = upper[0]
+
+
+def in_pk_range(queryset, lower=None, upper=None):
+    """
+    Limits ``queryset`` to the primary key range ``(lower, upper]`` as
+    yielded by ``pk_ranges``.
+    """
+    if lower is not None:
+        queryset = queryset.filter(pk__gt=lower)
+    if upper is not None:
+        queryset = queryset.filter(pk__lte=upper)
+    return queryset
+
+
+class Throttle(object):
+    """
+    Limits the rate of processed rows to ``max_rows_per_sec`` by sleeping
+    in ``wait``, and pauses ``sleep`` seconds after every call of ``wait``.
+    Doesn't limit anything if both are None.
+    """
+    def __init__(self, max_rows_per_sec=None, sleep=None):
+        self.max_rows_per_sec = max_rows_per_sec
+        self.sleep = sleep
+        self.start = time.time()
+        self.rows = 0
+
+    def wait(self, rows):
+        """
+        Called after processing ``rows`` rows.
+        """
+        self.rows += rows
+        if self.max_rows_per_sec:
+            delay = self.start + float(self.rows) / self.max_rows_per_sec - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        if self.sleep:
+            time.sleep(self.sleep)
+
+
+def bulk_update(model, instances, fields, using=None):
+    """
+    Writes the current values of ``fields`` of all ``instances`` back to the
+    database without calling ``save()``.
+    Uses ``QuerySet.bulk_update`` if available (Django>=2.2), otherwise
+    issues one ``UPDATE ... SET column = CASE pk WHEN ... END`` per batch.
+    """
+    using = using or router.db_for_write(model)
+    manager = model._base_manager.using(using)
+    instances = list(instances)
+    if not instances or not fields:
+        return
+    if hasattr(manager, 'bulk_update'):
+        manager.bulk_update(instances, fields)
+        return
+
+    cconnection = connections[using]
+    fields = [model._meta.get_field(name) for name in fields]
+    batch_size = max(cconnection.ops.bulk_batch_size(['pk', 'pk'] + fields, instances), 1)
+    for batch in chunked(instances, batch_size):
+        updates = {}
+        for field in fields:
+            whens = [When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in batch]
+            case = Case(*whens, output_field=field)
+            if Cast and cconnection.vendor == 'postgresql':
+                # postgres resolves untyped CASE branches to text
+                case = Cast(case, output_field=field)
+            updates[field.attname] = case
+        manager.filter(pk__in=[obj.pk for obj in batch]).update(**updates)
@@ -1,3 +1,4 @@
+import errno
 import os
 import sys
 import django
@@ -14,9 +15,11 @@ PID_FILE = "/tmp/django-denorm-daemon-pid"
 def commit_manually(fn):  # replacement of transaction.commit_manually decorator removed in Django 1.6
     def _commit_manually(*args, **kwargs):
         transaction.set_autocommit(False)
-        res = fn(*args, **kwargs)
-        transaction.commit()
-        transaction.set_autocommit(True)
+        try:
+            res = fn(*args, **kwargs)
+            transaction.commit()
+        finally:
+            transaction.set_autocommit(True)
         return res
     return _commit_manually
 
@@ -52,6 +55,30 @@ class Command(BaseCommand):
             default=False,
             help='Run only once (for testing purposes)',
         ),
+        parser.add_argument(
+            '--batch-size',
+            action='store',
+            type=int,
+            dest='batch_size',
+            default=None,
+            help='Process dirty instances in batches of this size. Defaults to the DENORM_FLUSH_BATCH_SIZE setting.',
+        ),
+        parser.add_argument(
+            '--workers',
+            action='store',
+            type=int,
+            dest='workers',
+            default=None,
+            help='Flush in parallel with this many workers.',
+        ),
+        parser.add_argument(
+            '--executor',
+            action='store',
+            dest='executor',
+            choices=('process', 'thread'),
+            default='process',
+            help='Run the workers as processes (default) or threads.',
+        ),
     help = "Runs a daemon that checks for dirty fields and updates them in regular intervals."
 
     def pid_exists(self, pidfile):
@@ -61,7 +88,7 @@ class Command(BaseCommand):
             self.stderr.write(self.style.ERROR("daemon already running as pid: %s\n" % (pid,)))
             return True
         except OSError as err:
-            return err.errno == os.errno.EPERM
+            return err.errno == errno.EPERM
         except IOError as err:
             if err.errno == 2:
                 return False
@@ -74,6 +101,9 @@ class Command(BaseCommand):
         interval = options['interval']
         pidfile = options['pidfile']
         run_once = options['run_once']
+        batch_size = options.get('batch_size')
+        workers = options.get('workers')
+        executor = options.get('executor', 'process')
 
         if self.pid_exists(pidfile):
             return
@@ -84,7 +114,7 @@ class Command(BaseCommand):
 
         while not run_once:
             try:
-                denorms.flush()
+                denorms.flush(batch_size=batch_size, workers=workers, executor=executor, concurrent=True)
                 sleep(interval)
                 transaction.commit()
             except KeyboardInterrupt:
@@ -5,5 +5,24 @@ from denorm import denorms
 class Command(BaseCommand):
     help = "Recalculates the value of every denormalized field that was marked dirty."
 
-    def handle(self, **kwargs):
-        denorms.flush()
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', action='store', type=int, dest='batch_size',
+            default=None, help='Process dirty instances in batches of this size. '
+                'Defaults to the DENORM_FLUSH_BATCH_SIZE setting.',
+        )
+        parser.add_argument(
+            '--workers', action='store', type=int, dest='workers',
+            default=None, help='Flush in parallel with this many workers.',
+        )
+        parser.add_argument(
+            '--executor', action='store', dest='executor', choices=('process', 'thread'),
+            default='process', help='Run the workers as processes (default) or threads.',
+        )
+
+    def handle(self, **options):
+        denorms.flush(
+            batch_size=options.get('batch_size'),
+            workers=options.get('workers'),
+            executor=options.get('executor', 'process'),
+        )
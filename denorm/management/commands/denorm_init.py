@@ -1,6 +1,6 @@
 from optparse import make_option
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.db import DEFAULT_DB_ALIAS
 import django
 
@@ -15,9 +15,45 @@ class Command(BaseCommand):
             default=DEFAULT_DB_ALIAS, help='Nominates a database to execute '
                 'SQL into. Defaults to the "default" database.',
         )
+        parser.add_argument(
+            '--check', action='store_true', dest='check', default=False,
+            help='Only report triggers that are missing, changed or no longer '
+                'needed, without changing the database.',
+        )
+        parser.add_argument(
+            '--online', action='store_true', dest='online', default=False,
+            help='Install the triggers one table at a time in short transactions.',
+        )
+        parser.add_argument(
+            '--lock-timeout', action='store', dest='lock_timeout', type=int, default=1000,
+            help='With --online, the number of milliseconds to wait for a table lock.',
+        )
+        parser.add_argument(
+            '--retries', action='store', dest='retries', type=int, default=5,
+            help='With --online, how often to retry a table when its lock could not be taken.',
+        )
 
     help = "Creates all triggers needed by django-denorm."
 
     def handle(self, **options):
         using = options['database']
-        denorms.install_triggers(using=using)
+        if options['check']:
+            create, replace, drop = denorms.build_triggerset(using=using).diff()
+            for action, names in (('create', create), ('replace', replace), ('drop', drop)):
+                for name in names:
+                    self.stdout.write("%s %s" % (action, name))
+            if create or replace or drop:
+                raise CommandError("The triggers in the database are out of date, run denorm_init.")
+
+        elif options['online']:
+            def progress(table, done, total):
+                if options['verbosity'] > 0:
+                    self.stdout.write("Installed triggers on %s (%d/%d)" % (table, done, total))
+
+            denorms.install_triggers(
+                using=using, online=True, lock_timeout=options['lock_timeout'],
+                retries=options['retries'], progress=progress,
+            )
+
+        else:
+            denorms.install_triggers(using=using)
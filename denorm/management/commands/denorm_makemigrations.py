@@ -0,0 +1,91 @@
+import re
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.db.migrations import Migration
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.writer import MigrationWriter
+
+from denorm.operations import render_triggers, InstallDenormTriggers, DropDenormTriggers
+
+
+class Command(BaseCommand):
+    help = "Creates a migration installing the triggers that changed since they were last migrated."
+
+    def add_arguments(self, parser):
+        parser.add_argument('app_label', help='The app to create the migration in.')
+        parser.add_argument(
+            '--name', action='store', dest='name', default='denorm_triggers',
+            help='Use this name for the migration.',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Print the migration instead of writing it.',
+        )
+        parser.add_argument(
+            '--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates the database to render '
+                'the triggers for. Defaults to the "default" database.',
+        )
+
+    def handle(self, **options):
+        app_label = options['app_label']
+        try:
+            apps.get_app_config(app_label)
+        except LookupError as e:
+            raise CommandError(str(e))
+
+        loader = MigrationLoader(None, ignore_no_migrations=True)
+        vendor, tables = render_triggers(using=options['database'])
+
+        # the triggers as installed by the existing migrations
+        migrated = {}
+        plan = []
+        for node in loader.graph.leaf_nodes():
+            plan.extend(key for key in loader.graph.forwards_plan(node) if key not in plan)
+        for key in plan:
+            for operation in loader.graph.nodes[key].operations:
+                if isinstance(operation, InstallDenormTriggers) and operation.vendor == vendor:
+                    if isinstance(operation, DropDenormTriggers):
+                        migrated.pop(operation.table, None)
+                    else:
+                        migrated[operation.table] = operation.triggers
+
+        def normalize(triggers):
+            return [(name, sql, tuple(params)) for name, sql, params in triggers or []]
+
+        operations = []
+        for table in sorted(set(tables) | set(migrated)):
+            if table not in tables:
+                operations.append(DropDenormTriggers(table, migrated[table], vendor))
+            elif normalize(tables[table]) != normalize(migrated.get(table)):
+                operations.append(InstallDenormTriggers(table, tables[table], vendor))
+        if not operations:
+            self.stdout.write("No changes detected")
+            return
+
+        # the tables and the content types have to exist
+        table_apps = dict(
+            (model._meta.db_table, model._meta.app_label)
+            for model in apps.get_models(include_auto_created=True)
+        )
+        dependency_apps = set(['contenttypes', 'denorm', app_label])
+        dependency_apps.update(table_apps[operation.table] for operation in operations if operation.table in table_apps)
+        dependencies = sorted(
+            node for dependency_app in dependency_apps
+            for node in loader.graph.leaf_nodes(dependency_app)
+        )
+
+        numbers = [int(re.match(r'\d*', name).group() or 0) for label, name in loader.graph.leaf_nodes(app_label)]
+        migration = Migration("%04i_%s" % (max(numbers + [0]) + 1, options['name']), app_label)
+        migration.dependencies = dependencies
+        migration.operations = operations
+
+        writer = MigrationWriter(migration)
+        if options['dry_run']:
+            self.stdout.write(writer.as_string())
+            return
+        with open(writer.path, 'w') as migration_file:
+            migration_file.write(writer.as_string())
+        self.stdout.write("Created %s" % writer.path)
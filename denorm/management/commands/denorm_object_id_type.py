@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from denorm import denorms
+from denorm.helpers import object_id_field, OBJECT_ID_FIELDS
+
+
+class Command(BaseCommand):
+    help = "Changes the type of the object ids in the dirty queue to the DENORM_OBJECT_ID_TYPE setting."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'previous_type', choices=sorted(OBJECT_ID_FIELDS),
+            help='The type the object ids are stored as now.',
+        )
+        parser.add_argument(
+            '--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database to execute '
+                'SQL into. Defaults to the "default" database.',
+        )
+
+    def handle(self, previous_type, **options):
+        from denorm.models import DirtyInstance
+
+        using = options['database']
+        if DirtyInstance.objects.using(using).exists():
+            raise CommandError("The dirty queue is not empty, run denorm_flush first.")
+
+        old_field = OBJECT_ID_FIELDS[previous_type]()
+        new_field = object_id_field()
+        for field in (old_field, new_field):
+            field.set_attributes_from_name('object_id')
+            field.model = DirtyInstance
+
+        connection = connections[using]
+        if connection.vendor == 'sqlite' and not connection.get_autocommit():
+            # SQLite rebuilds the table, which needs the foreign key checks
+            # disabled, and they can't be inside a transaction
+            raise CommandError("The column can't be converted inside a transaction on SQLite.")
+
+        # the triggers write to the table, which may be rebuilt
+        denorms.drop_triggers(using=using)
+        with connection.schema_editor() as editor:
+            editor.alter_field(DirtyInstance, old_field, new_field)
+        denorms.install_triggers(using=using)
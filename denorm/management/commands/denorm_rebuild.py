@@ -5,6 +5,50 @@ from denorm import denorms
 class Command(BaseCommand):
     help = "Recalculates the value of every single denormalized model field in the whole project."
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'model_name', nargs='?', default=None,
+            help='Only rebuild the models of this app label, model name or app_label.ModelName.',
+        )
+        parser.add_argument(
+            '--chunk-size', action='store', dest='chunk_size', type=int, default=None,
+            help='Mark (or with --direct rebuild) the instances in ranges of this many primary keys.',
+        )
+        parser.add_argument(
+            '--direct', action='store_true', dest='direct', default=False,
+            help='Rebuild the instances directly instead of marking them dirty. '
+                'An interrupted direct rebuild continues where it stopped.',
+        )
+        parser.add_argument(
+            '--shadow', action='store_true', dest='shadow', default=False,
+            help='Compute the values into a shadow table and swap them in at the end, '
+                'so reads only see a half rebuilt column during the swap. The swap is not '
+                'atomic: it runs in one transaction per chunk, and until it is done readers '
+                'see new values in the swapped chunks and old values in the others.',
+        )
+        parser.add_argument(
+            '--max-rows-per-sec', action='store', dest='max_rows_per_sec', type=float, default=None,
+            help='Rebuild at most this many instances per second (with --direct or --shadow).',
+        )
+        parser.add_argument(
+            '--workers', action='store', dest='workers', type=int, default=None,
+            help='Rebuild (with --direct) and flush the instances with this many parallel workers. '
+                'Ignored on sqlite.',
+        )
+        parser.add_argument(
+            '--executor', action='store', dest='executor', default='process', choices=['process', 'thread'],
+            help='Run the workers as processes (default) or threads.',
+        )
+
     def handle(self, model_name=None, *args, **kwargs):
         verbosity = int((kwargs.get('verbosity', 0)))
-        denorms.rebuildall(verbose=verbosity > 1, model_name=model_name)
+        denorms.rebuildall(
+            verbose=verbosity > 1,
+            model_name=model_name,
+            chunk_size=kwargs.get('chunk_size'),
+            direct=kwargs.get('direct', False),
+            max_rows_per_sec=kwargs.get('max_rows_per_sec'),
+            workers=kwargs.get('workers'),
+            executor=kwargs.get('executor', 'process'),
+            shadow=kwargs.get('shadow', False),
+        )
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from denorm import denorms
+
+
+class Command(BaseCommand):
+    help = "Finds the denormalized values that differ from their recalculated value and repairs them."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'model_name', nargs='?', default=None,
+            help='Only verify the models of this app label, model name or app_label.ModelName.',
+        )
+        parser.add_argument(
+            '--field', action='store', dest='field_name', default=None,
+            help='Only verify the denormalized fields with this name.',
+        )
+        parser.add_argument(
+            '--chunk-size', action='store', dest='chunk_size', type=int, default=1000,
+            help='Compare the values in ranges of this many primary keys.',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only report the wrong values instead of repairing them.',
+        )
+        parser.add_argument(
+            '--sample', action='store', dest='sample', type=int, default=None,
+            help='Only recalculate the fields other than counts and sums for about this many '
+                'instances of every model, spread over the table.',
+        )
+
+    def handle(self, model_name=None, *args, **kwargs):
+        verbosity = int(kwargs.get('verbosity', 1))
+        results = denorms.verifyall(
+            verbose=verbosity > 1,
+            model_name=model_name,
+            field_name=kwargs.get('field_name'),
+            chunk_size=kwargs.get('chunk_size') or 1000,
+            repair=not kwargs.get('dry_run', False),
+            sample=kwargs.get('sample'),
+            out=self.stdout,
+        )
+        if verbosity < 1:
+            return
+        for model, mismatches in results.items():
+            for fieldname, count in mismatches.items():
+                if count:
+                    self.stdout.write("%s wrong values of %s.%s.%s" % (count, model._meta.app_label, model._meta.object_name, fieldname))
+        total = sum(count for mismatches in results.values() for count in mismatches.values())
+        self.stdout.write("%s wrong values found" % total)
@@ -17,10 +17,13 @@ class DenormMiddleware(object):
 
     As usual the order of middleware classes matters. It makes a lot of sense to put ``DenormMiddleware``
     after ``TransactionMiddleware`` in your ``MIDDLEWARE_CLASSES`` setting.
+
+    Concurrent requests flush in batches, claiming the dirty instances they
+    process, so no instance is recalculated by two workers at once.
     """
     def process_response(self, request, response):
         try:
-            flush()
+            flush(concurrent=True)
         except DatabaseError as e:
             logger.error(e)
         return response
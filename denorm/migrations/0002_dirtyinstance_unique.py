@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicates(apps, schema_editor):
+    """
+    Keeps only the oldest marker for every object, so the unique
+    constraint can be created on a queue that already holds duplicates.
+    """
+    DirtyInstance = apps.get_model('denorm', 'DirtyInstance')
+    db_alias = schema_editor.connection.alias
+    duplicates = (
+        DirtyInstance.objects.using(db_alias)
+        .values('content_type', 'object_id')
+        .annotate(count=Count('pk'), first=Min('pk'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates:
+        DirtyInstance.objects.using(db_alias).filter(
+            content_type=duplicate['content_type'],
+            object_id=duplicate['object_id'],
+        ).exclude(pk=duplicate['first']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('denorm', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='dirtyinstance',
+            name='object_id',
+            field=models.CharField(max_length=255, null=True, blank=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dirtyinstance',
+            unique_together=set([('content_type', 'object_id')]),
+        ),
+    ]
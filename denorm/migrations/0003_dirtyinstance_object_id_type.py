@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the column stays text, denorm_object_id_type converts it to the type
+    # chosen with DENORM_OBJECT_ID_TYPE
+
+    dependencies = [
+        ('denorm', '0002_dirtyinstance_unique'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dirtyinstance',
+            name='object_id',
+            field=models.CharField(max_length=255, null=True, blank=True),
+        ),
+    ]
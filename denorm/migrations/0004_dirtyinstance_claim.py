@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('denorm', '0003_dirtyinstance_object_id_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dirtyinstance',
+            name='claim',
+            field=models.CharField(max_length=32, null=True, blank=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='dirtyinstance',
+            name='claimed_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+    ]
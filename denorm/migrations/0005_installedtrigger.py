@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('denorm', '0004_dirtyinstance_claim'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InstalledTrigger',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128, unique=True)),
+                ('table', models.CharField(max_length=128)),
+                ('checksum', models.CharField(max_length=32)),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def create_bypass_table(apps, schema_editor):
+    from denorm.db import get_backend
+    bypass = get_backend(schema_editor.connection.alias).TriggerBypass
+    if bypass.table_sql:
+        schema_editor.execute(bypass.table_sql)
+
+
+def drop_bypass_table(apps, schema_editor):
+    from denorm.db import get_backend
+    bypass = get_backend(schema_editor.connection.alias).TriggerBypass
+    if bypass.table_sql:
+        schema_editor.execute('DROP TABLE IF EXISTS %s' % schema_editor.quote_name(bypass.table))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('denorm', '0007_rebuildcheckpoint_shadow_table'),
+    ]
+
+    operations = [
+        # only needed by backends keeping the trigger bypass in a table
+        migrations.RunPython(create_bypass_table, drop_bypass_table),
+    ]
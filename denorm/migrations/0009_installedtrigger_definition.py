@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('denorm', '0008_bypass_table'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='installedtrigger',
+            name='definition',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
@@ -3,6 +3,8 @@ from django.db import models
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 
+from .helpers import object_id_field
+
 
 class DirtyInstance(models.Model):
     """
@@ -10,16 +12,71 @@ class DirtyInstance(models.Model):
     that needs to be recalculated.
     DirtyInstance instances are created by the insert/update/delete triggers
     when related objects change.
+    At most one DirtyInstance exists per object, the triggers skip the
+    insert if the object is already marked dirty.
+    The type of object_id is set with DENORM_OBJECT_ID_TYPE.
     """
     class Meta:
         app_label="denorm"
+        unique_together = (('content_type', 'object_id'),)
 
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
-    object_id = models.TextField(blank=True, null=True)
+    object_id = object_id_field()
     content_object = GenericForeignKey()
+    # set while a batched flush is processing this instance
+    claim = models.CharField(max_length=32, blank=True, null=True, db_index=True)
+    claimed_at = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
         return u'DirtyInstance: %s,%s' % (self.content_type, self.object_id)
 
     def __unicode__(self):
         return u'DirtyInstance: %s, %s' % (self.content_type, self.object_id)
+
+
+class InstalledTrigger(models.Model):
+    """
+    Records the triggers installed in the database together with a checksum
+    of their SQL, so that ``denorm.denorms.install_triggers`` only has to
+    replace the triggers that changed, and a checksum of their definition
+    in the database, to notice triggers changed by hand.
+    """
+    class Meta:
+        app_label="denorm"
+
+    name = models.CharField(max_length=128, unique=True)
+    table = models.CharField(max_length=128)
+    checksum = models.CharField(max_length=32)
+    definition = models.CharField(max_length=32, blank=True, default='')
+
+    def __str__(self):
+        return u'InstalledTrigger: %s' % self.name
+
+    def __unicode__(self):
+        return u'InstalledTrigger: %s' % self.name
+
+
+class RebuildCheckpoint(models.Model):
+    """
+    Records how far a direct rebuild got, so an interrupted rebuild
+    continues after the last completed chunk instead of starting over.
+    See ``denorm.denorms.rebuild_model``.
+    A shadow rebuild (see ``denorm.shadow``) also records the table it
+    computes the values into until they are swapped in.
+    """
+    class Meta:
+        app_label="denorm"
+
+    # identifies the rebuilt model and fields
+    name = models.CharField(max_length=255, unique=True)
+    # the primary key of the last rebuilt instance
+    last_pk = models.CharField(max_length=255)
+    rows = models.BigIntegerField(default=0)
+    shadow_table = models.CharField(max_length=128, blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return u'RebuildCheckpoint: %s' % self.name
+
+    def __unicode__(self):
+        return u'RebuildCheckpoint: %s' % self.name
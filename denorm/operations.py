@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Migration operations installing the triggers of django-denorm and filling
+newly added denormalized fields.
+
+The SQL of the triggers is rendered when the migration is created, see the
+``denorm_makemigrations`` command. Content type ids differ between databases,
+so they are stored as ``{content_type:<app_label>.<model>}`` tokens and only
+resolved when the migration is applied.
+"""
+import re
+import warnings
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.db.migrations.operations.base import Operation
+import six
+
+CONTENT_TYPE_TOKEN = '{content_type:%s.%s}'
+CONTENT_TYPE_TOKEN_RE = re.compile(r'\{content_type:(\w+)\.(\w+)\}')
+
+
+def render_triggers(using=None):
+    """
+    Returns the vendor of the database and a dict mapping every table with
+    triggers to a list of ``(name, sql, params)`` of its triggers, with the
+    content type ids replaced by tokens.
+    """
+    from . import denorms
+
+    manager = ContentType.objects
+    db = manager.db
+    cache = manager._cache.pop(db, None)
+    try:
+        # the tokens stand in for the ids, so they end up in the SQL as they
+        # are and can't be mistaken for anything else in it
+        for model in apps.get_models(include_auto_created=True):
+            opts = model._meta
+            content_type = ContentType(
+                pk=CONTENT_TYPE_TOKEN % (opts.app_label, opts.model_name),
+                app_label=opts.app_label, model=opts.model_name,
+            )
+            manager._add_to_cache(db, content_type)
+        triggerset = denorms.build_triggerset(using=using)
+
+        tables = {}
+        for trigger in triggerset.triggers.values():
+            sql, params = trigger.sql()
+            # the name in the database depends on the content type ids
+            sql = sql.replace(trigger.db_name(), '{name}')
+            tables.setdefault(trigger.db_table, []).append((trigger.name(), sql, tuple(params)))
+    finally:
+        manager._cache.pop(db, None)
+        if cache is not None:
+            manager._cache[db] = cache
+
+    for triggers in tables.values():
+        triggers.sort()
+    return triggerset.connection.vendor, tables
+
+
+def resolve_triggers(triggerset, table, triggers):
+    """
+    Returns the ``TriggerSet.desired`` dict of the rendered ``triggers`` on
+    ``table``, with the content type tokens replaced by the ids in the
+    database of ``triggerset``.
+    """
+    manager = ContentType.objects.db_manager(triggerset.connection.alias)
+    ids = {}
+
+    def resolve(value):
+        if not isinstance(value, six.string_types):
+            return value
+
+        def content_type_id(match):
+            if match.group(0) not in ids:
+                content_type, created = manager.get_or_create(app_label=match.group(1), model=match.group(2))
+                ids[match.group(0)] = str(content_type.pk)
+            return ids[match.group(0)]
+        return CONTENT_TYPE_TOKEN_RE.sub(content_type_id, value)
+
+    desired = {}
+    for name, sql, params in triggers:
+        name = triggerset.db_name(resolve(name))
+        sql = resolve(sql).replace('{name}', name)
+        params = tuple(resolve(param) for param in params)
+        desired[name] = (table, sql, params, triggerset.checksum(sql, params), set())
+    return desired
+
+
+def install_table_triggers(connection, table, triggers):
+    """
+    Makes the denorm triggers on ``table`` match the rendered ``triggers``.
+    """
+    from .db import get_backend
+
+    backend = get_backend(connection.alias)
+    triggerset = backend.TriggerSet(using=connection.alias)
+    cursor = triggerset.cursor()
+    triggerset.prepare(cursor)
+    desired = resolve_triggers(triggerset, table, triggers)
+    installed = dict((name, t) for name, t in triggerset.installed().items() if t == table)
+    triggerset.apply(cursor, desired, installed, *triggerset.diff(desired, installed))
+
+
+class InstallDenormTriggers(Operation):
+    """
+    Installs the given triggers on a table, replacing the denorm triggers
+    it had before. Only applied to databases of the vendor the triggers
+    were rendered for, on others it warns and does nothing. Reversing it
+    drops the triggers of the table.
+    """
+    reduces_to_sql = False
+    reversible = True
+
+    def __init__(self, table, triggers, vendor):
+        self.table = table
+        self.triggers = triggers
+        self.vendor = vendor
+
+    def deconstruct(self):
+        return (
+            self.__class__.__name__,
+            [],
+            {'table': self.table, 'triggers': self.triggers, 'vendor': self.vendor},
+        )
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def applies_to(self, connection):
+        if connection.vendor == self.vendor:
+            return True
+        warnings.warn(
+            "The denorm triggers of %s were rendered for %s and are not applied to %s. "
+            "Run denorm_makemigrations against a %s database or denorm_init." % (
+                self.table, self.vendor, connection.vendor, connection.vendor),
+            RuntimeWarning,
+        )
+        return False
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if self.applies_to(schema_editor.connection):
+            install_table_triggers(schema_editor.connection, self.table, self.triggers)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if self.applies_to(schema_editor.connection):
+            install_table_triggers(schema_editor.connection, self.table, [])
+
+    def describe(self):
+        return "Install denorm triggers on %s" % self.table
+
+
+class DropDenormTriggers(InstallDenormTriggers):
+    """
+    Drops the denorm triggers of a table. Reversing it installs the given
+    triggers again.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        super(DropDenormTriggers, self).database_backwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        super(DropDenormTriggers, self).database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def describe(self):
+        return "Drop denorm triggers on %s" % self.table
+
+
+class BackfillDenormField(Operation):
+    """
+    Computes the values of the denormalized field ``name`` of the model
+    ``model_name`` of the migration's app, for a field added by an earlier
+    operation. Only this field is written.
+
+    The instances are processed in chunks of ``chunk_size`` primary keys,
+    at most ``max_rows_per_sec`` instances per second and with a pause of
+    ``sleep`` seconds after every chunk, see
+    ``denorm.denorms.rebuild_model``. Counts and sums are computed with one
+    set based UPDATE per chunk, other fields with their function.
+
+    Every chunk is a transaction of its own and the progress is saved in a
+    ``RebuildCheckpoint`` if the migration is not atomic (``atomic =
+    False`` on the migration), so a failed backfill continues where it
+    stopped when the migration is applied again. ``atomic`` works like the
+    one of ``RunPython``.
+
+    The function of the field is taken from the current model, not the
+    historical one, so the backfill has to run before later migrations
+    change the columns it reads. Reversing it does nothing, the field is
+    removed by reversing the operation that added it.
+    """
+    reduces_to_sql = False
+    reversible = True
+
+    def __init__(self, model_name, name, chunk_size=1000, max_rows_per_sec=None, sleep=None, atomic=None):
+        self.model_name = model_name
+        self.name = name
+        self.chunk_size = chunk_size
+        self.max_rows_per_sec = max_rows_per_sec
+        self.sleep = sleep
+        self.atomic = atomic
+
+    def deconstruct(self):
+        kwargs = {'model_name': self.model_name, 'name': self.name}
+        if self.chunk_size != 1000:
+            kwargs['chunk_size'] = self.chunk_size
+        for key in ('max_rows_per_sec', 'sleep', 'atomic'):
+            if getattr(self, key) is not None:
+                kwargs[key] = getattr(self, key)
+        return (self.__class__.__name__, [], kwargs)
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        from .denorms import rebuild_model
+
+        model = apps.get_model(app_label, self.model_name)
+        alias = schema_editor.connection.alias
+        if not self.allow_migrate_model(alias, model):
+            return
+        denorm = getattr(model._meta.get_field(self.name), 'denorm', None)
+        if denorm is None:
+            raise ValueError("%s.%s.%s is not a denormalized field" % (model._meta.app_label, model._meta.object_name, self.name))
+        rebuild_model(
+            model,
+            denorms=[denorm],
+            using=alias,
+            chunk_size=self.chunk_size,
+            max_rows_per_sec=self.max_rows_per_sec,
+            sleep=self.sleep,
+        )
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        pass
+
+    def describe(self):
+        return "Backfill denormalized field %s on %s" % (self.name, self.model_name)
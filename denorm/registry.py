@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+
+from django.apps import apps
+from django.db.models import ManyToManyField
+from django.db.models.signals import class_prepared
+
+from .helpers import remote_field_model
+
+
+class DenormRegistry(object):
+    """
+    Index of all denormalizations of the project.
+
+    The index is built once the app registry is ready (see
+    ``denorm.apps.DenormConfig``) and is only rebuilt when a model is
+    created afterwards. It maps
+
+    * every model to the denorms declared in its fields,
+    * every table to the denorms that a write to this table affects and
+    * every model to the models whose denormalized fields depend on it.
+    """
+
+    def __init__(self):
+        self.clear()
+        class_prepared.connect(self.model_prepared)
+
+    def clear(self):
+        self.built = False
+        self.denorms = []
+        self.by_model = OrderedDict()
+        self.by_table = OrderedDict()
+        self.graph = OrderedDict()
+        self.m2ms = {}
+
+    def model_prepared(self, sender, **kwargs):
+        # Models may be created after the app registry is ready (e.g. in tests)
+        if self.built:
+            self.clear()
+
+    def build(self):
+        self.clear()
+        seen = set()
+        for model in apps.get_models(include_auto_created=True):
+            if model._meta.proxy:
+                continue
+            denorms = self.by_model.setdefault(model, [])
+            for field in model._meta.fields:
+                denorm = getattr(field, 'denorm', None)
+                if denorm is None or denorm.model._meta.swapped:
+                    continue
+                denorms.append(denorm)
+                if id(denorm) not in seen:
+                    seen.add(id(denorm))
+                    self.add(denorm)
+        self.built = True
+
+    def add(self, denorm):
+        self.denorms.append(denorm)
+        self.graph.setdefault(denorm.model, OrderedDict())
+        for related_model in self.related_models(denorm):
+            self.graph.setdefault(related_model, OrderedDict())[denorm.model] = None
+        for table in self.source_tables(denorm):
+            denorms = self.by_table.setdefault(table, [])
+            if denorm not in denorms:
+                denorms.append(denorm)
+
+    def related_models(self, denorm):
+        """
+        Returns the models a change of which may change ``denorm``.
+        """
+        related_models = [getattr(dependency, 'other_model', None) for dependency in getattr(denorm, 'depend', [])]
+        related_field = self.aggregate_field(denorm)
+        if related_field is not None:
+            related_models.append(related_field.model)
+        return [model for model in related_models if isinstance(model, type)]
+
+    def source_tables(self, denorm):
+        """
+        Returns the tables the triggers of ``denorm`` are installed on.
+        """
+        try:
+            from django.contrib.contenttypes.fields import GenericRelation
+        except ImportError:  # Django<1.7
+            from django.contrib.contenttypes.generic import GenericRelation
+
+        tables = [model._meta.db_table for model in self.related_models(denorm)]
+        fields = [getattr(dependency, 'field', None) for dependency in getattr(denorm, 'depend', [])]
+        fields.append(self.aggregate_field(denorm))
+        for field in fields:
+            if isinstance(field, ManyToManyField):
+                tables.append(field.m2m_db_table())
+            elif isinstance(field, GenericRelation):
+                tables.append(remote_field_model(field)._meta.db_table)
+        return tables
+
+    def aggregate_field(self, denorm):
+        manager = getattr(denorm, 'manager', None)
+        if manager is None:
+            return None
+        try:  # Django>=1.9
+            return manager.field
+        except AttributeError:
+            return manager.related.field
+
+    def ensure_built(self):
+        if not self.built:
+            self.build()
+
+    def all(self):
+        """
+        Returns all denorms.
+        """
+        self.ensure_built()
+        return list(self.denorms)
+
+    def for_model(self, model):
+        """
+        Returns the denorms in the fields of ``model``, including the
+        fields it inherited.
+        """
+        self.ensure_built()
+        if model not in self.by_model:
+            model = model._meta.concrete_model
+        return self.by_model.get(model, [])
+
+    def for_table(self, table):
+        """
+        Returns the denorms that a write to ``table`` affects.
+        """
+        self.ensure_built()
+        return self.by_table.get(table, [])
+
+    def dependents(self, model):
+        """
+        Returns the models whose denormalized fields depend on ``model``.
+        """
+        self.ensure_built()
+        return list(self.graph.get(model, ()))
+
+    def dependency_graph(self):
+        self.ensure_built()
+        return OrderedDict((model, OrderedDict(dependents)) for model, dependents in self.graph.items())
+
+    def m2m_fields(self, model):
+        """
+        Returns the denormalized ManyToManyFields declared on ``model``.
+        """
+        try:
+            return self.m2ms[model]
+        except KeyError:
+            m2ms = self.m2ms[model] = [m2m for m2m in model._meta.local_many_to_many if hasattr(m2m, 'denorm')]
+            return m2ms
+
+
+registry = DenormRegistry()
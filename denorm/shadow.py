@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Rebuilds denormalized fields with only a short window of mixed reads.
+
+The values are computed chunk by chunk into a shadow table keyed by the
+primary key, while the live column keeps its old values. Along with every
+new value the shadow stores the live value it was computed against. The
+flush writes the values it changes to the shadow as well, so the changes
+made while the shadow is built are not lost. Finally the shadow
+is swapped in with one UPDATE per field and chunk of primary keys:
+
+* callback fields take the new value where the live value is still the
+  one it was computed against; a live value written since then (by a
+  flush or ``save()``) is newer and wins.
+* counts and sums are kept up to date by the triggers incrementally, so
+  they are corrected by the difference between the new and the old value.
+
+The swap only writes the rows whose value changed. Every chunk is
+swapped in a short transaction of its own and its rows are removed from
+the shadow, so an interrupted swap continues where it stopped. While the
+swap runs, readers see the new values of the chunks swapped so far and
+the old values of the others; every row is swapped as a whole. Swapping
+in a single transaction instead would lock all rows of the table until
+the end.
+"""
+import hashlib
+
+from django.contrib import contenttypes
+from django.db import connections, router, transaction
+from django.db.backends.utils import truncate_name
+from django.utils.encoding import force_bytes, force_text
+
+from .db import get_backend
+from .helpers import chunked, in_pk_range, pk_ranges, Throttle
+
+SHADOW_SUFFIX = '@shadow'
+
+
+def checkpoint_name(model, fieldnames=None):
+    """
+    Returns the name of the ``RebuildCheckpoint`` of the shadow rebuild of
+    ``fieldnames`` (all fields if None) of ``model``.
+    """
+    return '%s.%s:%s%s' % (
+        model._meta.app_label, model._meta.model_name,
+        '*' if fieldnames is None else ','.join(sorted(fieldnames)), SHADOW_SUFFIX,
+    )
+
+
+def shadow_denorms(model, name):
+    """
+    Returns the denorms rebuilt by the shadow rebuild ``name``, in the
+    order of the columns of its shadow table.
+    """
+    from .denorms import get_rebuild_denorms
+    fieldnames = name.split(':', 1)[1][:-len(SHADOW_SUFFIX)]
+    fieldnames = None if fieldnames == '*' else fieldnames.split(',')
+    return sorted(get_rebuild_denorms(model, fieldnames), key=lambda denorm: denorm.fieldname)
+
+
+def active_shadows(using):
+    """
+    Returns a dict mapping the models with shadow rebuilds in progress to
+    a list of ``(table, denorms)`` of these rebuilds, with one query.
+    """
+    from django.apps import apps
+    from .models import RebuildCheckpoint
+    shadows = {}
+    checkpoints = RebuildCheckpoint.objects.using(using).filter(name__endswith=SHADOW_SUFFIX).exclude(shadow_table='')
+    for checkpoint in checkpoints:
+        model = apps.get_model(checkpoint.name.split(':', 1)[0])
+        shadows.setdefault(model, []).append((checkpoint.shadow_table, shadow_denorms(model, checkpoint.name)))
+    return shadows
+
+
+def create_shadow(model, denorms, name, using):
+    """
+    Creates the shadow table of the rebuild ``name`` and returns its name.
+    It has a ``new_<i>`` and an ``old_<i>`` column for every denorm.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = truncate_name(
+        '%s_shadow_%s' % (model._meta.db_table, hashlib.md5(force_bytes(name)).hexdigest()[:8]),
+        connection.ops.max_name_length(),
+    )
+    pk = model._meta.pk
+    columns = ['%s %s PRIMARY KEY' % (qn('pk'), getattr(pk, 'rel_db_type', pk.db_type)(connection))]
+    for i, denorm in enumerate(denorms):
+        db_type = model._meta.get_field(denorm.fieldname).db_type(connection)
+        columns.append('%s %s NULL' % (qn('new_%s' % i), db_type))
+        columns.append('%s %s NULL' % (qn('old_%s' % i), db_type))
+    cursor = connection.cursor()
+    if table in connection.introspection.table_names(cursor):
+        cursor.execute('DROP TABLE %s' % qn(table))
+    cursor.execute('CREATE TABLE %s (%s)' % (qn(table), ', '.join(columns)))
+    return table
+
+
+def shadow_pks(connection, table, lower=None, upper=None):
+    """
+    Returns the primary keys in the range ``(lower, upper]`` the shadow
+    ``table`` has a row for.
+    """
+    qn = connection.ops.quote_name
+    where, params = [], []
+    if lower is not None:
+        where.append('%s > %%s' % qn('pk'))
+        params.append(lower)
+    if upper is not None:
+        where.append('%s <= %%s' % qn('pk'))
+        params.append(upper)
+    cursor = connection.cursor()
+    cursor.execute('SELECT %s FROM %s%s' % (
+        qn('pk'), qn(table), ' WHERE ' + ' AND '.join(where) if where else ''), params)
+    return set(row[0] for row in cursor.fetchall())
+
+
+def fill_shadow(model, denorms, table, lower=None, upper=None, using=None):
+    """
+    Computes ``denorms`` of the instances of ``model`` in the primary key
+    range ``(lower, upper]`` into the shadow ``table`` and returns their
+    number. Counts and sums are computed in the query loading the
+    instances, the other fields with their functions. Nothing is written
+    to the instances.
+
+    The callback fields of rows the flush has already written to the
+    shadow are kept, they are at least as new.
+    """
+    from .denorms import rebuilds_in_sql, update_denorms
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = [model._meta.get_field(denorm.fieldname) for denorm in denorms]
+    aggregates = dict(
+        (i, 'denorm_shadow_%s' % i) for i, denorm in enumerate(denorms) if rebuilds_in_sql(denorm))
+    callbacks = [denorm for i, denorm in enumerate(denorms) if i not in aggregates]
+
+    chunk = in_pk_range(model._base_manager.using(using), lower, upper).order_by('pk')
+    chunk = chunk.annotate(**dict(
+        (alias, denorms[i].get_rebuild_value()) for i, alias in aggregates.items()))
+    with transaction.atomic(using=using):
+        existing = shadow_pks(connection, table, lower, upper)
+        inserts, updates = [], []
+        for instance in chunk:
+            old = [getattr(instance, field.attname) for field in fields]
+            for i, alias in aggregates.items():
+                setattr(instance, fields[i].attname, getattr(instance, alias))
+            update_denorms(model, instance, callbacks)
+            new = [getattr(instance, field.attname) for field in fields]
+            pk = model._meta.pk.get_db_prep_save(instance.pk, connection)
+            if pk in existing:
+                updates.append([
+                    prep for i in sorted(aggregates)
+                    for prep in (fields[i].get_db_prep_save(new[i], connection), fields[i].get_db_prep_save(old[i], connection))
+                ] + [pk])
+            else:
+                inserts.append([pk] + [
+                    prep for i, field in enumerate(fields)
+                    for prep in (field.get_db_prep_save(new[i], connection), field.get_db_prep_save(old[i], connection))
+                ])
+
+        cursor = connection.cursor()
+        if inserts:
+            columns = [qn('pk')] + [qn('%s_%s' % (c, i)) for i in range(len(fields)) for c in ('new', 'old')]
+            cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+                qn(table), ', '.join(columns), ', '.join(['%s'] * len(columns))), inserts)
+        if updates and aggregates:
+            sets = ', '.join('%s = %%s' % qn('%s_%s' % (c, i)) for i in sorted(aggregates) for c in ('new', 'old'))
+            cursor.executemany('UPDATE %s SET %s WHERE %s = %%s' % (qn(table), sets, qn('pk')), updates)
+    return len(inserts) + len(updates)
+
+
+def sync_shadows(model, instances, denorms=None, using=None, cache=None, changed=None):
+    """
+    Writes the current values of the recalculated callback ``denorms``
+    (all callback denorms by default) of ``instances`` to the shadow
+    tables of the shadow rebuilds of ``model`` in progress. Called by the
+    flush after recalculating the instances.
+
+    Only the instances in ``changed`` (all by default) get a shadow row.
+    The others are unchanged, a row is only written for them if the shadow
+    already has one, which may hold a value computed before the last change.
+
+    The rebuilds in progress are looked up once per database and kept in
+    the dict ``cache``, if given. A flush or rebuild passes the same dict
+    for all the instances it recalculates.
+    """
+    from .denorms import get_flush_denorms, rebuilds_in_sql
+    using = using or router.db_for_write(model)
+    if cache is None:
+        cache = {}
+    if using not in cache:
+        cache[using] = active_shadows(using)
+    shadows = cache[using].get(model)
+    if not shadows:
+        return
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    instances = list(instances)
+    if changed is not None:
+        changed = set(id(instance) for instance in changed)
+    recalculated = set(denorm.fieldname for denorm in (get_flush_denorms(model) if denorms is None else denorms))
+    pk_field = model._meta.pk
+    with transaction.atomic(using=using):
+        cursor = connection.cursor()
+        for table, shadow in shadows:
+            columns = [
+                (i, model._meta.get_field(denorm.fieldname)) for i, denorm in enumerate(shadow)
+                if denorm.fieldname in recalculated and not rebuilds_in_sql(denorm)
+            ]
+            if not columns:
+                continue
+            names = [qn('%s_%s' % (c, i)) for i, field in columns for c in ('new', 'old')]
+            for batch in chunked(instances, 500):
+                pks = [pk_field.get_db_prep_save(instance.pk, connection) for instance in batch]
+                cursor.execute('SELECT %s FROM %s WHERE %s IN (%s)' % (
+                    qn('pk'), qn(table), qn('pk'), ', '.join(['%s'] * len(pks))), pks)
+                existing = set(row[0] for row in cursor.fetchall())
+                inserts, updates = [], []
+                for pk, instance in zip(pks, batch):
+                    # the live value is the new one now
+                    values = [
+                        field.get_db_prep_save(getattr(instance, field.attname), connection)
+                        for i, field in columns for c in ('new', 'old')
+                    ]
+                    if pk in existing:
+                        updates.append(values + [pk])
+                    elif changed is None or id(instance) in changed:
+                        inserts.append([pk] + values)
+                if inserts:
+                    cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+                        qn(table), ', '.join([qn('pk')] + names), ', '.join(['%s'] * (len(names) + 1))), inserts)
+                if updates:
+                    cursor.executemany('UPDATE %s SET %s WHERE %s = %%s' % (
+                        qn(table), ', '.join('%s = %%s' % name for name in names), qn('pk')), updates)
+
+
+def swap_shadow(model, denorms, table, using=None, chunk_size=None):
+    """
+    Writes the values of the shadow ``table`` to the live columns, in one
+    transaction per chunk of ``chunk_size`` primary keys (or in a single
+    transaction), and removes the swapped rows from the shadow, see the
+    module documentation. Returns the number of written values.
+    """
+    from .denorms import bypass_token, rebuilds_in_sql
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    triggers = get_backend(using)
+    content_type = contenttypes.models.ContentType.objects.db_manager(using).get_for_model(model)
+    live = qn(model._meta.db_table)
+    shadow = qn(table)
+    join = '%s.%s = %s.%s' % (shadow, qn('pk'), live, qn(model._meta.pk.column))
+
+    def equal(a, b):
+        return '((%(a)s = %(b)s AND %(a)s IS NOT NULL AND %(b)s IS NOT NULL) OR (%(a)s IS NULL AND %(b)s IS NULL))' % locals()
+
+    if chunk_size:
+        ranges = pk_ranges(model._base_manager.using(using), chunk_size)
+    else:
+        ranges = [(None, None)]
+    written = 0
+    for lower, upper in ranges:
+        bounds, params = [], []
+        if lower is not None:
+            bounds.append('%s.%s > %%s' % (shadow, qn('pk')))
+            params.append(model._meta.pk.get_db_prep_value(lower, connection))
+        if upper is not None:
+            bounds.append('%s.%s <= %%s' % (shadow, qn('pk')))
+            params.append(model._meta.pk.get_db_prep_value(upper, connection))
+        with transaction.atomic(using=using):
+            with triggers.TriggerBypass(bypass_token(content_type.pk), using=using):
+                cursor = connection.cursor()
+                for i, denorm in enumerate(denorms):
+                    column = qn(model._meta.get_field(denorm.fieldname).column)
+                    new = '%s.%s' % (shadow, qn('new_%s' % i))
+                    old = '%s.%s' % (shadow, qn('old_%s' % i))
+                    current = '%s.%s' % (live, column)
+                    if rebuilds_in_sql(denorm):
+                        value = '%s + (SELECT %s - %s FROM %s WHERE %s)' % (column, new, old, shadow, join)
+                        where = '%s <> %s' % (new, old)
+                    else:
+                        value = '(SELECT %s FROM %s WHERE %s)' % (new, shadow, join)
+                        where = '%s AND NOT %s' % (equal(old, current), equal(new, current))
+                    cursor.execute('UPDATE %s SET %s = %s WHERE EXISTS (SELECT 1 FROM %s WHERE %s)' % (
+                        live, column, value, shadow, ' AND '.join([join, where] + bounds)), params)
+                    written += max(cursor.rowcount, 0)
+                # counts and sums must not be corrected twice
+                cursor.execute('DELETE FROM %s%s' % (shadow, ' WHERE ' + ' AND '.join(bounds) if bounds else ''), params)
+    return written
+
+
+def drop_shadow(table, using):
+    """
+    Drops the shadow ``table``. Not part of the swap, as some databases
+    (e.g. MySQL) commit the running transaction when a table is dropped.
+    """
+    connection = connections[using]
+    if table in connection.introspection.table_names():
+        connection.cursor().execute('DROP TABLE %s' % connection.ops.quote_name(table))
+
+
+def rebuild_shadow(model, denorms=None, using=None, chunk_size=1000, max_rows_per_sec=None, verbose=False):
+    """
+    Recalculates ``denorms`` (all denormalized fields but the cache keys
+    by default) of every instance of ``model`` into a shadow table and
+    swaps them in at the end, see the module documentation.
+
+    Like ``denorm.denorms.rebuild_model`` the shadow is filled in chunks
+    of ``chunk_size`` primary keys, at most ``max_rows_per_sec`` instances
+    per second, and an interrupted rebuild continues after the last
+    completed chunk. The swap runs in chunks of the same size. Returns the
+    number of written values.
+    """
+    from .models import RebuildCheckpoint
+    using = using or router.db_for_write(model)
+    name = checkpoint_name(model, None if denorms is None else [denorm.fieldname for denorm in denorms])
+    denorms = shadow_denorms(model, name)
+
+    checkpoints = RebuildCheckpoint.objects.using(using)
+    checkpoint = checkpoints.filter(name=name).first()
+    if checkpoint is None:
+        table = create_shadow(model, denorms, name, using)
+        checkpoint = checkpoints.create(name=name, last_pk='', shadow_table=table)
+        lower = None
+    else:
+        table = checkpoint.shadow_table
+        lower = model._meta.pk.to_python(checkpoint.last_pk) if checkpoint.last_pk else None
+
+    throttle = Throttle(max_rows_per_sec)
+    rows = checkpoint.rows
+    for lower, upper in pk_ranges(model._base_manager.using(using), chunk_size, lower):
+        count = fill_shadow(model, denorms, table, lower, upper, using=using)
+        rows += count
+        if upper is not None:
+            checkpoints.filter(name=name).update(last_pk=force_text(upper), rows=rows)
+        if verbose:
+            print('computed', rows, 'instances of', model, 'into', table)
+        throttle.wait(count)
+
+    written = swap_shadow(model, denorms, table, using=using, chunk_size=chunk_size)
+    # the flush stops writing to the shadow
+    checkpoints.filter(name=name).delete()
+    drop_shadow(table, using)
+    if verbose:
+        print('swapped in', written, 'values of', model)
+    return written
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_app', '0004_auto_20160306_1822'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ForumBadge',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('forum_title', models.CharField(editable=False, max_length=255)),
+                ('forum', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='test_app.Forum')),
+            ],
+        ),
+    ]
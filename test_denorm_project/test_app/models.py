@@ -159,6 +159,16 @@ class Post(TaggedModel):
         return rcount
 
 
+class ForumBadge(models.Model):
+    forum = models.ForeignKey(Forum, on_delete=models.CASCADE)
+
+    # Only changes of the forum title matter
+    @denormalized(models.CharField, max_length=255)
+    @depend_on_related(Forum, fields=["title"])
+    def forum_title(self):
+        return self.forum.title
+
+
 class PostExtend(models.Model):
     # Test also OneToOneField
     post = models.OneToOneField('Post', on_delete=models.CASCADE)
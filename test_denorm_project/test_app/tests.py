@@ -1,7 +1,11 @@
-from django.db import connection
-from django.test import TestCase, TransactionTestCase
+from django.db import connection, transaction, IntegrityError
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.contrib.contenttypes.models import ContentType
 from django.core.management import call_command
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from multiprocessing.pool import ThreadPool
+from unittest import skipIf, skipUnless
 
 from django.contrib.auth import get_user_model
 User = get_user_model()
@@ -9,7 +13,10 @@ User = get_user_model()
 import denorm
 from denorm import denorms
 from test_app import models
+import datetime
 import django
+import warnings
+from six import StringIO
 from decimal import Decimal
 
 # Use all but denorms in FailingTriggers models by default
@@ -34,6 +41,104 @@ class TestTriggers(TestCase):
             denorms.alldenorms = alldenorms
 
 
+class TestStatementTriggers(TestCase):
+    def test_transition_sql(self):
+        from denorm.db.postgresql import triggers
+        self.assertEqual(
+            triggers.transition_sql('"t"."id" = NEW."fk" OR "t"."id" = OLD."fk" OR RENEW.x'),
+            '"t"."id" = denorm_new."fk" OR "t"."id" = denorm_old."fk" OR RENEW.x',
+        )
+
+    def test_row_level_fallback(self):
+        from denorm.db.postgresql import triggers
+        action = triggers.TriggerActionUpdate(
+            model=models.Forum,
+            columns=('post_count',),
+            values=('post_count + 1',),
+            where='id = NEW.forum_id',
+        )
+        self.assertIsNone(action.statement_sql('denorm_new', 'TRUE'))
+        action = triggers.TriggerActionUpdate(
+            model=models.Forum,
+            columns=('post_count',),
+            values=('post_count + 1',),
+            where=('id = NEW.forum_id', []),
+            deltas=('1',),
+        )
+        sql, params = action.statement_sql('denorm_new', 'TRUE')
+        self.assertIn('SUM(1)', sql)
+        self.assertIn('id = denorm_new.forum_id', sql)
+
+
+@skipUnless(connection.vendor == 'postgresql', "statement level triggers are only used on PostgreSQL")
+@override_settings(DENORM_STATEMENT_TRIGGERS=True)
+class TestStatementTriggersBulk(TransactionTestCase):
+    def setUp(self):
+        denorms.install_triggers()
+
+    def tearDown(self):
+        with override_settings(DENORM_STATEMENT_TRIGGERS=False):
+            denorms.install_triggers()
+
+    def markers(self, model):
+        content_type = ContentType.objects.get_for_model(model)
+        return set(
+            str(object_id) for object_id in
+            denorm.models.DirtyInstance.objects.filter(content_type=content_type).values_list('object_id', flat=True)
+        )
+
+    def test_bulk_changes(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        f2 = models.Forum.objects.create(title="forumtwo")
+        denorm.flush()
+
+        models.Post.objects.bulk_create([models.Post(forum=f1, title=str(i)) for i in range(3)])
+        models.Post.objects.bulk_create([models.Post(forum=f2, title="3")])
+        self.assertEqual(models.Forum.objects.get(pk=f1.pk).post_count, 3)
+        self.assertEqual(models.Forum.objects.get(pk=f2.pk).post_count, 1)
+        post_ids = set(str(pk) for pk in models.Post.objects.values_list('pk', flat=True))
+        self.assertEqual(self.markers(models.Post), post_ids)
+        self.assertEqual(self.markers(models.Forum), set([str(f1.pk), str(f2.pk)]))
+        denorm.flush()
+
+        models.Post.objects.filter(forum=f1).update(forum=f2)
+        self.assertEqual(models.Forum.objects.get(pk=f1.pk).post_count, 0)
+        self.assertEqual(models.Forum.objects.get(pk=f2.pk).post_count, 4)
+        self.assertEqual(self.markers(models.Post), post_ids)
+        denorm.flush()
+
+        # a changed primary key is a deleted and an inserted row
+        post = models.Post.objects.get(title="0")
+        moved = post.pk + 1000
+        models.Post.objects.filter(pk=post.pk).update(id=moved, forum=f1)
+        self.assertEqual(models.Forum.objects.get(pk=f1.pk).post_count, 1)
+        self.assertEqual(models.Forum.objects.get(pk=f2.pk).post_count, 3)
+        self.assertEqual(self.markers(models.Post), set([str(moved)]))
+        self.assertFalse(denorm.models.DirtyInstance.objects.filter(object_id__isnull=True).exists())
+        denorm.flush()
+
+        models.Post.objects.filter(forum=f2).delete()
+        self.assertEqual(models.Forum.objects.get(pk=f1.pk).post_count, 1)
+        self.assertEqual(models.Forum.objects.get(pk=f2.pk).post_count, 0)
+        self.assertIn(str(f2.pk), self.markers(models.Forum))
+        denorm.flush()
+        self.assertEqual(models.Forum.objects.get(pk=f2.pk).author_names, '')
+
+    def test_old_server(self):
+        def statement_triggers():
+            sql = [trigger.sql()[0] for trigger in denorms.build_triggerset().triggers.values()]
+            return [s for s in sql if 'FOR EACH STATEMENT' in s]
+
+        self.assertTrue(statement_triggers())
+        # transition tables need PostgreSQL 10
+        pg_version = connection.pg_version
+        connection.pg_version = 90600
+        try:
+            self.assertEqual(statement_triggers(), [])
+        finally:
+            connection.pg_version = pg_version
+
+
 class TestCached(TestCase):
     def setUp(self):
         denorms.drop_triggers()
@@ -429,6 +534,248 @@ class TestDenormalisation(TransactionTestCase):
         self.assertEqual(f1.post_count, 1)
         self.assertEqual(f1.authors.all()[0], m1)
 
+    def test_mark_all_dirty(self):
+        forums = [models.Forum.objects.create(title="forum%s" % i) for i in range(5)]
+        denorm.flush()
+        content_type = ContentType.objects.get_for_model(models.Forum)
+        dirty = denorm.models.DirtyInstance.objects.filter(content_type=content_type)
+        dirty.create(content_type=content_type, object_id=forums[0].pk, claim='token')
+
+        # one statement per chunk, without loading any instance
+        with CaptureQueriesContext(connection) as queries:
+            denorms.mark_all_dirty(models.Forum, chunk_size=2)
+        self.assertFalse([q for q in queries.captured_queries if 'SELECT "test_app_forum"."title"' in q['sql']])
+        self.assertEqual(len([q for q in queries.captured_queries if q['sql'].startswith('INSERT')]), 3)
+        self.assertEqual(sorted(int(pk) for pk in dirty.values_list('object_id', flat=True)), [f.pk for f in forums])
+        # the claim of an existing marker is dropped
+        self.assertFalse(dirty.exclude(claim=None).exists())
+
+        denorms.mark_all_dirty(models.Forum)
+        self.assertEqual(dirty.count(), 5)
+
+        call_command('denorm_rebuild', 'Forum', chunk_size=2)
+        self.assertEqual(denorm.models.DirtyInstance.objects.count(), 0)
+
+    def test_direct_rebuild(self):
+        forums = [models.Forum.objects.create(title="forum%s" % i) for i in range(5)]
+        for forum in forums:
+            models.Post.objects.create(forum=forum)
+        denorm.flush()
+        denorms.drop_triggers()
+        models.Forum.objects.update(post_count=7, path='')
+        denorms.install_triggers()
+        checkpoint = denorm.models.RebuildCheckpoint.objects.create(
+            name='test_app.forum:post_count', last_pk=str(forums[2].pk), rows=3)
+
+        # an interrupted rebuild continues after the checkpoint
+        rows = denorms.rebuild_model(models.Forum, denorms=[models.Forum._meta.get_field('post_count').denorm], chunk_size=1)
+        self.assertEqual(rows, 5)
+        self.assertEqual(list(models.Forum.objects.order_by('pk').values_list('post_count', flat=True)), [7, 7, 7, 1, 1])
+        self.assertEqual(list(models.Forum.objects.values_list('path', flat=True).distinct()), [''])
+        self.assertFalse(denorm.models.RebuildCheckpoint.objects.exists())
+
+        with CaptureQueriesContext(connection) as queries:
+            denorms.rebuildall(model_name='Forum', direct=True, chunk_size=2, max_rows_per_sec=1000)
+        self.assertFalse([q for q in queries.captured_queries if 'INSERT INTO "denorm_dirtyinstance"' in q['sql']])
+        for forum in models.Forum.objects.all():
+            self.assertEqual(forum.post_count, 1)
+            self.assertEqual(forum.path, '/%s/' % forum.title)
+        self.assertFalse(denorm.models.DirtyInstance.objects.exists())
+        self.assertFalse(denorm.models.RebuildCheckpoint.objects.exists())
+
+        models.Forum.objects.update(post_count=7)
+        denorm.models.DirtyInstance.objects.all().delete()
+        call_command('denorm_rebuild', 'Forum', direct=True, chunk_size=3)
+        self.assertEqual(list(models.Forum.objects.values_list('post_count', flat=True).distinct()), [1])
+
+    def test_parallel_rebuild(self):
+        forums = [models.Forum.objects.create(title="forum%s" % i) for i in range(4)]
+        for forum in forums:
+            models.Post.objects.create(forum=forum)
+        denorm.flush()
+        denorms.drop_triggers()
+        models.Forum.objects.update(post_count=7, path='')
+        denorms.install_triggers()
+
+        # a worker rebuilds one range and reports errors instead of raising them
+        lower, upper, count, error = denorms.rebuild_partition(
+            ('test_app.Forum', ['post_count'], forums[0].pk, forums[2].pk, 'default', None, None, 'process', {}))
+        self.assertEqual((lower, upper, count, error), (forums[0].pk, forums[2].pk, 2, None))
+        self.assertEqual(list(models.Forum.objects.order_by('pk').values_list('post_count', flat=True)), [7, 1, 1, 7])
+        lower, upper, count, error = denorms.rebuild_partition(
+            ('test_app.Missing', None, None, None, 'default', None, None, 'process', {}))
+        self.assertEqual(count, 0)
+        self.assertIn('LookupError', error)
+        self.assertIn('LookupError', str(denorms.RebuildError([(models.Forum, None, None, error)])))
+
+        # sqlite rebuilds serially, whatever the number of workers
+        call_command('denorm_rebuild', 'test_app.Forum', direct=True, chunk_size=1, workers=2, executor='thread')
+        for forum in models.Forum.objects.all():
+            self.assertEqual(forum.post_count, 1)
+            self.assertEqual(forum.path, '/%s/' % forum.title)
+        self.assertFalse(denorm.models.RebuildCheckpoint.objects.exists())
+
+    @skipIf(connection.vendor == 'sqlite', "sqlite rebuilds serially")
+    def test_parallel_rebuild_pool(self):
+        forums = [models.Forum.objects.create(title="forum%s" % i) for i in range(4)]
+        for forum in forums:
+            models.Post.objects.create(forum=forum)
+        denorm.flush()
+
+        for executor in ('process', 'thread'):
+            denorms.drop_triggers()
+            models.Forum.objects.update(post_count=7, path='')
+            denorms.install_triggers()
+            rows = denorms.rebuild_model(models.Forum, chunk_size=1, workers=2, executor=executor)
+            self.assertEqual(rows, 4)
+            for forum in models.Forum.objects.all():
+                self.assertEqual(forum.post_count, 1)
+                self.assertEqual(forum.path, '/%s/' % forum.title)
+            self.assertFalse(denorm.models.RebuildCheckpoint.objects.exists())
+
+        with transaction.atomic():
+            with self.assertRaises(transaction.TransactionManagementError):
+                denorms.rebuild_model(models.Forum, chunk_size=1, workers=2)
+
+    def test_shadow_rebuild(self):
+        from denorm import shadow
+        forums = [models.Forum.objects.create(title="forum%s" % i) for i in range(4)]
+        for forum in forums:
+            models.Post.objects.create(forum=forum)
+        denorm.flush()
+        denorms.drop_triggers()
+        models.Forum.objects.update(post_count=7, path='')
+        denorms.install_triggers()
+
+        # the values are computed into the shadow, the live columns keep theirs
+        name = shadow.checkpoint_name(models.Forum)
+        fields = shadow.shadow_denorms(models.Forum, name)
+        self.assertEqual([denorm.fieldname for denorm in fields], ['author_names', 'path', 'post_count', 'tags_string'])
+        table = shadow.create_shadow(models.Forum, fields, name, 'default')
+        denorm.models.RebuildCheckpoint.objects.create(name=name, last_pk='', shadow_table=table)
+        self.assertEqual(shadow.fill_shadow(models.Forum, fields, table, upper=forums[2].pk), 3)
+        self.assertEqual(list(models.Forum.objects.values_list('post_count', 'path').distinct()), [(7, '')])
+
+        # changes made in the meantime are kept
+        models.Post.objects.create(forum=forums[0])
+        forums[1].title = 'renamed'
+        forums[1].save()
+        denorm.flush()
+        self.assertEqual(shadow.fill_shadow(models.Forum, fields, table, lower=forums[2].pk), 1)
+
+        # the rebuilds in progress are looked up once per flush pass
+        shadows = {}
+        with CaptureQueriesContext(connection) as queries:
+            for forum in models.Forum.objects.all():
+                denorms.flush_instance(forum, shadows)
+        self.assertEqual(len([q for q in queries.captured_queries if 'denorm_rebuildcheckpoint' in q['sql']]), 1)
+        self.assertEqual(list(shadows['default']), [models.Forum])
+
+        # unchanged instances only update the rows already in the shadow
+        connection.cursor().execute('DELETE FROM %s WHERE pk = %%s' % connection.ops.quote_name(table), [forums[2].pk])
+        denorms.flush_instance(models.Forum.objects.get(pk=forums[2].pk), shadows)
+        self.assertNotIn(forums[2].pk, shadow.shadow_pks(connection, table))
+        self.assertEqual(shadow.fill_shadow(models.Forum, fields, table, lower=forums[1].pk, upper=forums[2].pk), 1)
+
+        forums[3].title = 'renamed3'
+        forums[3].save()
+        models.Post.objects.create(forum=forums[3])
+
+        # the swap runs in chunks and removes the swapped rows
+        shadow.swap_shadow(models.Forum, fields, table, using='default', chunk_size=2)
+        self.assertFalse(shadow.shadow_pks(connection, table))
+        counts = list(models.Forum.objects.order_by('pk').values_list('post_count', flat=True))
+        self.assertEqual(shadow.swap_shadow(models.Forum, fields, table, using='default'), 0)
+        self.assertEqual(list(models.Forum.objects.order_by('pk').values_list('post_count', flat=True)), counts)
+        denorm.models.RebuildCheckpoint.objects.all().delete()
+        shadow.drop_shadow(table, 'default')
+        denorm.flush()
+        self.assertEqual(
+            list(models.Forum.objects.order_by('pk').values_list('post_count', 'path')),
+            [(2, '/forum0/'), (1, '/renamed/'), (1, '/forum2/'), (2, '/renamed3/')])
+        self.assertNotIn(table, connection.introspection.table_names())
+
+        models.Forum.objects.update(post_count=7, path='')
+        call_command('denorm_rebuild', 'test_app.Forum', shadow=True, chunk_size=3)
+        self.assertEqual(
+            list(models.Forum.objects.order_by('pk').values_list('post_count', 'path')),
+            [(2, '/forum0/'), (1, '/renamed/'), (1, '/forum2/'), (2, '/renamed3/')])
+        self.assertFalse(denorm.models.RebuildCheckpoint.objects.exists())
+
+    def test_verify(self):
+        forums = [models.Forum.objects.create(title="forum%s" % i) for i in range(5)]
+        for forum in forums:
+            models.Post.objects.create(forum=forum)
+        denorm.flush()
+        self.assertEqual(denorms.verify_model(models.Forum, chunk_size=2)['post_count'], 0)
+
+        denorms.drop_triggers()
+        models.Forum.objects.filter(pk__in=[forums[1].pk, forums[4].pk]).update(post_count=7)
+        models.Forum.objects.filter(pk=forums[2].pk).update(path='')
+        denorms.install_triggers()
+
+        out = StringIO()
+        call_command('denorm_verify', 'test_app.Forum', dry_run=True, chunk_size=2, stdout=out)
+        self.assertIn('2 wrong values of test_app.Forum.post_count', out.getvalue())
+        self.assertIn('1 wrong values of test_app.Forum.path', out.getvalue())
+        self.assertIn('3 wrong values found', out.getvalue())
+        self.assertNotIn('0 wrong values', out.getvalue())
+        self.assertFalse(denorm.models.DirtyInstance.objects.exists())
+
+        # verbose lists every field through the command's output
+        out = StringIO()
+        call_command('denorm_verify', 'test_app.Forum', dry_run=True, verbosity=2, stdout=out)
+        self.assertIn('0 wrong values of test_app.Forum.author_names', out.getvalue())
+
+        # a sample recalculates every n-th instance, across the ranges
+        self.assertEqual(denorms.verify_model(models.Forum, chunk_size=2, repair=False, sample=3)['path'], 1)
+        mismatches = denorms.verify_model(models.Forum, chunk_size=2, repair=False, sample=2)
+        self.assertEqual((mismatches['path'], mismatches['post_count']), (0, 2))
+
+        # counts are repaired right away, the other fields by the next flush
+        with CaptureQueriesContext(connection) as queries:
+            results = denorms.verifyall(model_name='Forum', chunk_size=2)
+        self.assertEqual(results[models.Forum]['post_count'], 2)
+        self.assertEqual(len([q for q in queries.captured_queries if q['sql'].startswith('UPDATE "test_app_forum"')]), 2)
+        self.assertEqual(list(models.Forum.objects.values_list('post_count', flat=True).distinct()), [1])
+        forum_type = ContentType.objects.get_for_model(models.Forum)
+        dirty = denorm.models.DirtyInstance.objects.filter(content_type=forum_type)
+        self.assertEqual([int(pk) for pk in dirty.values_list('object_id', flat=True)], [forums[2].pk])
+        denorm.flush()
+        self.assertEqual(models.Forum.objects.get(pk=forums[2].pk).path, '/forum2/')
+        self.assertEqual(sum(denorms.verify_model(models.Forum).values()), 0)
+
+    def test_aggregate_rebuild(self):
+        forums = [models.Forum.objects.create(title="forum%s" % i) for i in range(4)]
+        for forum in forums[:3]:
+            models.Post.objects.create(forum=forum)
+        models.Post.objects.create(forum=forums[0])
+        denorm.flush()
+        denorms.drop_triggers()
+        models.Forum.objects.update(post_count=7)
+        models.Forum.objects.filter(pk=forums[1].pk).update(post_count=1)
+        denorms.install_triggers()
+        denorm.models.DirtyInstance.objects.all().delete()
+
+        # one UPDATE per chunk, only writing the values that changed
+        denorm_ = models.Forum._meta.get_field('post_count').denorm
+        self.assertTrue(denorms.rebuilds_in_sql(denorm_))
+        with CaptureQueriesContext(connection) as queries:
+            written = denorms.rebuild_aggregates(models.Forum, [denorm_], chunk_size=2)
+        self.assertEqual(written, 3)
+        self.assertEqual(len([q for q in queries.captured_queries if q['sql'].startswith('UPDATE "test_app_forum"')]), 3)
+        self.assertEqual([f.post_count for f in models.Forum.objects.order_by('pk')], [2, 1, 1, 0])
+        self.assertFalse(denorm.models.DirtyInstance.objects.filter(
+            content_type=ContentType.objects.get_for_model(models.Forum)).exists())
+
+        # rebuildall doesn't queue the instances for aggregates
+        models.Forum.objects.update(post_count=7)
+        denorm.models.DirtyInstance.objects.all().delete()
+        with CaptureQueriesContext(connection) as queries:
+            denorms.rebuildall(model_name='Forum', field_name='post_count')
+        self.assertFalse([q for q in queries.captured_queries if 'INSERT INTO "denorm_dirtyinstance"' in q['sql']])
+        self.assertEqual([f.post_count for f in models.Forum.objects.order_by('pk')], [2, 1, 1, 0])
+
     def test_denorm_rebuild_called_once(self):
         """
         Test whether the denorm function is not called only once during rebuild.
@@ -594,6 +941,453 @@ class TestDenormalisation(TransactionTestCase):
         m1 = models.Member.objects.get(id=m1.id)
         self.assertNotEqual(ck1, m1.cachekey)
 
+    def test_dirty_instances_unique(self):
+        d1 = models.RealDenormModel.objects.create(text="onion")
+        models.RealDenormModel.objects.create(text="onion")
+        denorm.flush()
+
+        models.RealDenormModel.objects.update(text="garlic")
+        models.RealDenormModel.objects.update(text="leek")
+        models.RealDenormModel.objects.filter(id=d1.id).update(text="carrot")
+        self.assertEqual(denorm.models.DirtyInstance.objects.count(), 2)
+
+        denorm.flush()
+        d1 = models.RealDenormModel.objects.get(id=d1.id)
+        self.assertEqual(d1.ham, "Ham and carrot")
+
+    def test_depends_related_fields(self):
+        f1 = models.Forum.objects.create(title="forumone")
+        f2 = models.Forum.objects.create(title="forumtwo")
+        models.ForumBadge.objects.create(forum=f1)
+        denorm.flush()
+        badge_type = ContentType.objects.get_for_model(models.ForumBadge)
+
+        # ForumBadge.forum_title only depends on Forum.title
+        models.Forum.objects.filter(id=f1.id).update(parent_forum=f2)
+        self.assertFalse(denorm.models.DirtyInstance.objects.filter(content_type=badge_type).exists())
+
+        models.Forum.objects.filter(id=f1.id).update(title="forumthree")
+        self.assertTrue(denorm.models.DirtyInstance.objects.filter(content_type=badge_type).exists())
+        denorm.flush()
+        self.assertEqual(models.ForumBadge.objects.get().forum_title, "forumthree")
+
+    def test_save_bypass(self):
+        with transaction.atomic():
+            d1 = models.RealDenormModel.objects.create(text="onion")
+        # inserts without a primary key are not bypassed
+        self.assertEqual(denorm.models.DirtyInstance.objects.count(), 1)
+        denorm.flush()
+        with transaction.atomic():
+            d1.text = "leek"
+            d1.save()
+        # saved instances are computed already
+        self.assertFalse(denorm.models.DirtyInstance.objects.exists())
+
+        # outside of atomic blocks a failed save could leave the bypass behind
+        d1.text = "onion"
+        d1.save()
+        self.assertEqual(denorm.models.DirtyInstance.objects.count(), 1)
+        denorm.flush()
+
+        # the rollback of a failed save removes the bypass
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    d1.save(force_insert=True)
+            except IntegrityError:
+                pass
+            models.RealDenormModel.objects.filter(pk=d1.pk).update(text="leek")
+        self.assertEqual(denorm.models.DirtyInstance.objects.count(), 1)
+        denorm.flush()
+
+        # the bypass doesn't change the schema
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                d1.text = "onion"
+                d1.save()
+        self.assertFalse([q for q in queries.captured_queries if 'CREATE' in q['sql'].upper()])
+
+        with transaction.atomic():
+            d1.text = "garlic"
+            d1.save(update_fields=['text'])
+            models.RealDenormModel.objects.create(text="carrot")
+            models.RealDenormModel.objects.update(text="celery")
+        self.assertEqual(denorm.models.DirtyInstance.objects.count(), 2)
+        denorm.flush()
+        self.assertEqual(models.RealDenormModel.objects.filter(ham="Ham and celery").count(), 2)
+
+    def test_nested_bypass(self):
+        from denorm.db import triggers
+        d1 = models.RealDenormModel.objects.create(text="onion")
+        denorm.flush()
+        content_type = ContentType.objects.get_for_model(models.RealDenormModel)
+        any_row = denorms.bypass_token(content_type.pk)
+        with transaction.atomic():
+            with triggers.TriggerBypass(any_row):
+                # e.g. a save() run by the flush, with the same or a narrower token
+                for token in (any_row, denorms.bypass_token(content_type.pk, d1.pk)):
+                    with triggers.TriggerBypass(token):
+                        pass
+                    # the enclosing bypass is still in place
+                    models.RealDenormModel.objects.update(text=token)
+        self.assertFalse(denorm.models.DirtyInstance.objects.exists())
+        models.RealDenormModel.objects.update(text="leek")
+        self.assertEqual(denorm.models.DirtyInstance.objects.count(), 1)
+
+    def test_flush_unchanged(self):
+        d1 = models.RealDenormModel.objects.create(text="onion")
+        d2 = models.RealDenormModel.objects.create(text="onion")
+        denorm.flush()
+        content_type = ContentType.objects.get_for_model(models.RealDenormModel)
+        denorm.models.DirtyInstance.objects.create(content_type=content_type, object_id=d1.id)
+        models.RealDenormModel.objects.filter(id=d2.id).update(text="leek")
+
+        with CaptureQueriesContext(connection) as queries:
+            denorm.flush()
+
+        # only the changed instance is written
+        table = models.RealDenormModel._meta.db_table
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE') and table in q['sql']]
+        self.assertEqual(len(updates), 1)
+        self.assertFalse('"text"' in updates[0])
+        self.assertEqual(models.RealDenormModel.objects.get(id=d2.id).ham, "Ham and leek")
+        self.assertFalse(denorm.models.DirtyInstance.objects.exists())
+
+    def test_flush_order(self):
+        order = denorms.flush_order()
+
+        def position(model):
+            content_type_id = ContentType.objects.get_for_model(model).pk
+            return [i for i, group in enumerate(order) if content_type_id in group][0]
+
+        # Forum and Post depend on each other
+        self.assertEqual(position(models.Forum), position(models.Post))
+        self.assertTrue(position(models.Competitor) < position(models.Team))
+        self.assertTrue(position(models.Post) < position(models.Attachment))
+        self.assertTrue(position(models.Tag) < position(models.Post))
+
+
+@override_settings(DENORM_FLUSH_BATCH_SIZE=2)
+class TestBatchedFlush(TestDenormalisation):
+    """
+    Runs the denormalisation tests with batched flushing.
+    """
+
+    def test_batched_queries(self):
+        instances = [models.RealDenormModel.objects.create(text=str(i)) for i in range(6)]
+        denorm.flush()
+
+        models.RealDenormModel.objects.update(text="onion")
+        with CaptureQueriesContext(connection) as queries:
+            denorm.flush(batch_size=2)
+
+        table = models.RealDenormModel._meta.db_table
+        statements = [q['sql'].split(' ', 1)[0] for q in queries if table in q['sql']]
+        self.assertEqual(statements.count('SELECT'), 3)
+        self.assertEqual(statements.count('UPDATE'), 3)
+        for instance in instances:
+            instance = models.RealDenormModel.objects.get(id=instance.id)
+            self.assertEqual(instance.ham, "Ham and onion")
+            self.assertEqual(instance.eggs, "Eggs and onion")
+
+    def test_batched_pages(self):
+        for i in range(5):
+            models.RealDenormModel.objects.create(text=str(i))
+        denorm.flush()
+        models.RealDenormModel.objects.update(text="onion")
+        self.assertEqual(denorm.models.DirtyInstance.objects.count(), 5)
+
+        with CaptureQueriesContext(connection) as queries:
+            denorm.flush(batch_size=2)
+
+        # the queue is read in pages instead of being loaded at once
+        table = denorm.models.DirtyInstance._meta.db_table
+        selects = [q['sql'] for q in queries if q['sql'].startswith('SELECT') and table in q['sql']]
+        self.assertTrue(selects)
+        for sql in selects:
+            self.assertTrue('LIMIT' in sql, sql)
+        self.assertFalse(denorm.models.DirtyInstance.objects.exists())
+        self.assertEqual(models.RealDenormModel.objects.filter(eggs="Eggs and onion").count(), 5)
+
+    def test_batched_claims(self):
+        d1 = models.RealDenormModel.objects.create(text="onion")
+        d2 = models.RealDenormModel.objects.create(text="onion")
+        denorm.flush()
+        models.RealDenormModel.objects.update(text="leek")
+
+        # a marker claimed by an other worker is left alone
+        content_type = ContentType.objects.get_for_model(models.RealDenormModel)
+        claimed = denorm.models.DirtyInstance.objects.filter(content_type=content_type, object_id=d1.id)
+        claimed.update(claim='other', claimed_at=timezone.now())
+        denorm.flush(batch_size=2)
+        self.assertEqual(models.RealDenormModel.objects.get(id=d1.id).ham, "Ham and onion")
+        self.assertEqual(models.RealDenormModel.objects.get(id=d2.id).ham, "Ham and leek")
+        self.assertEqual(list(denorm.models.DirtyInstance.objects.values_list('claim', flat=True)), ['other'])
+
+        # unless the claim has expired
+        claimed.update(claimed_at=timezone.now() - datetime.timedelta(hours=1))
+        denorm.flush(batch_size=2)
+        self.assertEqual(models.RealDenormModel.objects.get(id=d1.id).ham, "Ham and leek")
+        self.assertFalse(denorm.models.DirtyInstance.objects.exists())
+
+    def test_dirty_pages_keyset(self):
+        for i in range(5):
+            models.RealDenormModel.objects.create(text=str(i))
+        denorm.flush()
+        models.RealDenormModel.objects.update(text="onion")
+        markers = list(denorm.models.DirtyInstance.objects.order_by('pk').values_list('pk', flat=True))
+
+        # the next page starts after the previous one
+        page = denorms.claim_dirty_instances('worker', 2, after=markers[2])
+        self.assertEqual([row[0] for row in page], markers[3:])
+        denorm.models.DirtyInstance.objects.filter(pk__in=markers[3:]).update(claim=None)
+
+        pages = denorms.dirty_pages(2)
+        token, page = next(pages)
+        self.assertEqual([row[0] for row in page], markers[:2])
+        # a released marker behind the last page is picked up by a pass from the start
+        denorm.models.DirtyInstance.objects.filter(claim=token).update(claim=None)
+        self.assertEqual([[row[0] for row in page] for token, page in pages], [markers[2:4], markers[4:], markers[:2]])
+
+    def test_middleware_claims(self):
+        from denorm.middleware import DenormMiddleware
+        d1 = models.RealDenormModel.objects.create(text="onion")
+        d2 = models.RealDenormModel.objects.create(text="onion")
+        denorm.flush()
+        models.RealDenormModel.objects.update(text="leek")
+
+        # markers claimed by an other web worker are left to it
+        content_type = ContentType.objects.get_for_model(models.RealDenormModel)
+        claimed = denorm.models.DirtyInstance.objects.filter(content_type=content_type, object_id=d1.id)
+        claimed.update(claim='other', claimed_at=timezone.now())
+        with override_settings(DENORM_FLUSH_BATCH_SIZE=None):
+            response = object()
+            self.assertIs(DenormMiddleware().process_response(None, response), response)
+        self.assertEqual(models.RealDenormModel.objects.get(id=d1.id).ham, "Ham and onion")
+        self.assertEqual(models.RealDenormModel.objects.get(id=d2.id).ham, "Ham and leek")
+        self.assertEqual(list(denorm.models.DirtyInstance.objects.values_list('claim', flat=True)), ['other'])
+
+    def test_batched_concurrent_change(self):
+        d1 = models.RealDenormModel.objects.create(text="onion")
+        denorm.flush()
+        models.RealDenormModel.objects.update(text="leek")
+        page = denorms.claim_dirty_instances('worker', 10)
+        self.assertEqual(len(page), 1)
+        pk, content_type_id, object_id = page[0]
+
+        # the instance changes again while the worker is busy
+        models.RealDenormModel.objects.update(text="garlic")
+        denorms.flush_batch('worker', content_type_id, models.RealDenormModel, [object_id])
+        self.assertEqual(denorm.models.DirtyInstance.objects.filter(claim__isnull=True).count(), 1)
+
+        denorm.flush()
+        self.assertEqual(models.RealDenormModel.objects.get(id=d1.id).ham, "Ham and garlic")
+        self.assertFalse(denorm.models.DirtyInstance.objects.exists())
+
+    def test_unbatched_concurrent_change(self):
+        d1 = models.RealDenormModel.objects.create(text="onion")
+        denorm.flush()
+        models.RealDenormModel.objects.update(text="leek")
+        flush_instance = denorms.flush_instance
+        flushed = []
+
+        def changed_again(instance, shadows=None):
+            flush_instance(instance, shadows)
+            flushed.append(instance.pk)
+            if change_again and len(flushed) == 1:
+                # what the triggers do if an other connection changes the instance
+                denorm.models.DirtyInstance.objects.update(claim=None)
+
+        denorms.flush_instance = changed_again
+        try:
+            with override_settings(DENORM_FLUSH_BATCH_SIZE=None):
+                # the flush's own write doesn't mark the instance dirty again
+                change_again = False
+                denorm.flush()
+                self.assertEqual(flushed, [d1.pk])
+                self.assertEqual(models.RealDenormModel.objects.get(id=d1.id).ham, "Ham and leek")
+
+                # a marker changed again while it was flushed is kept
+                models.RealDenormModel.objects.update(text="garlic")
+                change_again = True
+                flushed = []
+                denorm.flush()
+                self.assertEqual(flushed, [d1.pk, d1.pk])
+        finally:
+            denorms.flush_instance = flush_instance
+        self.assertFalse(denorm.models.DirtyInstance.objects.exists())
+
+    def test_partition_page(self):
+        page = [(1, 10, '1'), (2, 10, '2'), (3, 11, '1'), (4, 10, '3'), (5, 10, '2')]
+        partitions = denorms.partition_page(page, 2)
+        self.assertEqual(sorted(sum(partitions.values(), [])), ['1', '1', '2', '3'])
+        for (content_type_id, partition), object_ids in partitions.items():
+            self.assertTrue(partition in (0, 1))
+            for object_id in object_ids:
+                self.assertEqual(denorms.partition_page([(1, content_type_id, object_id)], 2), {(content_type_id, partition): [object_id]})
+
+    def test_parallel_flush(self):
+        for i in range(6):
+            models.RealDenormModel.objects.create(text=str(i))
+        denorm.flush()
+        models.RealDenormModel.objects.update(text="onion")
+
+        self.assertEqual(denorm.flush(workers=2, executor='thread'), 6)
+        self.assertEqual(models.RealDenormModel.objects.filter(eggs="Eggs and onion").count(), 6)
+        self.assertFalse(denorm.models.DirtyInstance.objects.exists())
+
+    def test_parallel_flush_errors(self):
+        if connection.vendor != 'sqlite':
+            with self.assertRaises(ValueError):
+                denorm.flush(workers=2, executor='fiber')
+
+        # the workers commit on their own, which would break an enclosing transaction
+        with transaction.atomic():
+            with self.assertRaises(transaction.TransactionManagementError):
+                denorms.get_pool(2, 'process')
+
+        # the worker processes leave the connections of this one alone
+        connection.ensure_connection()
+        pool = denorms.get_pool(1, 'process')
+        pool.close()
+        pool.join()
+        self.assertIsNotNone(connection.connection)
+        self.assertEqual(models.RealDenormModel.objects.count(), 0)
+
+    def test_parallel_flush_worker_errors(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest("the worker thread would lock the in-memory database of this one")
+        models.RealDenormModel.objects.create(text="onion")
+        denorm.flush()
+        models.RealDenormModel.objects.update(text="leek")
+
+        marker = denorm.models.DirtyInstance.objects.get()
+        # a thread worker closes its connections, so it must not run on this thread
+        pool = ThreadPool(1)
+        content_type_id, object_ids, error = pool.apply(
+            denorms.flush_partition, [('worker', 0, [marker.object_id], 'thread', {})])
+        pool.close()
+        pool.join()
+        self.assertEqual((content_type_id, object_ids), (0, [marker.object_id]))
+        self.assertTrue('DoesNotExist' in error)
+        self.assertTrue(error in str(denorms.FlushError([(content_type_id, object_ids, error)])))
+        self.assertEqual(denorm.models.DirtyInstance.objects.count(), 1)
+
+    @skipIf(connection.vendor == 'sqlite', "sqlite flushes serially")
+    def test_parallel_flush_pool(self):
+        for i in range(6):
+            models.RealDenormModel.objects.create(text=str(i))
+        denorm.flush()
+
+        for executor in ('process', 'thread'):
+            models.RealDenormModel.objects.update(text=executor)
+            self.assertEqual(denorm.flush(workers=2, executor=executor, batch_size=4), 6)
+            self.assertEqual(models.RealDenormModel.objects.filter(eggs="Eggs and %s" % executor).count(), 6)
+            self.assertFalse(denorm.models.DirtyInstance.objects.exists())
+
+
+class TestObjectIdField(TestCase):
+    def test_object_id_type(self):
+        from denorm.helpers import object_id_field
+        with override_settings(DENORM_OBJECT_ID_TYPE='text'):
+            self.assertIsInstance(object_id_field(), django.db.models.CharField)
+        with override_settings(DENORM_OBJECT_ID_TYPE='bigint'):
+            self.assertIsInstance(object_id_field(), django.db.models.BigIntegerField)
+        with override_settings(DENORM_OBJECT_ID_TYPE='uuid'):
+            self.assertIsInstance(object_id_field(), django.db.models.UUIDField)
+            # the migrations only know the text column
+            field = object_id_field()
+            field.set_attributes_from_name('object_id')
+            self.assertEqual(field.deconstruct(), ('object_id', 'django.db.models.CharField', [], {'max_length': 255, 'blank': True, 'null': True}))
+            self.assertIsInstance(field.clone(), django.db.models.UUIDField)
+        with override_settings(DENORM_OBJECT_ID_TYPE='float'):
+            self.assertRaises(ValueError, object_id_field)
+
+
+class TestObjectIdType(TransactionTestCase):
+    def tearDown(self):
+        denorm.models.DirtyInstance.objects.all().delete()
+        call_command('denorm_object_id_type', 'bigint')
+
+    def test_bigint_ids(self):
+        denorm.models.DirtyInstance.objects.all().delete()
+        with override_settings(DENORM_OBJECT_ID_TYPE='bigint'):
+            call_command('denorm_object_id_type', 'text')
+
+        d1 = models.RealDenormModel.objects.create(text="onion")
+        d2 = models.RealDenormModel.objects.create(text="onion")
+        models.RealDenormModel.objects.update(text="leek")
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT typeof(object_id) FROM denorm_dirtyinstance')
+                self.assertEqual(set(row[0] for row in cursor.fetchall()), set(['integer']))
+
+        # the batched flush deletes the markers it flushed
+        self.assertEqual(denorm.flush(batch_size=1), 2)
+        self.assertFalse(denorm.models.DirtyInstance.objects.exists())
+        models.RealDenormModel.objects.filter(id=d1.id).update(text="garlic")
+        denorm.flush()
+        self.assertFalse(denorm.models.DirtyInstance.objects.exists())
+        self.assertEqual(models.RealDenormModel.objects.get(id=d1.id).ham, "Ham and garlic")
+        self.assertEqual(models.RealDenormModel.objects.get(id=d2.id).ham, "Ham and leek")
+
+        models.RealDenormModel.objects.update(text="celery")
+        self.assertRaises(django.core.management.base.CommandError, call_command, 'denorm_object_id_type', 'bigint')
+
+
+class TestRegistry(TestCase):
+    def test_indexes(self):
+        from denorm.registry import registry
+
+        self.assertTrue(registry.built)
+        fieldnames = [denorm.fieldname for denorm in registry.for_model(models.Forum)]
+        self.assertIn('post_count', fieldnames)
+        self.assertIn('path', fieldnames)
+        self.assertEqual(registry.for_model(models.CallCounterProxy), registry.for_model(models.CallCounter))
+
+        affected = [(denorm.model, denorm.fieldname) for denorm in registry.for_table(models.Post._meta.db_table)]
+        self.assertIn((models.Forum, 'post_count'), affected)
+        self.assertIn((models.Attachment, 'forum'), affected)
+        self.assertNotIn((models.Post, 'forum_title'), affected)
+        through = models.Member._meta.get_field('bookmarks').m2m_db_table()
+        self.assertIn((models.Member, 'bookmark_titles'), [(d.model, d.fieldname) for d in registry.for_table(through)])
+
+        self.assertIn(models.Forum, registry.dependents(models.Post))
+        self.assertEqual(registry.m2m_fields(models.Forum), [models.Forum._meta.get_field('authors')])
+        self.assertEqual(registry.m2m_fields(models.Post), [])
+        self.assertEqual(len(denorms.get_alldenorms()), len(set(map(id, denorms.get_alldenorms()))))
+
+
+class TestImport(TestCase):
+    def test_lazy_import(self):
+        """
+        Importing denorm doesn't load the ORM, its public names are loaded
+        on first use.
+        """
+        import json
+        import subprocess
+        import sys
+
+        script = "\n".join([
+            "import json, sys",
+            "import denorm",
+            "heavy = ('denorm.', 'django.db', 'django.contrib', 'django.apps')",
+            "modules = sorted(name for name in sys.modules if name.startswith(heavy))",
+            "denorm.denormalized, denorm.depend_on_related, denorm.flush",
+            "print(json.dumps([modules, denorm.flush.__module__, 'django.db.models' in sys.modules]))",
+        ])
+        output = subprocess.check_output([sys.executable, '-c', script])
+        modules, flush_module, loaded = json.loads(output.decode('utf-8'))
+        self.assertEqual(modules, [])
+        self.assertEqual(flush_module, 'denorm.denorms')
+        self.assertTrue(loaded)
+
+    def test_backend_per_alias(self):
+        from denorm import db
+        self.assertIs(db.get_backend('default'), db.get_backend())
+        self.assertTrue(db.get_backend().__name__.startswith('denorm.db.%s' % connection.vendor))
+        self.assertIs(db.triggers.TriggerSet, db.get_backend().TriggerSet)
+
 
 if connection.vendor != "sqlite":
     class TestFilterCount(TestCase):
@@ -715,6 +1509,16 @@ if connection.vendor != "sqlite":
             master = models.FilterSumModel.objects.get(pk=master.pk)
             self.assertEqual(master.active_item_sum, 8)
 
+        def test_filter_sum_rebuild(self):
+            master = models.FilterSumModel.objects.create()
+            empty = models.FilterSumModel.objects.create()
+            master.counts.create(age=18, active_item_count=8)
+            master.counts.create(age=16, active_item_count=4)
+            models.FilterSumModel.objects.update(active_item_sum=3)
+            denorms.rebuild_aggregates(models.FilterSumModel, [models.FilterSumModel._meta.get_field('active_item_sum').denorm])
+            self.assertEqual(models.FilterSumModel.objects.get(pk=master.pk).active_item_sum, 8)
+            self.assertEqual(models.FilterSumModel.objects.get(pk=empty.pk).active_item_sum, 0)
+
 
 class CommandsTestCase(TransactionTestCase):
     def test_denorm_daemon(self):
@@ -734,6 +1538,142 @@ class CommandsTestCase(TransactionTestCase):
         " Test denorm_init command."
         call_command('denorm_init')
 
+    def test_denorm_init_check(self):
+        " Test denorm_init --check command."
+        denorms.drop_triggers()
+        self.assertRaises(django.core.management.base.CommandError, call_command, 'denorm_init', check=True)
+        call_command('denorm_init')
+        call_command('denorm_init', check=True)
+
+        # unchanged triggers are not recreated
+        with CaptureQueriesContext(connection) as queries:
+            call_command('denorm_init')
+        self.assertFalse([q for q in queries.captured_queries if ' TRIGGER ' in q['sql'].upper()])
+
+        installed = denorm.models.InstalledTrigger.objects.all()[0]
+        installed.checksum = ''
+        installed.save()
+        self.assertRaises(django.core.management.base.CommandError, call_command, 'denorm_init', check=True)
+        call_command('denorm_init')
+        call_command('denorm_init', check=True)
+
+        # triggers changed in the database are replaced as well
+        installed = denorm.models.InstalledTrigger.objects.all()[0]
+        self.assertTrue(installed.definition)
+        if connection.vendor == 'sqlite':
+            sql = denorms.build_triggerset().definitions()[installed.name]
+            with connection.cursor() as cursor:
+                cursor.execute('DROP TRIGGER %s' % connection.ops.quote_name(installed.name))
+                cursor.execute(sql.replace('BEGIN', 'BEGIN\n', 1))
+        else:
+            installed.definition = 'changed'
+            installed.save()
+        out = StringIO()
+        self.assertRaises(django.core.management.base.CommandError, call_command, 'denorm_init', check=True, stdout=out)
+        self.assertEqual(out.getvalue(), 'replace %s\n' % installed.name)
+        call_command('denorm_init')
+        call_command('denorm_init', check=True)
+
+    def test_denorm_init_online(self):
+        " Test denorm_init --online command."
+        denorms.drop_triggers()
+        forum = models.Forum.objects.create(title="forumone")
+        models.Forum.objects.filter(id=forum.id).update(title="forumtwo")
+        models.Post.objects.create(forum=forum)
+        denorm.models.DirtyInstance.objects.all().delete()
+
+        call_command('denorm_init', online=True, verbosity=0)
+        call_command('denorm_init', check=True)
+
+        # changes made without triggers are rebuilt right away, counts included
+        forum = models.Forum.objects.get(id=forum.id)
+        self.assertEqual(forum.path, '/forumtwo/')
+        self.assertEqual(forum.post_count, 1)
+        # only what depends on the rebuilt values is queued
+        denorm.flush()
+
+        # nothing changed, nothing to rebuild
+        with CaptureQueriesContext(connection) as queries:
+            call_command('denorm_init', online=True, verbosity=0)
+        self.assertFalse([q for q in queries.captured_queries if q['sql'].startswith('UPDATE "test_app_forum"')])
+        self.assertFalse(denorm.models.DirtyInstance.objects.exists())
+
+    def test_denorm_init_online_lock_timeout(self):
+        " Test that denorm_init --online restores the lock timeout of the session."
+        denorms.drop_triggers()
+        triggerset = denorms.build_triggerset()
+        if connection.vendor == 'mysql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT @@SESSION.lock_wait_timeout')
+                previous = cursor.fetchone()[0]
+            triggerset.install_online(lock_timeout=1000)
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT @@SESSION.lock_wait_timeout')
+                self.assertEqual(cursor.fetchone()[0], previous)
+            denorms.drop_triggers()
+
+        # also after failures
+        def apply(*args):
+            raise django.db.DatabaseError("lock wait timeout")
+        triggerset.restore_lock_timeout_sql = lambda: 'SELECT 42'
+        triggerset.apply = apply
+        with CaptureQueriesContext(connection) as queries:
+            with self.assertRaises(django.db.DatabaseError):
+                triggerset.install_online(retries=0)
+        self.assertEqual(queries.captured_queries[-1]['sql'], 'SELECT 42')
+        denorms.install_triggers()
+
+    def test_denorm_makemigrations(self):
+        " Test denorm_makemigrations command."
+        from denorm.operations import render_triggers, InstallDenormTriggers
+
+        out = StringIO()
+        call_command('denorm_makemigrations', 'test_app', dry_run=True, stdout=out)
+        self.assertIn('denorm.operations.InstallDenormTriggers(', out.getvalue())
+        self.assertIn('{content_type:test_app.forum}', out.getvalue())
+
+        denorms.drop_triggers()
+        vendor, tables = render_triggers()
+        with connection.schema_editor() as editor:
+            for table, triggers in tables.items():
+                InstallDenormTriggers(table, triggers, vendor).database_forwards('test_app', editor, None, None)
+        # the same triggers as installed by denorm_init
+        call_command('denorm_init', check=True)
+
+        # triggers rendered for an other vendor are not applied
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with connection.schema_editor() as editor:
+                InstallDenormTriggers('test_app_forum', [], 'oracle').database_forwards('test_app', editor, None, None)
+        self.assertEqual(len(caught), 1)
+        self.assertIn('rendered for oracle', str(caught[0].message))
+        call_command('denorm_init', check=True)
+
+    def test_backfill_denorm_field(self):
+        from denorm.operations import BackfillDenormField
+
+        forums = [models.Forum.objects.create(title="forum%s" % i) for i in range(3)]
+        for forum in forums[:2]:
+            models.Post.objects.create(forum=forum)
+        denorm.flush()
+        denorms.drop_triggers()
+        models.Forum.objects.update(post_count=7, path='')
+        denorms.install_triggers()
+
+        operation = BackfillDenormField('forum', 'post_count', chunk_size=2, sleep=0.01)
+        self.assertEqual(operation.deconstruct(), (
+            'BackfillDenormField', [], {'model_name': 'forum', 'name': 'post_count', 'chunk_size': 2, 'sleep': 0.01}))
+        with connection.schema_editor() as editor:
+            operation.database_forwards('test_app', editor, None, None)
+        # only the backfilled field is written
+        self.assertEqual(list(models.Forum.objects.order_by('pk').values_list('post_count', 'path')), [(1, ''), (1, ''), (0, '')])
+        self.assertFalse(denorm.models.RebuildCheckpoint.objects.exists())
+
+        with connection.schema_editor() as editor:
+            BackfillDenormField('forum', 'path').database_forwards('test_app', editor, None, None)
+            self.assertRaises(ValueError, BackfillDenormField('forum', 'title').database_forwards, 'test_app', editor, None, None)
+        self.assertEqual(list(models.Forum.objects.order_by('pk').values_list('path', flat=True)), ['/forum0/', '/forum1/', '/forum2/'])
+
     def test_denorm_drop(self):
         " Test denorm_init command."
         call_command('denorm_drop')